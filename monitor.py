@@ -0,0 +1,162 @@
+import os
+import time
+
+# Follows a (possibly still running) pw.x or ph.x output file,
+# remembering how far through the file it has read so that each
+# call to poll() only parses newly appended lines. poll() returns
+# a list of events, each a dictionary with an "event" key that is
+# one of
+#   scf_iteration   : a new scf iteration (pw.x) has started
+#   scf_accuracy    : estimated scf accuracy (pw.x, Ry) or |ddv_scf|^2 (ph.x)
+#   scf_converged   : pw.x scf convergence has been achieved
+#   iteration_cpu_time : cpu time (since the program started) reported
+#                     at the end of an iteration, along with the cpu time
+#                     taken by that iteration (q.e reports no wall time
+#                     per iteration)
+#   bfgs_step       : a new bfgs step of a relaxation
+#   enthalpy        : the enthalpy of the current bfgs step
+#   qpoint_started  : ph.x has started a new q-point
+#   qpoint_finished : ph.x has finished all representations at a q-point
+#   irrep_started   : ph.x has started a new irreducible representation
+#   irrep_finished  : ph.x has converged an irreducible representation
+#   job_done        : the program has finished
+# Every event also records the program that wrote the output and
+# the (wall clock) time at which the event was seen. The cpu time of
+# an iteration_cpu_time event is kept separately, as it is summed over
+# threads, so can run ahead of the wall time. The (wall clock) time at
+# which the program started is read from the header of the output.
+class OutputMonitor(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.reset()
+
+    # Forget everything we have read so far
+    def reset(self):
+        self.offset    = 0
+        self.program   = None
+        self.start     = None
+        self.iteration = 0
+        self.cpu_time  = 0.0
+        self.qpoint    = 0
+        self.irrep     = 0
+        self.done      = False
+
+    # Parse any lines appended to the file since the last poll
+    def poll(self):
+
+        if not os.path.isfile(self.filename):
+            return []
+
+        # The file has been truncated (e.g the stage was rerun)
+        if os.path.getsize(self.filename) < self.offset:
+            self.reset()
+
+        with open(self.filename, "rb") as f:
+            f.seek(self.offset)
+            new = f.read()
+
+        # Only parse complete lines, the rest will be
+        # parsed once the line has been finished
+        end = new.rfind(b"\n") + 1
+        self.offset += end
+
+        events = []
+        now    = time.time()
+        for line in new[:end].decode("utf-8", "replace").split("\n"):
+            for e in self.parse_line(line):
+                e["program"] = self.program
+                if not "time" in e: e["time"] = now
+                events.append(e)
+
+        return events
+
+    # Returns the events contained in a single line of output
+    def parse_line(self, line):
+
+        if "Program" in line and " v." in line:
+            self.program = line.split("Program")[-1].split()[0]
+            self.start   = parse_start_time(line)
+            return []
+
+        # pw.x scf progress
+        if "iteration #" in line:
+            self.iteration = int(line.split("#")[-1].split()[0])
+            return [{"event" : "scf_iteration", "iteration" : self.iteration}]
+
+        if "estimated scf accuracy" in line:
+            acc = float(line.split("<")[-1].split()[0])
+            return [{"event" : "scf_accuracy", "iteration" : self.iteration, "accuracy" : acc}]
+
+        if "convergence has been achieved in" in line:
+            its = int(line.split("in")[-1].split()[0])
+            return [{"event" : "scf_converged", "iterations" : its}]
+
+        if "total cpu time spent up to now is" in line:
+            return [self.iteration_time(float(line.split("is")[-1].split()[0]))]
+
+        # pw.x relaxation progress
+        if "number of bfgs steps" in line:
+            return [{"event" : "bfgs_step", "step" : int(line.split("=")[-1])}]
+
+        if "enthalpy new" in line:
+            return [{"event" : "enthalpy", "enthalpy" : float(line.split("=")[-1].split()[0])}]
+
+        # ph.x progress
+        if "Calculation of q" in line:
+            self.qpoint += 1
+            q = [float(w) for w in line.split("=")[-1].replace("-"," -").split()]
+            return [{"event" : "qpoint_started", "qpoint" : self.qpoint, "q" : q}]
+
+        if "Diagonalizing the dynamical matrix" in line:
+            return [{"event" : "qpoint_finished", "qpoint" : self.qpoint}]
+
+        if "Representation #" in line:
+            self.irrep     = int(line.split("#")[1].split()[0])
+            self.iteration = 0
+            return [{"event" : "irrep_started", "qpoint" : self.qpoint, "irrep" : self.irrep}]
+
+        if "iter #" in line and "total cpu time" in line:
+            self.iteration = int(line.split("#")[-1].split()[0])
+            return [self.iteration_time(float(line.split(":")[1].split()[0]))]
+
+        if "|ddv_scf|^2" in line:
+            acc = float(line.split("=")[-1])
+            return [{"event" : "scf_accuracy", "iteration" : self.iteration, "accuracy" : acc}]
+
+        if "Convergence has been achieved" in line:
+            return [{"event" : "irrep_finished", "qpoint" : self.qpoint, "irrep" : self.irrep}]
+
+        if "JOB DONE" in line:
+            self.done = True
+            return [{"event" : "job_done"}]
+
+        return []
+
+    # Event recording the cpu time at the end of an iteration
+    def iteration_time(self, cpu_time):
+        dt = cpu_time - self.cpu_time
+        self.cpu_time = cpu_time
+        return {"event" : "iteration_cpu_time", "iteration" : self.iteration,
+                "cpu_time" : cpu_time, "cpu_dt" : dt}
+
+# The (wall clock) time at which a program started, from the header line
+# "Program PWSCF v.6.4 starts on 14Feb2019 at  9: 5:12" (q.e pads the
+# date and time with spaces), or None if it can't be read
+def parse_start_time(line):
+    if not "starts on" in line or not " at " in line: return None
+    date, clock = line.split("starts on")[-1].split(" at ")
+    try:
+        t = time.strptime(date.replace(" ", "") + " " + clock.replace(" ", ""), "%d%b%Y %H:%M:%S")
+    except ValueError:
+        return None
+    return time.mktime(t)
+
+# Poll each of the given monitors, returning
+# a list of [filename, event] pairs
+def poll_all(monitors):
+    events = []
+    for m in monitors:
+        for e in m.poll():
+            events.append([m.filename, e])
+    return events
@@ -0,0 +1,206 @@
+import numpy as np
+import functools
+import inspect
+import zipfile
+import hashlib
+import json
+import os
+
+# On-disk cache of parsed q.e outputs. Parsed results are stored as
+# .npz files keyed by the path, size and modification time of the
+# files that were parsed, together with a hash of their first and last
+# blocks (so that looking up a multi-GB output costs two small reads,
+# rather than reading it all, as parsing only its tail would). The
+# cache is off unless enabled, either with the environment variables
+#   QE_TOOLS_CACHE     : set to 1 to enable the cache
+#   QE_TOOLS_CACHE_DIR : the directory the cache is stored in
+#   QE_TOOLS_CACHE_MB  : the size the cache can grow to before
+#                        the least-recently-used entries are evicted
+# or by calling configure_cache.
+CACHE_ENABLED   = os.environ.get("QE_TOOLS_CACHE", "0") == "1"
+CACHE_DIR       = os.environ.get("QE_TOOLS_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "quantum_espresso_tools", "parse"))
+CACHE_MAX_BYTES = int(float(os.environ.get("QE_TOOLS_CACHE_MB", 1024))*1024*1024)
+
+# The size of the blocks at the start and end of a file that are hashed
+HASH_BLOCK_BYTES = 64*1024
+
+# The errors raised when loading a corrupt or partially written entry
+BAD_ENTRY_ERRORS = (IOError, OSError, ValueError, KeyError, EOFError, zipfile.BadZipfile)
+
+# Running estimate of the size of the cache (None => not yet measured)
+cache_bytes = None
+
+def configure_cache(directory=None, max_bytes=None, enabled=None):
+    global CACHE_DIR, CACHE_MAX_BYTES, CACHE_ENABLED, cache_bytes
+    if not directory is None:
+        CACHE_DIR   = directory
+        cache_bytes = None
+    if not max_bytes is None: CACHE_MAX_BYTES = int(max_bytes)
+    if not enabled   is None: CACHE_ENABLED   = enabled
+
+# The name of the first argument of the given function
+def first_argument(function):
+    try: return list(inspect.signature(function).parameters)[0]
+    except AttributeError: return inspect.getargspec(function).args[0]
+
+# Decorator that caches the result of a parser on disk. files is a
+# function which, given the arguments to the parser, returns the list
+# of files that the result depends on (or None if the result should
+# not be cached). By default this is the first argument (which can
+# also be passed by name).
+def cached_parser(files=None):
+
+    def decorate(parser):
+
+        depends = files
+        if depends is None:
+            name    = first_argument(parser)
+            depends = lambda *args, **kwargs : [kwargs[name] if name in kwargs else args[0]]
+
+        @functools.wraps(parser)
+        def cached(*args, **kwargs):
+
+            if not CACHE_ENABLED:
+                return parser(*args, **kwargs)
+
+            # If we can't work out the key (e.g the file doesn't exist, or
+            # the arguments are wrong) just call the parser and let it
+            # raise the relevant error
+            try:
+                paths = depends(*args, **kwargs)
+                if paths is None: return parser(*args, **kwargs)
+                key = cache_key(parser.__name__, paths, args, kwargs)
+            except (IOError, OSError, TypeError, IndexError, KeyError):
+                return parser(*args, **kwargs)
+
+            path = os.path.join(CACHE_DIR, key[:2], key+".npz")
+            if os.path.isfile(path):
+                try:
+                    return load_result(path)
+                except BAD_ENTRY_ERRORS:
+                    # Remove the bad entry, it is replaced below
+                    try: os.remove(path)
+                    except OSError: pass
+
+            result = parser(*args, **kwargs)
+            try:
+                store_result(path, result)
+            except (IOError, OSError, TypeError, ValueError):
+                pass
+            return result
+
+        cached.uncached = parser
+        return cached
+
+    return decorate
+
+# Work out the cache key for a call to the named
+# parser, with the given arguments, that depends on
+# the given files
+def cache_key(name, paths, args, kwargs):
+
+    h = hashlib.sha1()
+    h.update(repr([name, args[1:], sorted(kwargs.items())]).encode("utf-8"))
+
+    for p in paths:
+        st    = os.stat(p)
+        mtime = getattr(st, "st_mtime_ns", st.st_mtime)
+        h.update(repr([os.path.abspath(p), st.st_size, mtime]).encode("utf-8"))
+        if os.path.isdir(p): continue
+        with open(p, "rb") as f:
+            h.update(f.read(HASH_BLOCK_BYTES))
+            if st.st_size > 2*HASH_BLOCK_BYTES:
+                f.seek(-HASH_BLOCK_BYTES, os.SEEK_END)
+                h.update(f.read())
+
+    return h.hexdigest()
+
+# Convert a (nested) parser result into a json-able description,
+# moving numpy arrays (and lists of floats) into arrays
+def pack(obj, arrays):
+
+    if isinstance(obj, np.ndarray):
+        arrays.append(obj)
+        return {"a" : len(arrays)-1}
+
+    if isinstance(obj, dict):
+        return {"d" : [[k, pack(v, arrays)] for k, v in obj.items()]}
+
+    if isinstance(obj, (list, tuple)):
+        if len(obj) > 0 and all(type(x) is float for x in obj):
+            arrays.append(np.array(obj))
+            return {"f" : len(arrays)-1}
+        kind = "l" if isinstance(obj, list) else "t"
+        return {kind : [pack(x, arrays) for x in obj]}
+
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+
+    if not (obj is None or isinstance(obj, (bool, int, float, str))):
+        raise TypeError("Cannot cache parser result of type {0}".format(type(obj)))
+
+    return {"v" : obj}
+
+# Inverse of pack
+def unpack(desc, arrays):
+
+    if "a" in desc: return arrays["a{0}".format(desc["a"])]
+    if "f" in desc: return arrays["a{0}".format(desc["f"])].tolist()
+    if "d" in desc: return dict([k, unpack(v, arrays)] for k, v in desc["d"])
+    if "l" in desc: return [unpack(v, arrays) for v in desc["l"]]
+    if "t" in desc: return tuple(unpack(v, arrays) for v in desc["t"])
+    return desc["v"]
+
+def load_result(path):
+
+    with np.load(path, allow_pickle=False) as npz:
+        result = unpack(json.loads(str(npz["structure"])), npz)
+
+    # Mark as recently used
+    os.utime(path, None)
+    return result
+
+def store_result(path, result):
+    global cache_bytes
+
+    arrays = []
+    desc   = pack(result, arrays)
+    npz    = dict(["a{0}".format(i), a] for i, a in enumerate(arrays))
+    npz["structure"] = np.array(json.dumps(desc))
+
+    # Write to a temporary file and rename, so that concurrent
+    # readers never see a partially written entry
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        np.savez(f, **npz)
+    os.rename(tmp, path)
+
+    if cache_bytes is None: evict()
+    else: cache_bytes += os.path.getsize(path)
+    if cache_bytes > CACHE_MAX_BYTES: evict()
+
+# Measure the size of the cache, removing the least-recently-used
+# entries until it is below 90% of its maximum size
+def evict():
+    global cache_bytes
+
+    entries = []
+    for root, dirs, files in os.walk(CACHE_DIR):
+        for f in files:
+            if not f.endswith(".npz"): continue
+            f  = os.path.join(root, f)
+            st = os.stat(f)
+            entries.append([st.st_mtime, st.st_size, f])
+
+    entries.sort()
+    cache_bytes = sum(e[1] for e in entries)
+    if cache_bytes <= CACHE_MAX_BYTES: return
+
+    for mtime, size, f in entries:
+        if cache_bytes <= 0.9*CACHE_MAX_BYTES: break
+        try: os.remove(f)
+        except OSError: continue
+        cache_bytes -= size
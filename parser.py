@@ -1,84 +1,715 @@
+from quantum_espresso_tools.parse_cache import cached_parser
+from quantum_espresso_tools.qe_input    import QEInput, format_rows
 import numpy as np
+import numpy.linalg as la
 import sys
 import os
+import re
+import xml.etree.ElementTree as ET
 
 RY_TO_K   = 157887.6633481157
 RY_TO_CMM = 109736.75775046606
+RY_TO_EV  = 13.605693122994
+ANGSTROM_TO_BOHR = 1.88973
+
+# Keys recovered from a vc-relax output by parse_vc_relax
+VC_RELAX_KEYS = ["lattice", "atoms", "energy", "enthalpy", "pressure", "volume"]
 
 # Parse the result of a vc-relax run for the
-# atomic positions and the cell parameters
-def parse_vc_relax(filename):
-        
-        f     = open(filename)
-        lines = f.read().split("\n")
-        f.close()
+# atomic positions and the cell parameters. The file is
+# streamed line by line; if final_only is True, the file
+# is instead read backwards from the end (in growing chunks)
+# until the final geometry/energy block has been found, so
+# that the cost is O(final block) rather than O(file)
+@cached_parser()
+def parse_vc_relax(filename, final_only=False):
+
+        if final_only:
+                return parse_vc_relax_tail(filename)
+
+        with open(filename) as f:
+                return parse_vc_relax_lines(f)
+
+# Parse vc-relax output from an iterable of lines, keeping
+# the last value found for each quantity
+def parse_vc_relax_lines(lines):
 
-        start = False
         data  = {}
+        lines = iter(lines)
+        line  = next(lines, None)
+
+        while line is not None:
 
-        for i, line in enumerate(lines):
-                
                 # Ignore case
-                line = line.lower()
+                low = line.lower()
 
-                # Parse cell parameters 
-                if "cell_parameters" in line:
-                        data["lattice"] = []
-                        for j in range(i+1,i+4):
-                                data["lattice"].append([float(w) for w in lines[j].split()])
+                # Parse cell parameters (ignoring a block that
+                # is cut short by the end of the file)
+                if "cell_parameters" in low:
+                        rows = [next(lines, None) for j in range(3)]
+                        if None in rows: break
+                        data["lattice"] = [[float(w) for w in r.split()] for r in rows]
 
-                # Parse atomic positions
-                if "atomic_positions" in line:
+                # Parse atomic positions (the line that ends the
+                # block is then parsed as normal)
+                if "atomic_positions" in low:
                         data["atoms"] = []
-                        for j in range(i+1, len(lines)):
+                        for line in lines:
                                 try:
-                                        name, x, y, z = lines[j].split()
+                                        name, x, y, z = line.split()
                                         x, y, z = [float(c) for c in [x,y,z]]
                                         data["atoms"].append([name, x, y, z])
-                                except:
+                                except ValueError:
                                         break
+                        else:
+                                break
+                        continue
                 
                 # Parse the final total energy (i.e the scf energy)
-                if "total energy" in line and "!" in line:
-                        data["energy"] = float(line.split("=")[-1].split("r")[0])
+                if "total energy" in low and "!" in low:
+                        data["energy"] = float(low.split("=")[-1].split("r")[0])
 
                 # Parse enthalpy (in case final enthalpy is absent for some reason)
-                if "enthalpy new" in line:
-                        data["enthalpy"] = float(line.split("=")[-1].split("r")[0]) 
+                if "enthalpy new" in low:
+                        data["enthalpy"] = float(low.split("=")[-1].split("r")[0]) 
 
                 # Parse final enthalpy
-                if "final enthalpy" in line:
-                        data["enthalpy"] = float(line.split("=")[-1].split("r")[0])
+                if "final enthalpy" in low:
+                        data["enthalpy"] = float(low.split("=")[-1].split("r")[0])
 
                 # Parse final pressure
-                if "p=" in line:
-                        data["pressure"] = float(line.split("=")[-1])
+                if "p=" in low:
+                        data["pressure"] = float(low.split("=")[-1])
 
                 # Parse final volume
-                if "unit-cell volume" in line:
-                        data["volume"] = float(line.split("=")[-1].split()[0])
+                if "unit-cell volume" in low:
+                        data["volume"] = float(low.split("=")[-1].split()[0])
+
+                line = next(lines, None)
         
         return data
 
-# Parse an scf.out file for various things
+# Parse only the end of a vc-relax output, seeking backwards
+# from the end of the file, doubling the amount read until every
+# quantity in VC_RELAX_KEYS has been found (or we reach the start)
+def parse_vc_relax_tail(filename, chunk_size=65536):
+
+        with open(filename, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                read = min(chunk_size, size)
+
+                while True:
+                        f.seek(size - read)
+                        lines = f.read(read).decode("utf-8", "replace").split("\n")
+
+                        # The first line may have been cut in half
+                        if read < size: lines = lines[1:]
+
+                        data = parse_vc_relax_lines(lines)
+                        if read == size: break
+                        if all(k in data for k in VC_RELAX_KEYS): break
+                        read = min(2*read, size)
+
+        return data
+
+# Parse every step of a vc-relax trajectory into a single preallocated
+# structured array with one record per scf calculation, holding the
+# geometry the scf was carried out at, i.e the fields
+#       lattice   (3x3, bohr)
+#       positions (nat x 3, fractional)
+#       energy, enthalpy (Ry), pressure (KBar), volume (bohr^3)
+# Quantities that were not printed for a step are left as nan. The file
+# is streamed twice (once to count the steps, once to fill the array) so
+# memory use is independent of the number of steps.
+# Returns [atom names, trajectory]
+def parse_vc_relax_trajectory(filename):
+
+        # First pass: count steps and atoms
+        nstep = 0
+        nat   = 0
+        with open(filename) as f:
+                for line in f:
+                        if line.startswith("!") and "total energy" in line:
+                                nstep += 1
+                        elif "number of atoms/cell" in line:
+                                nat = int(line.split("=")[-1])
+
+        traj = np.empty(nstep, dtype=[
+                ("lattice",   float, (3, 3)),
+                ("positions", float, (nat, 3)),
+                ("energy",    float),
+                ("enthalpy",  float),
+                ("pressure",  float),
+                ("volume",    float)])
+        traj.fill(np.nan)
+
+        names     = [None]*nat
+        alat      = 1.0
+        lattice   = np.identity(3)
+        positions = np.zeros((nat, 3))
+        volume    = np.nan
+        istep     = 0
+
+        # Second pass: fill the trajectory, recording
+        # the current geometry at each scf energy
+        with open(filename) as f:
+                for line in f:
+
+                        # Parse the initial geometry from the header
+                        if "lattice parameter (alat)" in line:
+                                alat = float(line.split("=")[-1].split()[0])
+
+                        elif "crystal axes: (cart. coord. in units of alat)" in line:
+                                for i in range(3):
+                                        words = next(f).split("(")[-1].split(")")[0].split()
+                                        lattice[i] = [alat*float(w) for w in words]
+
+                        elif "positions (alat units)" in line:
+                                for i in range(nat):
+                                        l = next(f)
+                                        names[i] = l.split()[1]
+                                        words = l.split("(")[-1].split(")")[0].split()
+                                        positions[i] = [alat*float(w) for w in words]
+                                positions = np.dot(positions, la.inv(lattice))
+
+                        elif "unit-cell volume" in line:
+                                volume = float(line.split("=")[-1].split()[0])
+
+                        # Parse a new geometry from the optimizer
+                        elif "CELL_PARAMETERS" in line:
+                                units = line.lower()
+                                if "alat" in units:
+                                        if "=" in units:
+                                                factor = float(units.split("=")[-1].split(")")[0])
+                                        else:
+                                                factor = alat
+                                elif "angstrom" in units: factor = ANGSTROM_TO_BOHR
+                                else: factor = 1.0
+                                for i in range(3):
+                                        lattice[i] = [factor*float(w) for w in next(f).split()]
+
+                        elif "ATOMIC_POSITIONS" in line:
+                                units = line.lower()
+                                for i in range(nat):
+                                        words = next(f).split()
+                                        names[i] = words[0]
+                                        positions[i] = [float(w) for w in words[1:4]]
+                                if   "alat"     in units: positions *= alat
+                                elif "angstrom" in units: positions *= ANGSTROM_TO_BOHR
+                                if not "crystal" in units:
+                                        positions = np.dot(positions, la.inv(lattice))
+
+                        # A new scf energy => a new step, at the current geometry
+                        elif line.startswith("!") and "total energy" in line:
+                                step = traj[istep]
+                                step["lattice"]   = lattice
+                                step["positions"] = positions
+                                step["volume"]    = volume
+                                step["energy"]    = float(line.split("=")[-1].split()[0])
+                                istep += 1
+
+                        # Quantities printed after the scf for the current step
+                        elif "P=" in line and istep > 0:
+                                traj[istep-1]["pressure"] = float(line.split("=")[-1])
+
+                        elif ("enthalpy new" in line or "Final enthalpy" in line) and istep > 0:
+                                traj[istep-1]["enthalpy"] = float(line.split("=")[-1].split()[0])
+
+        return [names, traj]
+
+# Matches a line of the clock report that q.e programs
+# write at the end of their output, e.g
+#   "     davcio       :     45.10s CPU    300.20s WALL (  123456 calls)"
+CLOCK_LINE = re.compile(
+        r"^\s*(\S+)\s*:\s*([0-9dhms. ]+?)\s*CPU(?:\s+([0-9dhms. ]+?)\s*WALL)?"
+        r"(?:\s*\(\s*(\d+)\s*calls\))?\s*$")
+
+# Convert a q.e clock time (e.g 1h23m or 12m34.50s) to seconds
+def parse_clock_time(t):
+        seconds = 0.0
+        number  = ""
+        for c in t.replace(" ",""):
+                if c in "dhms":
+                        seconds += float(number)*{"d":86400,"h":3600,"m":60,"s":1}[c]
+                        number   = ""
+                else:
+                        number += c
+        return seconds
+
+# Parse the per-routine clock report at the end of a pw.x, ph.x, q2r.x,
+# matdyn.x etc output. Returns a dictionary with
+#       "routines"  : {routine name : {"cpu" : s, "wall" : s, "calls" : n}}
+#       "program"   : the program name (e.g PWSCF, PHONON)
+#       "cpu"       : total cpu time of the program (s)
+#       "wall"      : total wall time of the program (s)
+#       "mpi_processes", "threads", "pools" : the parallelization used
+# (the totals are None if the program did not finish)
+def parse_clock_report(filename):
+
+        data = {
+                "routines"      : {},
+                "program"       : None,
+                "cpu"           : None,
+                "wall"          : None,
+                "mpi_processes" : 1,
+                "threads"       : 1,
+                "pools"         : 1,
+                }
+
+        with open(filename) as f:
+                for line in f:
+
+                        # Parallelization info from the header
+                        if "Program" in line and " v." in line:
+                                data["program"] = line.split("Program")[-1].split()[0]
+                                continue
+                        if "running on" in line and "processor" in line:
+                                data["mpi_processes"] = int(line.split("running on")[-1].split()[0])
+                                continue
+                        if "Number of MPI processes:" in line:
+                                data["mpi_processes"] = int(line.split(":")[-1])
+                                continue
+                        if "Threads/MPI process:" in line:
+                                data["threads"] = int(line.split(":")[-1])
+                                continue
+                        if "npool" in line and "=" in line and "division" in line:
+                                data["pools"] = int(line.split("=")[-1])
+                                continue
+
+                        if not "CPU" in line: continue
+                        m = CLOCK_LINE.match(line)
+                        if m is None: continue
+
+                        name, cpu, wall, calls = m.groups()
+                        cpu  = parse_clock_time(cpu)
+                        wall = cpu if wall is None else parse_clock_time(wall)
+
+                        # The line for the program as a whole has no call count
+                        if calls is None and name == data["program"]:
+                                data["cpu"]  = cpu
+                                data["wall"] = wall
+                                continue
+
+                        data["routines"][name] = {
+                                "cpu"   : cpu,
+                                "wall"  : wall,
+                                "calls" : 1 if calls is None else int(calls),
+                                }
+
+        return data
+
+# Parse an scf.out file for various things, in a single streaming pass
+#       "fermi_energy" : the fermi energy (eV)
+#       "eigenvalues"  : nk x nbnd eigenvalues (eV)
+#       "kpoints"      : nk x 3 k-points (cartesian, units of 2pi/alat)
+#       "weights"      : nk k-point weights
+# The eigenvalues are those of the last scf calculation in the file (note
+# that pw.x only prints the eigenvalues and k-point weights for more than
+# 100 k-points if verbosity='high'; missing weights are left as nan)
+@cached_parser()
 def parse_scf_out(filename):
 
-        f = open(filename)
-        lines = f.read().split("\n")
-        f.close()
+        data  = {}
+        nks   = 0
+        nbnd  = 0
+        ik    = 0
+        evals = np.zeros((0, 0))
+        kpts  = np.zeros((0, 3))
+        wk    = np.zeros(0)
         
-        data = {}
+        with open(filename) as f:
+                for line in f:
+
+                        if "Fermi energy" in line:
+                                data["fermi_energy"] = float(line.split("is")[-1].split("e")[0])
+
+                        elif "number of Kohn-Sham states" in line:
+                                nbnd = int(line.split("=")[-1])
+
+                        # Preallocate the k-point arrays
+                        elif "number of k points" in line:
+                                nks   = int(line.split("=")[1].split()[0])
+                                evals = np.zeros((nks, nbnd))
+                                kpts  = np.zeros((nks, 3))
+                                wk    = np.full(nks, np.nan)
+
+                        # The (first, cartesian) list of k-points and weights
+                        elif line.lstrip().startswith("k(") and "wk =" in line:
+                                i = int(line.split("(")[1].split(")")[0]) - 1
+                                if i >= nks or not np.isnan(wk[i]): continue
+                                kpts[i] = [float(w) for w in line.split("(")[2].split(")")[0].split()]
+                                wk[i]   = float(line.split("=")[-1])
+
+                        # Start of a new set of eigenvalues
+                        elif "End of self-consistent calculation" in line or \
+                             "End of band structure calculation" in line:
+                                ik = 0
+
+                        # Eigenvalues at a k-point
+                        elif "bands (ev)" in line:
+
+                                # More k-points than expected (e.g spin-polarized)
+                                if ik >= len(evals):
+                                        evals = np.concatenate([evals, np.zeros(evals.shape)])
+                                        kpts  = np.concatenate([kpts,  np.zeros(kpts.shape)])
+                                        wk    = np.concatenate([wk,    np.full(len(wk), np.nan)])
+
+                                k = line.split("=")[1].split("(")[0].replace("-"," -").split()
+                                kpts[ik] = [float(w) for w in k]
+
+                                n = 0
+                                while n < nbnd:
+                                        words = next(f).replace("-"," -").split()
+                                        evals[ik, n:n+len(words)] = words
+                                        n += len(words)
+                                ik += 1
+
+        data["eigenvalues"] = evals[:ik]
+        data["kpoints"]     = kpts[:ik]
+        data["weights"]     = wk[:ik]
+        return data
+
+# Parse the sizes of a calculation from the header of a pw.x/ph.x output
+# file, stopping as soon as the header has been read (so this is cheap,
+# even for large outputs). Returns (with None for anything not found)
+#       "nks"  : the number of (irreducible) k-points
+#       "nbnd" : the number of Kohn-Sham states
+#       "fft"  : the dense FFT grid dimensions [nr1, nr2, nr3]
+#       "nq"   : the number of irreducible q-points (ph.x)
+def parse_run_dimensions(filename):
+
+        data = {"nks" : None, "nbnd" : None, "fft" : None, "nq" : None}
+
+        with open(filename) as f:
+                for line in f:
+
+                        if "number of k points" in line:
+                                data["nks"] = int(line.split("=")[1].split()[0])
+
+                        elif "number of Kohn-Sham states" in line:
+                                data["nbnd"] = int(line.split("=")[-1])
+
+                        # The first (dense) grid
+                        elif "FFT dimensions" in line and data["fft"] is None:
+                                fft = line.split("FFT dimensions:")[1].split("(")[1].split(")")[0]
+                                data["fft"] = [int(w) for w in fft.split(",")]
+
+                        elif "q-points):" in line:
+                                data["nq"] = int(line.split("q-points")[0].split("(")[-1])
+
+                        # End of the header
+                        elif "Self-consistent Calculation" in line or \
+                             "Band Structure Calculation" in line or \
+                             "Calculation of q" in line:
+                                break
+
+        return data
+
+# Parse the data-file-schema.xml written by pw.x into outdir/prefix.save
+# The file is streamed (elements are discarded as soon as they have been
+# read) so that large files are never held in memory. Returns
+#       "lattice"      : lattice vectors (bohr)
+#       "atoms"        : [[name, x, y, z], ...] in fractional coordinates
+#       "total_energy" : total energy (eV)
+#       "fermi_energy" : fermi energy (eV, None if not present)
+#       "kpoints"      : nk x 3 k-points (cartesian, units of 2pi/alat)
+#       "weights"      : nk k-point weights
+#       "eigenvalues"  : nk x nbnd eigenvalues (eV)
+# all taken from the output section of the file (energies are
+# converted to eV, as in parse_scf_out).
+def parse_xml_data_file(filename="pwscf.save/data-file-schema.xml"):
+
+        data = {
+                "lattice"      : np.zeros((3,3)),
+                "atoms"        : [],
+                "total_energy" : None,
+                "fermi_energy" : None,
+                }
+
+        ks      = ["output", "band_structure", "ks_energies"]
+        nks     = None
+        ik      = 0
+        kpoints = None
+        weights = None
+        evals   = None
+        path    = []
+        elems   = []
+
+        for event, elem in ET.iterparse(filename, events=("start", "end")):
+
+                tag = elem.tag.split("}")[-1]
+
+                if event == "start":
+                        path.append(tag)
+                        elems.append(elem)
+                        continue
+
+                path.pop()
+                elems.pop()
+
+                # Path relative to the root element
+                p = path[1:]
+                if len(p) > 0 and p[0] == "output":
+
+                        # Geometry
+                        if p[1:] == ["atomic_structure", "atomic_positions"] and tag == "atom":
+                                data["atoms"].append([elem.get("name")] + 
+                                        [float(w) for w in elem.text.split()])
+
+                        elif p[1:] == ["atomic_structure", "cell"]:
+                                data["lattice"][int(tag[1])-1] = [float(w) for w in elem.text.split()]
+
+                        # Energies (converted from Ha to eV)
+                        elif p[1:] == ["total_energy"] and tag == "etot":
+                                data["total_energy"] = 2*RY_TO_EV*float(elem.text)
+
+                        elif p[1:] == ["band_structure"] and tag == "fermi_energy":
+                                data["fermi_energy"] = 2*RY_TO_EV*float(elem.text)
+
+                        elif p[1:] == ["band_structure"] and tag == "nks":
+                                nks = int(elem.text)
+
+                        # K-points and eigenvalues, preallocated once
+                        # we know how many of them there are
+                        elif p == ks and tag == "k_point":
+                                if kpoints is None:
+                                        kpoints = np.zeros((nks, 3))
+                                        weights = np.zeros(nks)
+                                kpoints[ik] = [float(w) for w in elem.text.split()]
+                                weights[ik] = float(elem.get("weight"))
+
+                        elif p == ks and tag == "eigenvalues":
+                                e = np.array(elem.text.split(), dtype=float)
+                                if evals is None: evals = np.zeros((nks, len(e)))
+                                evals[ik] = 2*RY_TO_EV*e
+
+                        elif p == ks[:-1] and tag == "ks_energies":
+                                ik += 1
+
+                # Discard the element now that it has been read
+                elem.clear()
+                if len(elems) > 0: elems[-1].remove(elem)
+
+        # Convert positions to fractional coordinates
+        linv = la.inv(data["lattice"])
+        for a in data["atoms"]:
+                a[1:] = [float(x) for x in np.dot(a[1:], linv)]
+
+        data["kpoints"]     = kpoints
+        data["weights"]     = weights
+        data["eigenvalues"] = evals
+        return data
+
+# Parse the patterns.N.xml file written by ph.x (in _ph0/prefix.phsave)
+# for the N^th q-point, returning a list of the dimension (number of
+# perturbations) of each irreducible representation at that q-point
+def parse_irrep_patterns(filename):
+
+        with open(filename) as f:
+                text = f.read()
+
+        # Values either follow the tag, or are on the next line (older q.e)
+        value = lambda tag, t : int(re.search(r"<"+tag+r"[^>]*>\s*(\d+)", t).group(1))
+
+        dims = []
+        for i in range(1, value("NUMBER_IRR_REP", text)+1):
+                rep = text[text.index("<REPRESENTION.{0}>".format(i)):]
+                dims.append(value("NUMBER_OF_PERTURBATIONS", rep))
+        return dims
+
+# Parse the dynamical matrix files written by ph.x (fildyn1, fildyn2 ...
+# in the given directory) into a single container with one entry per
+# q-point in the star of each irreducible q-point:
+#       "q"         : nq x 3 q-points (cartesian, units of 2pi/alat)
+#       "dyn"       : nq x 3nat x 3nat complex dynamical matrices
+#       "iq"        : nq index of the fildyn file each q-point came from
+#       "species"   : species names
+#       "masses"    : species masses (as written by ph.x)
+#       "ityp"      : species index (from 0) of each atom
+#       "positions" : nat x 3 atomic positions (cartesian, units of alat)
+#       "celldm"    : the celldm(1:6) of the calculation
+#       "lattice"   : lattice vectors in units of alat (None if ibrav != 0)
+def parse_dyn_files(direc=".", fildyn="matdyn"):
+
+        files = []
+        for f in os.listdir(direc):
+                n = f[len(fildyn):]
+                if f.startswith(fildyn) and n.isdigit() and int(n) > 0:
+                        files.append([int(n), direc+"/"+f])
+        files.sort()
+        if len(files) == 0:
+                raise Exception("No dynamical matrix files {0}/{1}1... found".format(direc, fildyn))
+
+        data = {"q" : [], "dyn" : [], "iq" : []}
+        for iq, filename in files:
+                header, qs, dyns = parse_dyn_file(filename)
+                data.update(header)
+                data["q"].append(qs)
+                data["dyn"].append(dyns)
+                data["iq"].append(np.full(len(qs), iq, dtype=int))
+
+        for key in ["q", "dyn", "iq"]:
+                data[key] = np.concatenate(data[key])
+
+        return data
+
+# Parse a single dynamical matrix file, returning the header
+# information, the q-points in the star and their dynamical matrices
+def parse_dyn_file(filename):
+
+        with open(filename) as f:
+
+                # Read a line, failing if the file ends early
+                # (e.g it is still being written)
+                def readline():
+                        line = f.readline()
+                        if line == "":
+                                raise Exception("Dynamical matrix file {0} is truncated".format(filename))
+                        return line
+
+                readline()
+                words  = readline().split()
+                ntyp   = int(words[0])
+                nat    = int(words[1])
+                ibrav  = int(words[2])
+                header = {"celldm" : np.array([float(w) for w in words[3:9]]), "lattice" : None}
+
+                if ibrav == 0:
+                        readline()
+                        header["lattice"] = np.array([[float(w) for w in readline().split()] 
+                                for i in range(3)])
+
+                header["species"] = []
+                header["masses"]  = np.zeros(ntyp)
+                for i in range(ntyp):
+                        line = readline()
+                        header["species"].append(line.split("'")[1].strip())
+                        header["masses"][i] = float(line.split("'")[-1])
+
+                header["ityp"]      = np.zeros(nat, dtype=int)
+                header["positions"] = np.zeros((nat, 3))
+                for i in range(nat):
+                        words = readline().split()
+                        header["ityp"][i]      = int(words[1]) - 1
+                        header["positions"][i] = [float(w) for w in words[2:5]]
+
+                qs   = []
+                dyns = []
+                line = f.readline()
+                while line != "" and not "Diagonalizing" in line:
+
+                        if not "q = (" in line:
+                                line = f.readline()
+                                continue
+
+                        # Read the 3x3 blocks of the dynamical matrix 
+                        # for each pair of atoms at this q-point
+                        qs.append([float(w) for w in line.split("(")[1].split(")")[0].replace("-"," -").split()])
+                        dyn = np.zeros((3*nat, 3*nat), dtype=complex)
+                        for i in range(nat*nat):
+                                line = readline()
+                                while len(line.split()) != 2: line = readline()
+                                na, nb = [int(w)-1 for w in line.split()]
+                                for j in range(3):
+                                        v = [float(w) for w in readline().replace("-"," -").split()]
+                                        dyn[3*na+j, 3*nb:3*nb+3] = np.array(v[0::2]) + 1j*np.array(v[1::2])
+                        dyns.append(dyn)
+                        line = f.readline()
+
+        return [header, np.array(qs), np.array(dyns)]
+
+# Parse a number written by q.e, which may have overflowed its field
+def parse_qe_float(word):
+        try: return float(word)
+        except ValueError: return np.nan
+
+# Parse the per-q electron-phonon output written by ph.x into
+# elph_dir/elph_inp_lambda.1, .2 ... into a single container:
+#       "q"            : nq x 3 q-points (cartesian, units of 2pi/alat)
+#       "w2"           : nq x nmodes squared phonon frequencies (Ry^2)
+#       "degauss"      : nsig smearing widths (Ry)
+#       "dos"          : nq x nsig DOS at the fermi energy (states/spin/Ry/cell)
+#       "fermi_energy" : nq x nsig fermi energies (eV)
+#       "double_delta" : nq x nsig double delta at the fermi energy
+#       "lambda"       : nq x nsig x nmodes mode-resolved coupling constants
+#       "gamma"        : nq x nsig x nmodes phonon linewidths (GHz)
+# (values that overflowed their field in the output are nan)
+def parse_elph_dir(direc="elph_dir"):
+
+        files = []
+        for f in os.listdir(direc):
+                if not f.startswith("elph_inp_lambda."): continue
+                files.append([int(f.split(".")[-1]), direc+"/"+f])
+        files.sort()
+        if len(files) == 0:
+                raise Exception("No elph_inp_lambda.* files found in "+direc)
+
+        data = None
+        for iq, (n, filename) in enumerate(files):
+                with open(filename) as f:
+
+                        words  = f.readline().split()
+                        nsig   = int(words[3])
+                        nmodes = int(words[4])
+
+                        if data is None:
+                                nq   = len(files)
+                                data = {
+                                        "q"            : np.zeros((nq, 3)),
+                                        "w2"           : np.zeros((nq, nmodes)),
+                                        "degauss"      : np.zeros(nsig),
+                                        "dos"          : np.zeros((nq, nsig)),
+                                        "fermi_energy" : np.zeros((nq, nsig)),
+                                        "double_delta" : np.zeros((nq, nsig)),
+                                        "lambda"       : np.zeros((nq, nsig, nmodes)),
+                                        "gamma"        : np.zeros((nq, nsig, nmodes)),
+                                        }
+
+                        data["q"][iq] = [float(w) for w in words[0:3]]
+
+                        w2 = []
+                        while len(w2) < nmodes:
+                                w2.extend(parse_qe_float(w) for w in f.readline().split())
+                        data["w2"][iq] = w2
+
+                        isig = -1
+                        imode = 0
+                        for line in f:
+                                if "Broadening" in line:
+                                        isig += 1
+                                        imode = 0
+                                        data["degauss"][isig] = float(line.split(":")[1].split()[0])
+                                elif "DOS =" in line:
+                                        data["dos"][iq, isig]          = parse_qe_float(line.split("=")[1].split()[0])
+                                        data["fermi_energy"][iq, isig] = parse_qe_float(line.split("=")[-1].split()[0])
+                                elif "double delta" in line:
+                                        data["double_delta"][iq, isig] = parse_qe_float(line.split("=")[-1])
+                                elif "lambda(" in line:
+                                        data["lambda"][iq, isig, imode] = parse_qe_float(line.split(")=")[1].split()[0])
+                                        data["gamma"][iq, isig, imode]  = parse_qe_float(line.split("=")[-1].split()[0])
+                                        imode += 1
 
-        for i, line in enumerate(lines):
-                
-                if "Fermi energy" in line:
-                        data["fermi_energy"] = float(line.split("is")[-1].split("e")[0])
         return data
 
 # Set the geometry in the given input file from the given lattice
 # and atoms in the format [[name, x, y, z], [name, x, y, z] ... ]
-# also sets the cutoff, kpoint sampling and pressure (if present)
-def modify_input(in_file,
+# also sets the cutoff, kpoint sampling and pressure (if present).
+# Keys are matched exactly (so that e.g press does not match
+# press_conv_thr) and the file is replaced atomically.
+def modify_input(in_file, **changes):
+        inp = QEInput.read(in_file)
+        apply_input_changes(inp, in_file, **changes)
+        inp.write(in_file)
+
+# Apply the same modifications (see modify_input) to each of the given
+# input files, each of which is parsed once and written atomically
+def modify_inputs(in_files, **changes):
+        for f in in_files:
+                modify_input(f, **changes)
+
+# Apply the modify_input changes to the parsed input inp (read from in_file)
+def apply_input_changes(inp, in_file,
         lattice     = None,
         atoms       = None,
         kpoints     = None,
@@ -90,261 +721,296 @@ def modify_input(in_file,
         den_cutoff  = None,
         recover     = None):
 
-        input = open(in_file)
-        lines = input.read().split("\n")
-        input.close()
+        # Replace cell parameters
+        card = inp.card("CELL_PARAMETERS")
+        if not lattice is None and not card is None:
+                card.lines = [" ".join([str(x) for x in l]) for l in lattice[:3]]
 
-        overwrite = open(in_file, "w")
-        i_ignored = []
+        # Replace atomic positions, and the number of atoms/species
+        card = inp.card("ATOMIC_POSITIONS")
+        if not atoms is None and not card is None:
+                card.lines = [" ".join([str(ai) for ai in a]) for a in atoms]
+        if not atoms is None:
+                unique_names = []
+                for a in atoms:
+                        if not a[0] in unique_names: unique_names.append(a[0])
+                inp.replace("nat",  len(atoms))
+                inp.replace("ntyp", len(unique_names))
 
-        for i, line in enumerate(lines):
-                if i in i_ignored: continue
+        # Replace the kpoint grid (adding it if it isn't present)
+        if not kpoints is None:
+                if len(kpoints) == 3:
+                        inp.set_card("K_POINTS", "automatic",
+                                [" ".join([str(k) for k in kpoints])+" 0 0 0"])
+                else:
+                        kpoints = np.asarray(kpoints, dtype=float)
+                        weights = np.full((len(kpoints), 1), 1/float(len(kpoints)))
+                        inp.set_card("K_POINTS", "crystal", [str(len(kpoints)),
+                                format_rows("%.10f %.10f %.10f %.10f", np.hstack([kpoints, weights]))])
 
-                # Replace cell parameters
-                if not lattice is None:
-                        if "cell_parameters" in line.lower():
-                                overwrite.write(line+"\n")
-                                for j in range(i+1, i+4):
-                                        i_ignored.append(j)
-                                        overwrite.write(" ".join([str(x) for x in lattice[j-i-1]])+"\n")
-                                continue
+        # Replace the calculation type
+        if not calculation is None:
+                inp.replace("calculation", calculation.strip("'\""))
 
-                # Replace atomic positions
-                if not atoms is None:
-                        if "atomic_positions" in line.lower():
-                                for j in range(i+1, len(lines)):
-                                        try:
-                                                name,x,y,z = lines[j].split()
-                                                i_ignored.append(j)
-                                        except:
-                                                break
-                                overwrite.write(line+"\n")
-                                for a in atoms:
-                                        overwrite.write(" ".join([str(ai) for ai in a])+"\n")
-                                continue
+        # Replace qpoints in el-ph coupling
+        if not qpoints is None:
+                for i in range(3):
+                        inp.replace("nq{0}".format(i+1), qpoints[i])
 
-                # Replace the kpoint grid
-                if kpoints != None:
-                        if "k_points" in line.lower():
-                                i_ignored.append(i+1)
-                                if len(kpoints) == 3:
-                                        overwrite.write("K_POINTS automatic\n")
-                                        overwrite.write(" ".join([str(k) for k in kpoints])+" 0 0 0\n")
-                                else:
-                                        overwrite.write("K_POINTS (crystal)\n")
-                                        overwrite.write(str(len(kpoints))+"\n")
-                                        weight = 1/float(len(kpoints))
-                                        for k in kpoints:
-                                                kline = " ".join(str(ki) for ki in k)
-                                                kline += " " + str(weight)
-                                                overwrite.write(kline+"\n")
-                                kpoints = None
-                                continue
+        # Replace the cutoffs, smearing and pressure
+        if not cutoff     is None: inp.replace("ecutwfc", cutoff)
+        if not den_cutoff is None: inp.replace("ecutrho", den_cutoff)
+        if not smearing   is None: inp.replace("degauss", smearing)
+        if not pressure   is None: inp.replace("press",   pressure)
 
-                # Replace number of atoms
-                if atoms != None:
-                        if "nat=" in line.replace(" ","").lower():
-                                line = "nat="+str(len(atoms))+","
-                        if "ntyp" in line.lower():
-                                unique_names = []
-                                for a in atoms:
-                                        if a[0] in unique_names:
-                                                continue
-                                        unique_names.append(a[0])
-                                line = "ntyp="+str(len(unique_names))+","
-
-                # Replace the calculation type
-                if calculation != None:
-                        if "calculation" in line.lower():
-                                line = "calculation="+calculation+","
-
-                # Replace qpoints in el-ph coupling
-                if qpoints != None:
-                        if "nq1" in line.lower():
-                                line = "nq1={0},".format(qpoints[0])
-                        if "nq2" in line.lower():
-                                line = "nq2={0},".format(qpoints[1])
-                        if "nq3" in line.lower():
-                                line = "nq3={0},".format(qpoints[2])
-
-                # Replace the cutoff
-                if cutoff != None:
-                        if "ecutwfc" in line.lower(): 
-                                line = "ecutwfc="+str(cutoff)+","
-
-                # Replace the density cutoff
-                if den_cutoff != None:
-                        if "ecutrho" in line.lower():
-                                line = "ecutrho="+str(den_cutoff)+","
-
-                # Replace the electronic smearing amount (degauss)
-                if smearing != None:
-                        if "degauss" in line.lower():
-                                line = "degauss="+str(smearing)+","
-
-                # Replace the pressure in a relax file
-                if pressure != None:
-                        if "press" in line.lower():
-                                line = "press="+str(pressure)+","
-
-                # Replace the recovery option for a phonon calculation
-                if recover != None:
-                        if "recover" in line.lower():
-                                if recover:
-                                        line = "recover=.true.,"
-                                else:
-                                        line = "recover=.false.,"
-                                # record our success
-                                recover = None
-                        
-                overwrite.write(line+"\n")
-
-        # Add kpoints to bottom of file
-        # if they were not set somewhere else
-        if kpoints != None:
-                if len(kpoints) == 3:
-                        overwrite.write("K_POINTS automatic\n")
-                        overwrite.write(" ".join([str(k) for k in kpoints])+" 0 0 0\n")
-                else:
-                        overwrite.write("K_POINTS (crystal)\n")
-                        overwrite.write(str(len(kpoints))+"\n")
-                        weight = 1/float(len(kpoints))
-                        for k in kpoints:
-                                kline = " ".join(str(ki) for ki in k)
-                                kline += " " + str(weight)
-                                overwrite.write(kline+"\n")
-
-        overwrite.close()
-        
-        # Check for errors
-        if recover != None:
-                ex  = "Did not properly set the recover option! "
-                ex += "Does the line recover=... exist in "+in_file
-                raise Exception(ex)
+        # Replace the recovery option for a phonon calculation
+        if not recover is None:
+                if not inp.replace("recover", bool(recover)):
+                        ex  = "Did not properly set the recover option! "
+                        ex += "Does the line recover=... exist in "+in_file
+                        raise Exception(ex)
+
+# Matches the sign of an exponent that q.e has written without
+# the E (this happens for large exponents, e.g 0.1234-105)
+MISSING_EXPONENT = re.compile(r"[+-](?<=[0-9.][+-])(?=[0-9])")
 
 # Parse the eliashberg function from a given output file
+@cached_parser()
 def parse_a2f(a2f_file):
-        
-        data = []
-        with open(a2f_file) as lines:
-            for line in lines:
 
-                # Deal with the line that has lambda in it
-                if "lambda" in line:
-                        lam = line.split("lambda")[-1]
-                        lam = float(lam.split("=")[1].split()[0])
-                        continue
+        with open(a2f_file) as f:
+                text = f.read()
 
-                # Check the line is numerical
-                if "." not in line: continue
-
-                try:
-                        # Sometimes q.e forgets to write the E for
-                        # large exponents
-                        words = line.split()
-                        for i in range(0, len(words)):
-                            if "E" in words[i]: continue
-                            if "-" in words[i][1:]:
-                                words[i] = "E".join(words[i].split("-"))
-                            if "+" in words[i][1:]:
-                                words[i] = "E".join(words[i].split("+"))
-                        dat = [float(w) for w in words]
-                        data.append(dat)
-                except:
-                        print("could not parse a2F line: "+line)
-                        continue
+        # Remove the line(s) that have lambda in them
+        i = text.find("lambda")
+        while i >= 0:
+                start = text.rfind("\n", 0, i) + 1
+                end   = text.find("\n", i)
+                if end < 0: end = len(text)
+                text  = text[:start] + text[end:]
+                i     = text.find("lambda", start)
+
+        # Repair missing exponents in the whole block at once
+        # and load it with a single numpy call
+        text = MISSING_EXPONENT.sub(r"E\g<0>", text)
+        try:
+                data = np.loadtxt(text.splitlines(), comments="#", ndmin=2)
+        except ValueError:
+                # Fall back to parsing line by line, skipping bad lines
+                data = []
+                for line in text.split("\n"):
+                        if line.lstrip().startswith("#"): continue
+                        if "." not in line: continue
+                        try:
+                                data.append([float(w) for w in line.split()])
+                        except ValueError:
+                                continue
+                ncol = max(len(d) for d in data)
+                data = np.array([d for d in data if len(d) == ncol])
 
-        data      = np.array(data).T
+        data      = data.T
         omega     = data[0]
         a2f_full  = data[1]
         a2f_proj  = data[2:]
-        a2f_noneg = np.zeros(len(a2f_full))
-        
-        for p in a2f_proj:
-                neg_mode = False
-                for i in range(0, len(p)):
-                        if omega[i] > 0: continue
-                        if abs(p[i]) < 10e-4: continue
-                        neg_mode = True
-                        break
-                if neg_mode: continue
-                a2f_noneg += p
+
+        # Only include modes which have no weight at negative frequencies
+        neg_mode  = np.any((omega <= 0) & (abs(a2f_proj) >= 10e-4), axis=1)
+        a2f_noneg = np.sum(a2f_proj[~neg_mode], axis=0)
         
         return [omega, a2f_full, a2f_noneg, a2f_proj]
 
-# Parse a .bands file
-def parse_bands(bands_file):
-        data = open(bands_file).read()
-
-        # Parse first line for band_count, q_count then remove it
-        lines      = data.split("\n")
-        band_count = int(lines[0].split("=")[1].split(",")[0])
-        q_count    = int(lines[0].split("=")[2].split("/")[0])
-        data       = "\n".join(lines[1:])
-        data = data.replace("-"," -")
-
-        # Parse data into a list of q-points (qs) and a list of
-        # frequencies for each (all_ws)
-        # such that all_ws[i] corresponds to frequencies at qs[i]
-        q  = []
-        qs = []
-        q_ws   = []
-        all_ws = []
-        cycle_count = 0
-
-        for w in data.split():
-
-                if cycle_count < 3:
-                        q.append(float(w))
-                        if len(q) == 3:
-                                qs.append(q)
-                                q = []
+# Parse a .bands file (as written by bands.x or matdyn.x) into a
+# (nq x 3) array of q-points (qs) and a (nq x nbands) array of
+# frequencies (all_ws), such that all_ws[i] corresponds to the
+# frequencies at qs[i]. If chunk_size is given, a generator is returned
+# instead, which yields [qs, all_ws] for chunk_size q-points at a time
+# (so that files larger than memory can be processed)
+@cached_parser(files=lambda bands_file, chunk_size=None :
+        None if chunk_size else [bands_file])
+def parse_bands(bands_file, chunk_size=None):
 
-                else:
-                        omega = float(w)
-                        q_ws.append(omega)
-                        if len(q_ws) == band_count:
-                                all_ws.append(q_ws)
-                                q_ws = []
-
-                cycle_count += 1
-                cycle_count = cycle_count % (3 + band_count)
-        
-        return [qs, all_ws]
+        if not chunk_size is None:
+                return iter_bands(bands_file, chunk_size)
 
-# Parse partial electronic PDOS from all pdos_atom#... files
-def parse_electron_pdos(direc):
+        for qs, all_ws in iter_bands(bands_file):
+                return [qs, all_ws]
+
+        return [np.zeros((0, 3)), np.zeros((0, 0))]
+
+# Generator yielding [qs, all_ws] for successive chunks of
+# chunk_size q-points from a .bands file (all of them at once
+# if chunk_size is None)
+def iter_bands(bands_file, chunk_size=None):
+
+        with open(bands_file) as f:
+
+                # Parse first line for band_count, q_count
+                header     = f.readline()
+                band_count = int(header.split("=")[1].split(",")[0])
+                q_count    = int(header.split("=")[2].split("/")[0])
+                if chunk_size is None: chunk_size = q_count
+
+                # Each q-point record is 3 coordinates followed by
+                # band_count frequencies; records are read straight
+                # into a flat buffer of chunk_size records
+                record    = 3 + band_count
+                remaining = q_count
+                buf       = np.empty(min(chunk_size, remaining)*record)
+                filled    = 0
+
+                for line in f:
+
+                        words = line.replace("-"," -").split()
+                        if len(words) == 0: continue
+                        buf[filled:filled+len(words)] = words
+                        filled += len(words)
+
+                        if filled == len(buf):
+                                data = buf.reshape(-1, record)
+                                yield [data[:,:3], data[:,3:]]
+
+                                # Start a new chunk (rather than overwriting
+                                # this one, which the caller may still hold)
+                                remaining -= len(data)
+                                if remaining <= 0: return
+                                buf    = np.empty(min(chunk_size, remaining)*record)
+                                filled = 0
+
+                # Incomplete final chunk (truncated file)
+                if filled > 0:
+                        data = buf[:filled - filled % record].reshape(-1, record)
+                        yield [data[:,:3], data[:,3:]]
+
+# The pdos files written by projwfc.x are named
+# prefix.pdos_atm#N(El)_wfc#M(orbital)
+PDOS_FILE = re.compile(r"pdos_atm#(\d+)\((\w+)\)_wfc#(\d+)\(([^)]+)\)$")
+
+# The pdos_atm files in a directory, ordered by atom and wavefunction
+# number (rather than the arbitrary order given by os.listdir)
+def pdos_files(direc):
         files = []
         for f in os.listdir(direc):
-                if "pdos_atm" not in f: continue
-                files.append(direc+"/"+f)
+                m = PDOS_FILE.search(f)
+                if m is None: continue
+                files.append([int(m.group(1)), int(m.group(3)), direc+"/"+f])
+        return [f[2] for f in sorted(files)]
+
+# Reads a single pdos file, returning the column names (excluding the
+# energy column, e.g ["ldos", "pdos", "pdos", "pdos"] or ["ldosup",
+# "ldosdw", "pdosup", "pdosdw"]) and the (nE x ncol+1) data
+def read_pdos_file(filename):
+        with open(filename) as f:
+                header = f.readline()
+                data   = np.loadtxt(f, ndmin=2)
+        columns = [c.split("(")[0] for c in header.replace("#","").split()]
+        columns = [c for c in columns if c.startswith("ldos") or c.startswith("pdos")]
+        return columns, data
+
+# Load all of the pdos_atm files written by projwfc.x in the given
+# directory, reading them concurrently using the given number of
+# threads (the files are usually small, but numerous, and often on
+# a network filesystem). Returns a dictionary containing
+#       "energies" : the (nE) energies shared by all of the files (eV)
+#       "pdos"     : (nfile x nE x ncol) array of the non-energy columns
+#                    of each file, padded with nan where a file has
+#                    fewer energies or columns than the others
+#       "columns"  : the column names of each file (see read_pdos_file)
+#       "files"    : the files, ordered by atom then wavefunction
+#       "atoms"    : the atom number of each file
+#       "elements" : the element of each file
+#       "wfcs"     : the wavefunction number of each file
+#       "orbitals" : the orbital label of each file (e.g "s", "p_j1.5")
+# Use group_pdos to sum the result by element, atom, orbital or spin.
+@cached_parser(files=lambda direc=".", threads=8 : [direc] + pdos_files(direc))
+def load_projwfc_pdos(direc=".", threads=8):
+        from multiprocessing.pool import ThreadPool
+
+        files = pdos_files(direc)
+        if len(files) == 0:
+                raise Exception("No pdos_atm files found in "+direc)
+
+        pool = ThreadPool(max(1, min(threads, len(files))))
+        try: results = pool.map(read_pdos_file, files)
+        finally: pool.close()
+
+        ne   = max(len(d) for c, d in results)
+        ncol = max(len(c) for c, d in results)
+        pdos = np.full((len(files), ne, ncol), np.nan)
+        for i, (c, d) in enumerate(results):
+                pdos[i, :len(d), :d.shape[1]-1] = d[:,1:]
+
+        # The energy grid is the same for every file
+        longest  = max(range(len(results)), key=lambda i : len(results[i][1]))
+        energies = results[longest][1][:,0]
+
+        data = {
+                "energies" : energies,
+                "pdos"     : pdos,
+                "columns"  : [c for c, d in results],
+                "files"    : files,
+                "atoms"    : np.array([int(PDOS_FILE.search(f).group(1)) for f in files]),
+                "elements" : [PDOS_FILE.search(f).group(2) for f in files],
+                "wfcs"     : np.array([int(PDOS_FILE.search(f).group(3)) for f in files]),
+                "orbitals" : [PDOS_FILE.search(f).group(4) for f in files],
+        }
+        return data
+
+# Sum the pdos loaded by load_projwfc_pdos into groups, where by is
+#       "element" : the ldos of each element
+#       "atom"    : the ldos of each atom
+#       "orbital" : the ldos of each orbital type (s, p, d...)
+#       "m"       : the pdos of each orbital/m component
+#       "spin"    : the total ldos of each spin channel
+# If spin is "up" or "down" only that channel of a spin-polarized
+# calculation is summed (otherwise both are). Returns a list of the
+# group labels and a (ngroups x nE) array of the summed dos.
+def group_pdos(pdos, by="element", spin=None):
+
+        if not by in ["element", "atom", "orbital", "m", "spin"]:
+                raise ValueError("Unknown pdos grouping: "+str(by))
 
-        pdos = []
-        energies = []
+        # Work out which group each column of each file contributes to
         labels = []
-        read_energies = False   
+        keys   = []
+        for i, columns in enumerate(pdos["columns"]):
+                count = {}
+                for j, c in enumerate(columns):
 
-        for f in files:
-                atm, wf = f.split("_")[-2:]
-                atm = "Atom "+atm.split("#")[-1]
-                wf = wf.split("#")[-1]
-                labels.append(atm + " " + wf)
-                
-                f = open(f)
-                lines = f.read().split("\n")[1:-1]
-                f.close()
-        
-                data = []
-                for l in lines:
-                        data.append(float(l.split()[2]))
-                        if not read_energies:
-                                energies.append(float(l.split()[0]))
-                pdos.append(data)
-                read_energies = True
-        
-        return energies, pdos, labels
+                        channel = "up" if c.endswith("up") else "down" if c.endswith("dw") else "total"
+                        if not spin is None and channel != spin: continue
+
+                        # Only the m-resolved grouping uses the pdos columns
+                        if c.startswith("ldos") == (by == "m"): continue
+
+                        if by == "element": label = pdos["elements"][i]
+                        elif by == "atom":  label = "Atom {0} ({1})".format(pdos["atoms"][i], pdos["elements"][i])
+                        elif by == "orbital": label = pdos["orbitals"][i]
+                        elif by == "spin": label = channel
+                        else:
+                                count[channel] = count.get(channel, 0) + 1
+                                label = "{0} m={1}".format(pdos["orbitals"][i], count[channel])
+                                if channel != "total": label += " "+channel
+
+                        if not label in labels: labels.append(label)
+                        keys.append([labels.index(label), i, j])
+
+        # Sum all of the groups at once
+        mask = np.zeros((len(labels),) + pdos["pdos"].shape[::2])
+        if len(keys) > 0:
+                keys = np.array(keys)
+                mask[keys[:,0], keys[:,1], keys[:,2]] = 1.0
+        dos = np.einsum("gfc,fec->ge", mask, np.nan_to_num(pdos["pdos"]))
+        return labels, dos
+
+# Parse partial electronic PDOS from all pdos_atom#... files
+def parse_electron_pdos(direc):
+        data = load_projwfc_pdos(direc)
+        labels = ["Atom {0}({1}) {2}({3})".format(*x) for x in
+                zip(data["atoms"], data["elements"], data["wfcs"], data["orbitals"])]
+        return data["energies"].tolist(), data["pdos"][:,:,1].tolist(), labels
 
 # Parse phonon density of states from phonon.dos file
+@cached_parser()
 def parse_phonon_dos(filename):
         f = open(filename)
         lines = f.read().split("\n")[1:-1]
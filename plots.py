@@ -62,10 +62,10 @@ def plot_bands(qs, all_ws, ylabel, hsp_file=None,
     # Remove repeated q-points
     to_remove.sort(key=lambda i:-i[1])
     for i, iq in to_remove:
-        del qs[iq]
-        del all_ws[iq]
+        qs     = np.delete(qs, iq, axis=0)
+        all_ws = np.delete(all_ws, iq, axis=0)
         if not lifetimes is None:
-            del lifetimes[iq]
+            lifetimes = np.delete(lifetimes, iq, axis=0)
 
         # Move labels to compenstate for change
         for j in range(i, len(xtick_vals)):
@@ -201,7 +201,7 @@ def plot_gibbs_vs_pressure_simple(system_dirs):
             dos          = np.sum(pdos, axis=0)
 
             # Read in thermodynamic quantities
-            relax    = parse_vc_relax(relax_file)
+            relax    = parse_vc_relax(relax_file, final_only=True)
             nat      = len(relax["atoms"])
             pressure = relax["pressure"]
             volume   = relax["volume"]/nat
@@ -348,7 +348,7 @@ def plot_gibbs_vs_pressure(system_dirs):
             dos          = np.sum(pdos, axis=0)
 
             # Read in thermodynamic quantities
-            relax    = parse_vc_relax(relax_file)
+            relax    = parse_vc_relax(relax_file, final_only=True)
             nat      = len(relax["atoms"])
             pressure = relax["pressure"]
             volume   = relax["volume"]/nat
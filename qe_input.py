@@ -0,0 +1,239 @@
+import numpy as np
+import os
+import re
+
+# In-memory model of a q.e input file, consisting of
+#   title     : any lines before the first namelist (e.g the ph.x title line)
+#   namelists : the &NAMELIST ... / blocks, in order
+#   cards     : the cards following the namelists (e.g ATOMIC_POSITIONS),
+#               in order. Lines following the namelists that do not belong
+#               to a named card (e.g the q-point list of a matdyn.x input)
+#               are stored as an anonymous card, with name None.
+# An existing input is parsed once with QEInput.read, can then be modified
+# any number of times, and is written back out with QEInput.write, which
+# replaces the file atomically (so that a running job never sees a
+# partially written input).
+
+# The cards that can follow the namelists of a pw.x input
+CARD_NAMES = ["ATOMIC_SPECIES", "ATOMIC_POSITIONS", "K_POINTS", "ADDITIONAL_K_POINTS",
+              "CELL_PARAMETERS", "OCCUPATIONS", "CONSTRAINTS", "ATOMIC_FORCES",
+              "SOLVENTS", "HUBBARD"]
+
+# A single key=value assignment within a namelist
+ASSIGNMENT = re.compile(r"([A-Za-z_][\w%]*(?:\([\d,\s]*\))?)\s*=\s*('[^']*'|\"[^\"]*\"|[^,\s/!]+)")
+
+# A quoted string within a namelist
+QUOTED = re.compile(r"'[^']*'|\"[^\"]*\"")
+
+# Convert a value from a namelist into the corresponding python type
+def parse_value(word):
+
+    if word[0] in "'\"": return word[1:-1]
+
+    low = word.lower()
+    if low in [".true.", ".t.", "t"]:  return True
+    if low in [".false.", ".f.", "f"]: return False
+
+    try: return int(word)
+    except ValueError: pass
+
+    try: return float(low.replace("d", "e"))
+    except ValueError: return word
+
+# Convert a python value into the format expected in a namelist
+def format_value(value):
+    if isinstance(value, bool): return ".true." if value else ".false."
+    if isinstance(value, str):  return "'{0}'".format(value)
+    return "{0}".format(value)
+
+# Format each row of a 2D array with the given (%-style) format,
+# returning a single block of lines that can be used as a card line.
+# This is done with one string operation, rather than a join per row,
+# so that long k-point lists are cheap to write.
+def format_rows(fmt, rows):
+    rows = np.asarray(rows)
+    if len(rows) == 0: return ""
+    return "\n".join([fmt]*len(rows)) % tuple(rows.ravel())
+
+# A namelist; an ordered set of key=value pairs where
+# keys are matched exactly, but case-insensitively
+class Namelist(object):
+
+    def __init__(self, name):
+        self.name  = name
+        self.items = []
+
+    def index(self, key):
+        key = key.lower()
+        for i, item in enumerate(self.items):
+            if item[0].lower() == key: return i
+        return -1
+
+    def __contains__(self, key):
+        return self.index(key) >= 0
+
+    def __getitem__(self, key):
+        i = self.index(key)
+        if i < 0: raise KeyError(key)
+        return self.items[i][1]
+
+    def __setitem__(self, key, value):
+        i = self.index(key)
+        if i < 0: self.items.append([key, value])
+        else: self.items[i][1] = value
+
+    def __delitem__(self, key):
+        i = self.index(key)
+        if i < 0: raise KeyError(key)
+        del self.items[i]
+
+    def get(self, key, default=None):
+        i = self.index(key)
+        return default if i < 0 else self.items[i][1]
+
+    def text(self):
+        t = "&{0}\n".format(self.name)
+        for key, value in self.items:
+            t += "{0}={1},\n".format(key, format_value(value))
+        return t + "/\n"
+
+# A card; a name, an option (e.g "crystal" for ATOMIC_POSITIONS)
+# and the lines of the card
+class Card(object):
+
+    def __init__(self, name, option=None, lines=None):
+        self.name   = name
+        self.option = option
+        self.lines  = [] if lines is None else lines
+
+    def text(self):
+        t = ""
+        if not self.name is None:
+            t += self.name
+            if self.option: t += " ({0})".format(self.option)
+            t += "\n"
+        for l in self.lines:
+            t += l + "\n"
+        return t
+
+class QEInput(object):
+
+    def __init__(self, title=None):
+        self.title     = [] if title is None else [title]
+        self.namelists = []
+        self.cards     = []
+
+    # Parse the given q.e input file
+    @staticmethod
+    def read(filename):
+        with open(filename) as f:
+            return QEInput.parse(f.read())
+
+    # Parse the given q.e input text
+    @staticmethod
+    def parse(text):
+
+        inp      = QEInput()
+        namelist = None
+        card     = None
+
+        for line in text.split("\n"):
+
+            stripped = line.strip()
+
+            # Start of a namelist
+            if namelist is None and stripped.startswith("&"):
+                words    = stripped[1:].split(None, 1)
+                namelist = inp.namelist(words[0])
+                stripped = words[1] if len(words) > 1 else ""
+
+            # Inside a namelist, which ends at a / outside of quotes
+            if not namelist is None:
+                data = stripped.split("!")[0]
+                for key, value in ASSIGNMENT.findall(data):
+                    namelist[key] = parse_value(value)
+                if "/" in QUOTED.sub("", data):
+                    namelist = None
+                continue
+
+            # Before the namelists
+            if len(inp.namelists) == 0:
+                if len(stripped) > 0: inp.title.append(line)
+                continue
+
+            # Start of a card
+            words = stripped.split()
+            if len(words) > 0 and words[0].upper() in CARD_NAMES:
+                option = " ".join(words[1:]).strip("(){} ")
+                card = Card(words[0].upper(), option if option else None)
+                inp.cards.append(card)
+                continue
+
+            if len(stripped) == 0 or stripped.startswith("!") or stripped.startswith("#"):
+                continue
+
+            # Lines that don't belong to a named card
+            if card is None:
+                card = Card(None)
+                inp.cards.append(card)
+            card.lines.append(line)
+
+        return inp
+
+    # Returns the namelist with the given name,
+    # creating it if it doesn't already exist
+    def namelist(self, name):
+        for n in self.namelists:
+            if n.name.lower() == name.lower(): return n
+        n = Namelist(name)
+        self.namelists.append(n)
+        return n
+
+    # Returns the namelist containing the given key (or None)
+    def find(self, key):
+        for n in self.namelists:
+            if key in n: return n
+        return None
+
+    # Set the value of a key in whichever namelist it appears
+    # in, returning False if it doesn't appear in any of them
+    def replace(self, key, value):
+        n = self.find(key)
+        if n is None: return False
+        n[key] = value
+        return True
+
+    # Returns the card with the given name (or None)
+    def card(self, name):
+        for c in self.cards:
+            if c.name == name: return c
+        return None
+
+    # Set the contents of a card, replacing the existing card
+    # with the same name, or adding a new one (before any
+    # anonymous card, which must come last)
+    def set_card(self, name, option, lines):
+        c = self.card(name)
+        if c is None:
+            c = Card(name)
+            i = len(self.cards)
+            if i > 0 and self.cards[-1].name is None: i -= 1
+            self.cards.insert(i, c)
+        c.option = option
+        c.lines  = list(lines)
+        return c
+
+    def text(self):
+        t = "".join(l + "\n" for l in self.title)
+        t += "".join(n.text() for n in self.namelists)
+        t += "".join(c.text() for c in self.cards)
+        return t
+
+    # Write the input to the given file, via a temporary file that
+    # is renamed over the destination, so the update is atomic
+    def write(self, filename):
+        tmp = os.path.join(os.path.dirname(os.path.abspath(filename)),
+            ".{0}.{1}.tmp".format(os.path.basename(filename), os.getpid()))
+        with open(tmp, "w") as f:
+            f.write(self.text())
+        os.rename(tmp, filename)
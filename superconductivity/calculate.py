@@ -1,7 +1,17 @@
 from quantum_espresso_tools.symmetry import get_kpoint_grid
-from quantum_espresso_tools.parser   import parse_vc_relax
+from quantum_espresso_tools.parser   import parse_vc_relax, parse_clock_report, parse_irrep_patterns
+from quantum_espresso_tools.qe_input import QEInput, format_rows
+from quantum_espresso_tools.superconductivity import store, parallel, launch, runner, trace
+from quantum_espresso_tools.superconductivity.workflow import Stage, Workflow
+from quantum_espresso_tools.superconductivity.workdir import WorkDir, work_dir
 import numpy as np
+from multiprocessing.pool import ThreadPool
 import numpy.linalg as la
+import threading
+import hashlib
+import shutil
+import json
+import time
 import os
 import subprocess
 
@@ -9,6 +19,187 @@ import subprocess
 ANGSTROM_TO_BOHR = 1.88973
 BOHR_TO_ANGSTROM = 0.529177
 
+# The type of each parameter that can appear in a parameter file
+PARAMETER_TYPES = {
+    "nodes"            : "int",
+    "cores_per_node"   : "int",
+    "mpirun"           : "str",
+    "ranks_per_node"   : "int",
+    "threads_per_rank" : "int",
+    "cpu_bind"         : "str",
+    "elph"             : "bool",
+    "relax_only"       : "bool",
+    "pressure"         : "float",
+    "press_conv_thr"   : "float",
+    "ecutwfc"          : "float",
+    "ecutrho"          : "float",
+    "qpoint_spacing"   : "float",
+    "qpoint_grid"      : "grid",
+    "kpts_per_qpt"     : "grid",
+    "aux_kpts"         : "grid",
+    "kpoint_grid"      : "grid",
+    "qpt_dense_mult"   : "int",
+    "ph_ndos"          : "int",
+    "band_kpts"        : "int",
+    "pseudo_dir"       : "str",
+    "forc_conv_thr"    : "float",
+    "degauss"          : "float",
+    "mixing_beta"      : "float",
+    "conv_thr"         : "float",
+    "symm_tol_cart"    : "float",
+    "symm_tol_angle"   : "float",
+    "require_prim_geom": "bool",
+    "elph_nsig"        : "int",
+    "elph_dsig"        : "float",
+    "disk_usage"       : "str",
+    "irrep_group_size" : "int",
+    "irrep_parallel_groups": "int",
+    "stage_timeout"    : "float",
+    "trace"            : "bool",
+    "parallel_flags"   : "str",
+    "memory_per_core_gb": "float",
+    "stage_store"      : "str",
+    "stage_store_outdir": "bool",
+    "stage_store_gb"   : "float",
+    "sweep"            : "sweep",
+    "lattice"          : "lattice",
+    "species"          : "species",
+    "atoms"            : "atoms",
+}
+
+# Parameters that may be None (i.e not specified)
+OPTIONAL_PARAMETERS = ["aux_kpts", "kpoint_grid"]
+
+# Entries that describe how (rather than what) to calculate, or that are
+# added to the parameters while running; these are not part of the
+# canonical form of the parameters
+RUNTIME_PARAMETERS = ["out_file", "nodes", "cores_per_node", "mpirun", "disk_usage",
+                      "ranks_per_node", "threads_per_rank", "cpu_bind", "cpu_list",
+                      "stage_store", "stage_store_outdir", "stage_store_gb", "stage_chain",
+                      "irrep_parallel_groups", "parallel_flags", "memory_per_core_gb", "sweep",
+                      "work_dir", "stage_timeout", "trace", "tracer"]
+
+# Normalize a float so that values that differ only by
+# rounding error have the same canonical form
+def canonical_float(x):
+    return float("{0:.12g}".format(float(x)))
+
+# Convert a parameter value to the given type
+def convert_parameter(kind, words):
+    if kind == "str":   return " ".join(words)
+    if kind == "int":
+        val = float(words[0])
+        if val != int(val): raise ValueError("Expected an integer, got "+words[0])
+        return int(val)
+    if kind == "float": return float(words[0])
+    if kind == "bool":
+        val = words[0].lower().strip(".")
+        if val in ["true", "t", "1"]:  return True
+        if val in ["false", "f", "0"]: return False
+        raise ValueError("Expected true or false, got "+words[0])
+    if kind == "grid":
+        if   len(words) >= 3: return [int(w) for w in words[:3]]
+        elif len(words) == 1: return [int(words[0])]*3
+    raise ValueError("Could not parse {0} from {1}".format(kind, " ".join(words)))
+
+# A set of calculation parameters. This is a dictionary (so that
+# it can be used, and modified, as before) with a schema that can be
+# validated, and that can be converted to a canonical form, where
+# floats are normalized and the lattice and atoms are arrays. The
+# digest of the canonical form identifies the calculation, so that
+# identical calculations in different directories can be recognised.
+class Parameters(dict):
+
+    # Check each parameter has the expected type/shape
+    def validate(self):
+
+        for key, kind in PARAMETER_TYPES.items():
+
+            if not key in self: continue
+            val = self[key]
+            if val is None:
+                if key in OPTIONAL_PARAMETERS: continue
+                raise ValueError("Parameter {0} must be specified".format(key))
+
+            if kind == "bool" and not isinstance(val, bool):
+                raise ValueError("Parameter {0} should be true or false".format(key))
+
+            elif kind in ["int", "float"] and not isinstance(val, (int, float, np.integer, np.floating)):
+                raise ValueError("Parameter {0} should be a number".format(key))
+
+            elif kind == "int" and val != int(val):
+                raise ValueError("Parameter {0} should be an integer".format(key))
+
+            elif kind == "grid" and (len(val) != 3 or min(val) < 1):
+                raise ValueError("Parameter {0} should be three positive integers".format(key))
+
+            elif kind == "lattice" and np.array(val, dtype=float).shape != (3, 3):
+                raise ValueError("The lattice should be a 3x3 matrix")
+
+            elif kind == "lattice" and abs(la.det(np.array(val, dtype=float))) < 1e-8:
+                raise ValueError("The lattice vectors are not linearly independent")
+
+        if "mpirun" in self: launch.launcher(self["mpirun"])
+        if "threads_per_rank" in self and self["threads_per_rank"] < 1:
+            raise ValueError("Parameter threads_per_rank should be at least 1")
+        if "cpu_bind" in self and not self["cpu_bind"] in launch.CPU_BINDINGS:
+            raise ValueError("Parameter cpu_bind should be one of "+", ".join(launch.CPU_BINDINGS))
+
+        names = [s[0] for s in self["species"]]
+        for a in self["atoms"]:
+            if len(a) != 4:
+                raise ValueError("Atoms should be specified as name x y z")
+            if not a[0] in names:
+                raise ValueError("Atom {0} has no corresponding species".format(a[0]))
+
+        return self
+
+    # The canonical form of the parameters describing the calculation
+    def canonical(self):
+
+        can = {}
+        for key, val in self.items():
+
+            if key in RUNTIME_PARAMETERS: continue
+            kind = PARAMETER_TYPES.get(key)
+
+            if val is None:
+                can[key] = None
+            elif kind == "lattice":
+                can[key] = np.vectorize(canonical_float)(np.array(val, dtype=float))
+            elif kind == "atoms":
+                can[key] = [[a[0] for a in val],
+                    np.vectorize(canonical_float)(np.array([a[1:] for a in val], dtype=float))]
+            elif kind == "species":
+                can[key] = [[s[0], canonical_float(s[1]), s[2]] for s in val]
+            elif kind == "grid":
+                can[key] = [int(g) for g in val]
+            elif isinstance(val, bool) or isinstance(val, str):
+                can[key] = val
+            elif isinstance(val, (int, np.integer)):
+                can[key] = int(val)
+            elif isinstance(val, (float, np.floating)):
+                can[key] = canonical_float(val)
+            else:
+                can[key] = val
+
+        return can
+
+    # A hashable version of the canonical form
+    def freeze(self):
+
+        def frozen(val):
+            if isinstance(val, np.ndarray): return frozen(val.tolist())
+            if isinstance(val, dict): return tuple(sorted((k, frozen(v)) for k, v in val.items()))
+            if isinstance(val, (list, tuple)): return tuple(frozen(v) for v in val)
+            return val
+
+        return frozen(self.canonical())
+
+    # A stable digest of the canonical form
+    def digest(self):
+        return hashlib.sha1(repr(self.freeze()).encode("utf-8")).hexdigest()
+
 def default_parameters():
 
     # Default pseudopotential directory is home/pseudopotentials
@@ -24,10 +215,13 @@ def default_parameters():
     except:
         cores = 1
 
-    return {
+    return Parameters({
     "nodes"            : 1,          # Number of compute nodes to use
     "cores_per_node"   : cores,      # Number of cores per compute node
-    "mpirun"           : "mpirun",   # Mpi caller (i.e mpirun or aprun)
+    "mpirun"           : "mpirun",   # Mpi caller (mpirun, aprun, srun or local for no mpi)
+    "ranks_per_node"   : 0,          # Mpi ranks per node (0 => cores_per_node/threads_per_rank)
+    "threads_per_rank" : 1,          # OpenMP threads per mpi rank
+    "cpu_bind"         : "cores",    # Binding of ranks/threads (none, cores, threads or sockets)
     "elph"             : True,       # True if we are to calculate electron-phonon coupling
     "relax_only"       : False,      # True if we are only to calculate relaxation
     "pressure"         : 0,          # Pressure in GPa
@@ -55,283 +249,230 @@ def default_parameters():
     "disk_usage"       : "normal",   # Set to 'minimal' to delete unnessacary files
     "pseudo_dir"       : pseudo_dir, # Where the pseudopotentials for this run are
     "irrep_group_size" : 0,          # The number of irreps processed in each el-ph step (0 => all)
+    "irrep_parallel_groups": 1,      # The number of irrep groups to run at the same time
+    "stage_timeout"    : 0,          # Time (s) after which a q.e run is killed (0 => never)
+    "trace"            : False,      # True to write a timeline of the run to trace.json
+    "parallel_flags"   : "",         # q.e parallelization flags (by default, chosen for each run)
+    "memory_per_core_gb": 2.0,       # The memory available per core, used to limit k-point pools
+    "stage_store"      : "",         # Directory of the store of completed stages ("" => don't use one)
+    "stage_store_outdir": False,     # True if the pw.x save directories should also be stored
+    "stage_store_gb"   : 50.0,       # The size (in GB) the stage store can grow to
+    "sweep"            : [],         # Parameters to sweep over, as [key, values] pairs
     "lattice"          : 2.15*np.identity(3),               # Crystal lattice in angstrom
     "species"          : [["Li", 7.0, "Li.UPF"]],           # Species of atom/mass/pseudo
     "atoms"            : [["Li",0,0,0],["Li",0.5,0.5,0.5]], # Atom names and x,y,z coords
-    }
+    })
 
 def read_parameters(filename):
     
     # Get the parameters specified in the given file
     ret = default_parameters()
 
-    f = open(filename)
-    lines = f.read().split("\n")
-    f.close()
-    
-    i_ignored = []
-    string_args = ["pseudo_dir", "disk_usage"]
-    int_args    = ["nodes", "cores_per_node"]
-    bool_args   = ["elph", "relax_only", "require_prim_geom"]
+    with open(filename) as f:
 
-    for i, l in enumerate(lines):
-        
-        l = l.strip()
-        if i in i_ignored:    continue # Skip lines that have been dealt with
-        if l.startswith("#"): continue # Ignore comment lines
-        if len(l) == 0:       continue # Ignore empty lines
-        if l.find("#") >= 0:
-            l = l[0:l.find("#")]  # strip comments
-        key = l.split()[0]
-
-        # Parse the lattice from the input file
-        if key == "lattice":
-
-            # Convert units to angstrom
-            units = l.split()[1]
-            if units == "angstrom":
-                factor = 1.0
-            elif units == "bohr":
-                factor = BOHR_TO_ANGSTROM
-            else:
-                raise ValueError("Unkown lattice units: "+units)
-
-            lattice = []
-            for j in range(i+1, i+4):
-                    i_ignored.append(j)
-                    lattice.append([factor*float(w) for w in lines[j].split()])
-            ret["lattice"] = lattice
-            continue
-
-        # Parse the atoms from the input file
-        elif key == "atoms":
-            count = int(l.split()[1])
-            units = l.split()[2]
-
-            # Calculate transformation to fractional coordinates
-            # from given system of units. This is done by constructing
-            # the matrix that transforms from the given units to 
-            # crystal coords: the inverse lattice transpose linv.
-            if units == "crystal" or units == "fractional":
-                linv = np.identity(3)
-            elif units == "angstrom":
-                linv = la.inv(np.array(ret["lattice"]).T)
-            elif units == "bohr":
-                linv = la.inv(ANGSTROM_TO_BOHR*np.array(ret["lattice"]).T)
-            else:
-                raise ValueError("Unkown atom coordinate units: "+units)
-            
-            # Parse atoms, transforming as we go
-            atoms = []
-            for j in range(i+1, i+1+count):
-                i_ignored.append(j)
-                n,x,y,z = lines[j].split()
-                r = [float(x), float(y), float(z)]
-                try: r = np.matmul(linv, r)
-                except AttributeError: r = np.dot(linv, r)
-                atoms.append([n, r[0], r[1], r[2]])
-
-            ret["atoms"] = atoms
-            continue
-
-        # Parse atomic species from input file
-        elif key == "species":
-            count = int(l.split()[1])
-            species = []
-            for j in range(i+1, i+1+count):
-                i_ignored.append(j)
-                n,m,p = lines[j].split()
-                species.append([n, float(m), p])
-            ret["species"] = species
-            continue
-
-        # Parse mpirun and arguments
-        elif key == "mpirun":
-            ret["mpirun"] = " ".join(l.split()[1:])
-            continue
-
-        # Parse qpoint_grid
-        elif key == "qpoint_grid":
-            ret["qpoint_grid"] = [int(q) for q in l.split()[1:4]]
-            continue
-
-        # Parse primary k-point grid
-        elif key == "kpts_per_qpt":
-            grid = [int(k) for k in l.split()[1:]]
-            if   len(grid) == 3: ret[key] = grid
-            elif len(grid) == 1: ret[key] = [grid[0], grid[0], grid[0]]
-            else: raise Exception("Could not parse kpts_per_qpts from : "+l)
-            continue
-
-        # Parse aux k-point grid
-        elif key == "aux_kpts":
-            try:    
-                grid = [int(k) for k in l.split()[1:4]]
-                if   len(grid) == 3: ret[key] = grid
-                elif len(grid) == 1: ret[key] = [grid[0], grid[0], grid[0]]
-            except: 
-                ret[key] = None # No auxillary grid
-            continue
-
-        # Parse explicit k-point grid
-        elif key == "kpoint_grid":
-            ret["kpoint_grid"] = [int(k) for k in l.split()[1:4]]
-            continue
-                        
-        # Parse simple key-value pairs from the input file
-        val = l.split()[1]
-
-        # Convert type for certain keys
-        if   key in string_args : val = str(val)
-        elif key in int_args    : val = int(val)
-        elif key in bool_args   : val = val.lower().strip() == "true"
-        else                    : val = float(val) # Default to float
-
-        if key in ret: ret[key] = val
-        else: raise Exception("Unkown key when parsing {1}: {0}".format(key, filename))
+        # Lines are read in a single pass, blocks (e.g the
+        # lattice) read their lines from the same iterator
+        lines = enumerate(f, 1)
+        for n, l in lines:
 
-    return ret
+            l = l.split("#")[0].strip() # strip comments
+            if len(l) == 0: continue    # Ignore empty lines
+            words = l.split()
+            key   = words[0]
 
-def create_qe_input_geom(parameters):
+            if not key in PARAMETER_TYPES:
+                raise Exception("Unkown key when parsing {1}: {0}".format(key, filename))
 
-    # Create the part of a q.e input file that
-    # describes the geometry of the crystal
+            err = "Could not parse {0} on line {1} of {2}: {3}"
+            try:
+                ret[key] = parse_parameter(key, words[1:], ret, lines)
+            except StopIteration:
+                raise ValueError(err.format(key, n, filename, "unexpected end of file"))
+            except (ValueError, IndexError) as e:
+                raise ValueError(err.format(key, n, filename, e))
 
-    # Cell parameters card
-    t  = "CELL_PARAMETERS (angstrom)\n"
-    t += "{0} {1} {2}\n".format(*parameters["lattice"][0])
-    t += "{0} {1} {2}\n".format(*parameters["lattice"][1])
-    t += "{0} {1} {2}\n".format(*parameters["lattice"][2])
+    ret.validate()
+    return ret
 
-    # Atomic species card
-    t += "ATOMIC_SPECIES\n"
-    for s in parameters["species"]:
-        t += "{0} {1} {2}\n".format(*s)
+# Parse a sweep line, adding it to the given sweep
+def parse_sweep(words, sweep):
 
-    # Atomic positions card
-    t += "ATOMIC_POSITIONS (crystal)\n"
-    for a in parameters["atoms"]:
-        t += "{0} {1} {2} {3}\n".format(*a)
+    key, values = words[0], words[1:]
+    kind = "str" if key == "structure" else PARAMETER_TYPES.get(key)
+    if not kind in ["int", "float", "str", "bool"]:
+        raise ValueError("Can't sweep over "+key)
 
-    # K-points card
-    t += "K_POINTS automatic\n"
-    t += "{0} {1} {2} 0 0 0\n".format(*parameters["kpoint_grid"])
+    if len(values) > 0 and values[0] == "range":
+        start, stop, step = [float(w) for w in values[1:4]]
+        values = [canonical_float(v) for v in np.arange(start, stop + step/2, step)]
+        values = [convert_parameter(kind, [repr(v)]) for v in values]
+    else:
+        values = [convert_parameter(kind, [v]) for v in values]
 
-    return t
+    if len(values) == 0:
+        raise ValueError("No values given to sweep {0} over".format(key))
 
-def create_relax_in(parameters):
+    return [s for s in sweep if s[0] != key] + [[key, values]]
 
-    # Create a quantum espresso relax.in file with
-    # the given parameters
+# Parse the parameter with the given key from the remaining words on its
+# line, reading any subsequent lines it needs from the iterator lines
+def parse_parameter(key, words, parameters, lines):
 
-    # Control namelist
-    t  = "&CONTROL\n"
-    t += "calculation='vc-relax',\n"
-    t += "pseudo_dir='{0}',\n".format(parameters["pseudo_dir"])
-    t += "outdir='.',\n"
-    t += "forc_conv_thr={0},\n".format(parameters["forc_conv_thr"])
-    if os.path.isfile("relax.out"):
-        t += "restart_mode='restart',\n"
-    t += "/\n"
+    # Parse the lattice from the input file
+    if key == "lattice":
+
+        # Convert units to angstrom
+        units = words[0]
+        if units == "angstrom":
+            factor = 1.0
+        elif units == "bohr":
+            factor = BOHR_TO_ANGSTROM
+        else:
+            raise ValueError("Unkown lattice units: "+units)
+
+        return [[factor*float(w) for w in next(lines)[1].split()[:3]] for i in range(3)]
+
+    # Parse the atoms from the input file
+    if key == "atoms":
+        count = int(words[0])
+        units = words[1]
+
+        # Calculate transformation to fractional coordinates
+        # from given system of units. This is done by constructing
+        # the matrix that transforms from the given units to 
+        # crystal coords: the inverse lattice transpose linv.
+        if units == "crystal" or units == "fractional":
+            linv = np.identity(3)
+        elif units == "angstrom":
+            linv = la.inv(np.array(parameters["lattice"]).T)
+        elif units == "bohr":
+            linv = la.inv(ANGSTROM_TO_BOHR*np.array(parameters["lattice"]).T)
+        else:
+            raise ValueError("Unkown atom coordinate units: "+units)
+
+        # Parse atoms, transforming all at once
+        rows  = [next(lines)[1].split() for i in range(count)]
+        r     = np.dot(np.array([row[1:4] for row in rows], dtype=float), linv.T)
+        return [[row[0], ri[0], ri[1], ri[2]] for row, ri in zip(rows, r)]
+
+    # Parse atomic species from input file
+    if key == "species":
+        species = []
+        for i in range(int(words[0])):
+            n, m, p = next(lines)[1].split()[:3]
+            species.append([n, float(m), p])
+        return species
+
+    # A parameter to sweep over, either as a list of values
+    #   sweep pressure 0 50 100
+    # or a range (including the end)
+    #   sweep pressure range 0 200 50
+    # where structures are swept over by giving parameter files
+    #   sweep structure LiH.in Li2H.in
+    if key == "sweep":
+        return parse_sweep(words, parameters["sweep"])
+
+    # No auxillary grid
+    if key == "aux_kpts" and (len(words) == 0 or words[0].lower() == "none"):
+        return None
+
+    # Parse simple key-value pairs, converting to the correct type
+    return convert_parameter(PARAMETER_TYPES[key], words)
+
+def add_geometry_cards(inp, parameters):
+
+    # Add the cards of a q.e input file that
+    # describe the geometry of the crystal
+    inp.set_card("CELL_PARAMETERS", "angstrom",
+        ["{0} {1} {2}".format(*l) for l in parameters["lattice"]])
+    inp.set_card("ATOMIC_SPECIES", None,
+        ["{0} {1} {2}".format(*s) for s in parameters["species"]])
+    inp.set_card("ATOMIC_POSITIONS", "crystal",
+        ["{0} {1} {2} {3}".format(*a) for a in parameters["atoms"]])
+    inp.set_card("K_POINTS", "automatic",
+        ["{0} {1} {2} 0 0 0".format(*parameters["kpoint_grid"])])
+    return inp
+
+def add_system_namelists(inp, parameters):
 
     # System namelist
-    t += "&SYSTEM\n"
-    t += "ntyp={0},\n".format(len(parameters["species"]))
-    t += "nat={0},\n".format(len(parameters["atoms"]))
-    t += "ibrav=0,\n"
-    t += "ecutwfc={0},\n".format(parameters["ecutwfc"])
-    t += "ecutrho={0},\n".format(parameters["ecutrho"])
-    t += "occupations='smearing',\n"
-    t += "degauss={0},\n".format(parameters["degauss"])
-    t += "smearing='mv',\n"
-    t += "/\n"
+    system = inp.namelist("SYSTEM")
+    system["ntyp"]        = len(parameters["species"])
+    system["nat"]         = len(parameters["atoms"])
+    system["ibrav"]       = 0
+    system["ecutwfc"]     = parameters["ecutwfc"]
+    system["ecutrho"]     = parameters["ecutrho"]
+    system["occupations"] = "smearing"
+    system["degauss"]     = parameters["degauss"]
+    system["smearing"]    = "mv"
 
     # Electrons namelist
-    t += "&ELECTRONS\n"
-    t += "mixing_beta={0},\n".format(parameters["mixing_beta"])
-    t += "conv_thr={0},\n".format(parameters["conv_thr"])
-    t += "/\n"
+    electrons = inp.namelist("ELECTRONS")
+    electrons["mixing_beta"] = parameters["mixing_beta"]
+    electrons["conv_thr"]    = parameters["conv_thr"]
+    return inp
+
+def relax_input(parameters, restart=False):
+
+    # Build a quantum espresso vc-relax input
+    # with the given parameters
+    inp = QEInput()
+
+    # Control namelist
+    control = inp.namelist("CONTROL")
+    control["calculation"]   = "vc-relax"
+    control["pseudo_dir"]    = parameters["pseudo_dir"]
+    control["outdir"]        = "."
+    control["forc_conv_thr"] = parameters["forc_conv_thr"]
+    if restart: control["restart_mode"] = "restart"
+
+    add_system_namelists(inp, parameters)
 
     # Ions namelist
-    t += "&IONS\n"
-    t += "ion_dynamics='bfgs',\n"
-    t += "/\n"
+    inp.namelist("IONS")["ion_dynamics"] = "bfgs"
 
     # Cell namelist
-    t += "&CELL\n"
-    t += "cell_dynamics='bfgs',\n"
-    t += "press={0},\n".format(parameters["pressure"]*10)
-    t += "press_conv_thr={0},\n".format(parameters["press_conv_thr"]*10)
-    t += "/\n"
+    cell = inp.namelist("CELL")
+    cell["cell_dynamics"]  = "bfgs"
+    cell["press"]          = parameters["pressure"]*10
+    cell["press_conv_thr"] = parameters["press_conv_thr"]*10
 
-    t += create_qe_input_geom(parameters)
+    return add_geometry_cards(inp, parameters)
 
-    # Write the file
-    f = open("relax.in","w")
-    f.write(t)
-    f.close()
+def create_relax_in(parameters):
 
-def create_scf_non_geom(parameters, file_prefix="scf"):
+    # Create a quantum espresso relax.in file with
+    # the given parameters
+    wd = work_dir(parameters)
+    relax_input(parameters, restart=wd.isfile("relax.out")).write(wd.file("relax.in"))
 
-    elph = parameters["elph"]
-        
-    # Control namelist
-    t  = "&CONTROL\n"
-    t += "calculation='scf',\n"
-    t += "pseudo_dir='{0}',\n".format(parameters["pseudo_dir"])
-    t += "outdir='.',\n"
-    t += "tprnfor=.true.,\n"
-    t += "tstress=.true.,\n"
-    if os.path.isfile("{0}.out".format(file_prefix)):
-        t += "restart_mode='restart',\n"
-    t += "/\n"
+def scf_input(parameters, restart=False):
 
-    # System namelist
-    t += "&SYSTEM\n"
-    t += "ntyp={0},\n".format(len(parameters["species"]))
-    t += "nat={0},\n".format(len(parameters["atoms"]))
-    t += "ibrav=0,\n"
-    t += "ecutwfc={0},\n".format(parameters["ecutwfc"])
-    t += "ecutrho={0},\n".format(parameters["ecutrho"])
-    t += "occupations='smearing',\n"
-    t += "degauss={0},\n".format(parameters["degauss"])
-    t += "smearing='mv',\n"
-    if elph:
-        t += "la2F=.true.,\n"
-    t += "/\n"
+    # Build a quantum espresso scf input
+    # with the given parameters
+    inp = QEInput()
 
-    # Electrons namelist
-    t += "&ELECTRONS\n"
-    t += "mixing_beta={0},\n".format(parameters["mixing_beta"])
-    t += "conv_thr={0},\n".format(parameters["conv_thr"])
-    t += "/\n"
+    # Control namelist
+    control = inp.namelist("CONTROL")
+    control["calculation"] = "scf"
+    control["pseudo_dir"]  = parameters["pseudo_dir"]
+    control["outdir"]      = "."
+    control["tprnfor"]     = True
+    control["tstress"]     = True
+    control["verbosity"]   = "high"
+    if restart: control["restart_mode"] = "restart"
+
+    add_system_namelists(inp, parameters)
+    if parameters["elph"]:
+        inp.namelist("SYSTEM")["la2F"] = True
 
-    return t
+    return add_geometry_cards(inp, parameters)
 
 def create_scf_in(parameters):
         
-    # Create the non-geometry and geomety parts
-    t  = create_scf_non_geom(parameters)
-    t += create_qe_input_geom(parameters)
-
-    # Write the file
-    f = open("scf.in","w")
-    f.write(t)
-    f.close()
-
-def create_extract_evals_in(parameters):
-    
-    # Create file to extract eigenvalues from scf run
-    t  = "&BANDS\n"
-    t += "outdir='.',\n"
-    t += "filband='extracted_evals.out',\n"
-    t += "lsym=.false.\n"
-    t += "/\n"
-
-    # Write the file
-    f = open("extract_evals.in", "w")
-    f.write(t)
-    f.close()
+    # Create the scf.in file
+    wd = work_dir(parameters)
+    scf_input(parameters, restart=wd.isfile("scf.out")).write(wd.file("scf.in"))
 
 def get_bz_path(parameters):
 
@@ -368,196 +509,221 @@ def get_bz_path(parameters):
 
     return [kpoints, special_kpoints]
 
-def create_bands_in(parameters):
+def bands_input(parameters, kpoints, restart=False):
         
-    # Create the bands input file the same
-    # way as an scf file, then replace the kpoints
-    # with the path
-    t  = create_scf_non_geom(parameters, file_prefix="bands")
-    t += create_qe_input_geom(parameters)
-
-    t = t[0:t.find("K_POINTS")]
-    t += "K_POINTS (crystal)\n"
+    # Build the bands input the same way as
+    # an scf input, then replace the kpoints
+    # with the given path
+    inp = scf_input(parameters, restart=restart)
+    w   = np.full((len(kpoints), 1), 1.0/float(len(kpoints)))
+    inp.set_card("K_POINTS", "crystal", [str(len(kpoints)),
+        format_rows("%.10f %.10f %.10f %.10f", np.hstack([kpoints, w]))])
+    return inp
+
+def create_bands_in(parameters):
+
+    wd = work_dir(parameters)
     kpoints, special_kpoints = get_bz_path(parameters)
 
     # Write the high symmetry poitns to file
-    with open("bands.high_symmetry_points","w") as f:
+    with wd.open("bands.high_symmetry_points","w") as f:
         for skp in special_kpoints:
             f.write("{0} {1} {2}\n".format(*skp))
 
-    # Format kpoints into output
-    t += "{0}\n".format(len(kpoints))
-    w  = 1.0/float(len(kpoints))
-    for k in kpoints:
-        t += "{0} {1} {2} {3}\n".format(k[0],k[1],k[2],w)
-
-    # Write the file
-    with open("bands.in","w") as f:
-        f.write(t)
+    inp = bands_input(parameters, kpoints, restart=wd.isfile("bands.out"))
+    inp.write(wd.file("bands.in"))
 
-def create_elph_in(
-    name, 
+def elph_input(
     parameters, 
     q_range=None,
     irr_range=None,
-    force_recover=False):
+    recover=False):
 
     elph = parameters["elph"]
 
-    # Create the input for an electron-phonon
+    # Build the input for an electron-phonon
     # interaction calculation
-    if elph: t = "Calculate electron-phonon coefficients\n"
-    else:    t = "Calculate dynamical matrix\n"
-    t += "&INPUTPH\n"
-    t += "tr2_ph=1.0d-12,\n"
-    t += "outdir='.',\n"
-    t += "reduce_io=.true.,\n"
-    t += "trans=.true.,\n"
-    t += "ldisp=.true.,\n"
-    t += "nq1={0},\n".format(parameters["qpoint_grid"][0])
-    t += "nq2={0},\n".format(parameters["qpoint_grid"][1])
-    t += "nq3={0},\n".format(parameters["qpoint_grid"][2])
+    if elph: inp = QEInput("Calculate electron-phonon coefficients")
+    else:    inp = QEInput("Calculate dynamical matrix")
+
+    ph = inp.namelist("INPUTPH")
+    ph["tr2_ph"]    = 1.0e-12
+    ph["outdir"]    = "."
+    ph["reduce_io"] = True
+    ph["trans"]     = True
+    ph["ldisp"]     = True
+    ph["nq1"]       = parameters["qpoint_grid"][0]
+    ph["nq2"]       = parameters["qpoint_grid"][1]
+    ph["nq3"]       = parameters["qpoint_grid"][2]
     if not q_range is None:
         # Specify a range of q-points to calculate
-        t += "start_q={0},\n".format(q_range[0])
-        t += "last_q={0},\n".format(q_range[1])
+        ph["start_q"] = q_range[0]
+        ph["last_q"]  = q_range[1]
     if not irr_range is None:
         # Specify a range of irreps to calculate
-        t += "start_irr={0},\n".format(irr_range[0])
-        t += "last_irr={0},\n".format(irr_range[1])
+        ph["start_irr"] = irr_range[0]
+        ph["last_irr"]  = irr_range[1]
     if elph:
         # Parameters for electron-phonon calculation
-        t += "fildvscf='elph_vscf',\n"
-        t += "electron_phonon='interpolated',\n"
-        t += "el_ph_sigma={0},\n".format(parameters["elph_dsig"])
-        t += "el_ph_nsigma={0},\n".format(int(parameters["elph_nsig"]))
+        ph["fildvscf"]        = "elph_vscf"
+        ph["electron_phonon"] = "interpolated"
+        ph["el_ph_sigma"]     = parameters["elph_dsig"]
+        ph["el_ph_nsigma"]    = int(parameters["elph_nsig"])
+    if recover:
+        ph["recover"] = True
 
-    # Check if calculation was already underway
-    # if so, make this a continuation run
-    if force_recover or os.path.isfile("elph.out"):
-        t += "recover=.true.,\n"
+    return inp
 
-    t += "/\n"
+def create_elph_in(
+    name, 
+    parameters, 
+    q_range=None,
+    irr_range=None,
+    force_recover=False):
 
-    # Write the file
-    with open(name+".in","w") as f:
-        f.write(t)
+    # Check if calculation was already underway
+    # if so, make this a continuation run
+    wd      = work_dir(parameters)
+    recover = force_recover or wd.isfile("elph.out")
+    elph_input(parameters, q_range, irr_range, recover).write(wd.file(name+".in"))
+
+def q2r_input(parameters):
+
+    # Build the input for q2r.x
+    inp = QEInput()
+    q2r = inp.namelist("INPUT")
+    q2r["zasr"]   = "simple"
+    q2r["fildyn"] = "matdyn"
+    q2r["flfrc"]  = "force_constants"
+    if parameters["elph"]:
+        q2r["la2F"]         = True
+        q2r["el_ph_nsigma"] = int(parameters["elph_nsig"])
+    return inp
 
 def create_q2r_in(parameters):
 
-    elph = parameters["elph"]
-
     # Creates the input file for q2r.x
-    t  = "&INPUT\n"
-    t += "zasr='simple',\n"
-    t += "fildyn='matdyn',\n"
-    t += "flfrc='force_constants',\n"
-    if elph:
-        t += "la2F=.true.\n"
-        t += "el_ph_nsigma={0},\n".format(int(parameters["elph_nsig"]))
-    t += "/\n"
-
-    # Write the file
-    f = open("q2r.in", "w")
-    f.write(t)
-    f.close()
-
-def create_ph_bands_in(parameters):
+    q2r_input(parameters).write(work_dir(parameters).file("q2r.in"))
 
-    elph = parameters["elph"]
+def ph_bands_input(parameters, qpoints):
 
-    # Creates the input files for calculating
+    # Build the input for calculating
     # the phonon bandstructure
-    t  = "&INPUT\n"
-    t += "asr='simple',\n"
-    t += "flfrc='force_constants',\n"
-    t += "flfrq='ph_bands.freq',\n"
-    t += "q_in_cryst_coord=.true.,\n"
-    t += "dos=.false.\n"
-    if elph:
-        t += "la2F=.true.,\n"
-        t += "el_ph_nsigma={0},\n".format(int(parameters["elph_nsig"]))
-    t += "/\n"
+    inp = QEInput()
+    matdyn = inp.namelist("INPUT")
+    matdyn["asr"]              = "simple"
+    matdyn["flfrc"]            = "force_constants"
+    matdyn["flfrq"]            = "ph_bands.freq"
+    matdyn["flvec"]            = "ph_bands.modes"
+    matdyn["q_in_cryst_coord"] = True
+    matdyn["dos"]              = False
+    if parameters["elph"]:
+        matdyn["la2F"]         = True
+        matdyn["el_ph_nsigma"] = int(parameters["elph_nsig"])
+
+    # The q-points follow the namelist, without a card name
+    inp.set_card(None, None, [str(len(qpoints)),
+        format_rows("%.10f %.10f %.10f", qpoints)])
+    return inp
 
+def create_ph_bands_in(parameters):
+
+    wd = work_dir(parameters)
     qpoints, special_qpoints = get_bz_path(parameters)
 
-    with open("ph_bands.high_symmetry_points","w") as f:
+    with wd.open("ph_bands.high_symmetry_points","w") as f:
         for sqp in special_qpoints:
             f.write("{0} {1} {2}\n".format(*sqp))
 
-    t += "{0}\n".format(len(qpoints))
-    for q in qpoints:
-        t += "{0} {1} {2}\n".format(*q)
-    
-    # Write the file
-    with open("ph_bands.in","w") as f:
-        f.write(t)
+    ph_bands_input(parameters, qpoints).write(wd.file("ph_bands.in"))
 
-def create_ph_dos_in(parameters):
+def ph_dos_input(parameters):
         
+    # Build the input for calculating phonon density of states
+    qgrid = parameters["qpt_dense_mult"]*np.array(parameters["qpoint_grid"])
+
+    inp = QEInput()
+    matdyn = inp.namelist("input")
+    matdyn["asr"]   = "simple"
+    matdyn["flfrc"] = "force_constants"
+    matdyn["flfrq"] = "ph_dos.freq"
+    matdyn["flvec"] = "ph_dos.modes"
+    matdyn["dos"]   = True
+    matdyn["fldos"] = "phonon.dos"
+    matdyn["nk1"]   = int(qgrid[0])
+    matdyn["nk2"]   = int(qgrid[1])
+    matdyn["nk3"]   = int(qgrid[2])
+    matdyn["ndos"]  = int(parameters["ph_ndos"])
+    if parameters["elph"]:
+        matdyn["la2F"]         = True
+        matdyn["el_ph_nsigma"] = int(parameters["elph_nsig"])
+    return inp
+
+def create_ph_dos_in(parameters):
+
     # Create input file for calculating phonon density of states
-    qgrid = parameters["qpoint_grid"] 
-    scale = parameters["qpt_dense_mult"]
-    elph  = parameters["elph"]
-
-    t  = "&input\n"
-    t += "asr='simple',\n"
-    t += "flfrc='force_constants',\n"
-    t += "flfrq='ph_dos.freq',\n"
-    t += "dos=.true.\n"
-    t += "fldos='phonon.dos',\n"
-    t += "nk1={0},\n".format(qgrid[0]*scale)
-    t += "nk2={0},\n".format(qgrid[1]*scale)
-    t += "nk3={0},\n".format(qgrid[2]*scale)
-    t += "ndos={0}\n".format(int(parameters["ph_ndos"]))
-    if elph:
-        t += "la2F=.true.,\n"
-        t += "el_ph_nsigma={0},\n".format(int(parameters["elph_nsig"]))
-    t += "/\n"
+    ph_dos_input(parameters).write(work_dir(parameters).file("ph_dos.in"))
 
-    # Write the file
-    with open("ph_dos.in", "w") as f:
-        f.write(t)
+def bands_x_input(parameters):
+
+    # Build the input for reordering of bands etc
+    inp = QEInput()
+    bands = inp.namelist("BANDS")
+    bands["outdir"]  = "."
+    bands["filband"] = "bands.x.bands"
+    return inp
 
 def create_bands_x_in(parameters):
         
     # Create input file for reordering of bands etc
-    t  = "&BANDS\n"
-    t += "outdir='.',\n"
-    t += "filband='bands.x.bands'\n"
-    t += "/\n"
+    bands_x_input(parameters).write(work_dir(parameters).file("bands.x.in"))
 
-    # Write the file
-    f = open("bands.x.in", "w")
-    f.write(t)
-    f.close()
+def run_qe(exe, file_prefix, parameters, dry=False, check_done=True, cores=None, directory=None):
 
-def run_qe(exe, file_prefix, parameters, dry=False, check_done=True):
+    # The cores to run on (by default, all of the cores available)
+    np    = parameters["nodes"] * parameters["cores_per_node"] if cores is None else cores
+    ranks = launch.ranks(parameters, np)
+    stage = os.path.join(directory or "", file_prefix)
 
-    if dry: return
+    # A dry run only records the run that would have been made
+    if dry:
+        trace.instant(parameters, stage, "qe", {"exe" : exe, "cores" : np, "ranks" : ranks,
+                      "threads" : parameters["threads_per_rank"], "dry" : True})
+        return
+
+    # The input/output files are in the given directory, relative
+    # to the working directory (by default, the working directory)
+    qe_dir = work_dir(parameters).path if directory is None else work_dir(parameters).file(directory)
+    path    = os.path.join(qe_dir, file_prefix)
+
+    # Work out the key of this stage in the stage store, the
+    # stage after this one follows on from this key
+    key = None
+    if store.store_enabled(parameters) and directory is None:
+        key = store.stage_key(exe, file_prefix, parameters)
+        parameters["stage_chain"] = key
 
     # Dont rerun if already done
-    if os.path.isfile(file_prefix+".out"):
-        with open(file_prefix+".out") as f:
+    if os.path.isfile(path+".out"):
+        with open(path+".out") as f:
             s = f.read()
             if "JOB DONE" in s:
                 fs = "{0}.out already complete, skipping.\n"
-                parameters["out_file"].write(fs.format(file_prefix))
+                parameters["out_file"].write(fs.format(os.path.join(directory or "", file_prefix)))
                 return
 
+    # Reuse the result of an identical stage run elsewhere
+    storable = not key is None and not store.stage_products(file_prefix, parameters) is None
+    if storable and store.restore_stage(key, file_prefix, parameters):
+        fs = "{0} restored from stage store ({1})\n"
+        parameters["out_file"].write(fs.format(file_prefix, key))
+        return
+
     # Run quantum espresso with specified parallelism
-    mpirun = parameters["mpirun"]
-    ppn    = parameters["cores_per_node"]
-    nodes  = parameters["nodes"]
-    np     = nodes * ppn
-
-    # Setup mpi invokation
-    if "mpirun" in mpirun:
-        mpirun = "{0} -np {1}".format(mpirun, np)
-    elif "aprun" in mpirun:
-        mpirun = "{0} -n {1}".format(mpirun, np)
-    else:
-        raise ValueError("Unkown mpirun = {0}".format(mpirun))
+    env, mpirun = launch.launch_command(parameters, np)
+
+    # Work out the parallelization for this run
+    qe_flags = parallel.qe_flags(exe, file_prefix, ranks, parameters, directory)
 
     # Check if the ESPRESSO_BIN environment variable is set
     if "ESPRESSO_BIN" in os.environ:
@@ -565,22 +731,81 @@ def run_qe(exe, file_prefix, parameters, dry=False, check_done=True):
         parameters["out_file"].write("Using QE from {0}\n".format(eb))
         exe = eb + "/" + exe
     
-    # Invoke the program 
-    qe_flags = "-nk {0}".format(np)
-    cmd = "{0} {1} {2} <{3}.in> {3}.out".format(mpirun, exe, qe_flags, file_prefix) 
-    parameters["out_file"].write("Running: "+cmd+"\n")
-    os.system(cmd)
+    # Invoke the program, recording the resources it used
+    args = mpirun + [exe] + qe_flags.split()
+    fs   = "Running: {0}\n    in {1}, stdin {2}.in, stdout {2}.out, with {3}\n"
+    parameters["out_file"].write(fs.format(" ".join(args), qe_dir, file_prefix,
+        " ".join("{0}={1}".format(k, env[k]) for k in sorted(env))))
+
+    timeout = parameters["stage_timeout"] if parameters["stage_timeout"] > 0 else None
+    with trace.span(parameters, stage, "qe", np, {"exe" : exe, "ranks" : ranks, "flags" : qe_flags,
+                    "threads" : parameters["threads_per_rank"]}):
+        metrics = runner.run_command(args, cwd=qe_dir,
+            stdin=file_prefix+".in", stdout=file_prefix+".out", env=env, timeout=timeout,
+            metrics_file=work_dir(parameters).file(runner.METRICS_FILE),
+            extra={"stage" : stage, "cores" : np, "ranks" : ranks,
+                   "threads" : parameters["threads_per_rank"]})
+
+    if metrics["timed_out"]:
+        parameters["out_file"].write("QE job {0}.in timed out!\n".format(path))
+        raise Exception("{0} timed out after {1}s".format(path, timeout))
+
+    if metrics["returncode"] != 0:
+        fs = "QE job {0}.in exited with status {1}\n"
+        parameters["out_file"].write(fs.format(path, metrics["returncode"]))
+        raise Exception("{0} exited with status {1}".format(path, metrics["returncode"]))
 
     # Check calculation completed properly
     if check_done:
-        with open(file_prefix+".out") as f:
+        with open(path+".out") as f:
             if not "JOB DONE" in f.read():
-                err = "JOB DONE not found in {0}.out".format(file_prefix)
-                parameters["out_file"].write("QE job {0}.in did not complete!\n".format(file_prefix))
-                raise Exception("JOB DONE not found in {0}.out".format(file_prefix))
+                err = "JOB DONE not found in {0}.out".format(path)
+                parameters["out_file"].write("QE job {0}.in did not complete!\n".format(path))
+                raise Exception(err)
+
+    # Store the result for identical stages elsewhere
+    if storable:
+        store.save_stage(key, file_prefix, parameters)
+
+def set_grids(parameters):
+
+    # Work out the q-point and k-point grids from the
+    # (possibly explicit) grids and spacings in parameters
+    log = parameters["out_file"].write if "out_file" in parameters else lambda m : None
+
+    # Work out qpoint_grid
+    if "qpoint_grid" in parameters:
+        
+        # Warn user we're using an explicit q-point grid
+        if "qpoint_spacing" in parameters:
+            log("Explicit q-point grid specified, ignoring q-point spacing\n")
+
+    elif "qpoint_spacing" in parameters:
+        
+        # Work out qpoint_grid from qpoint_spacing
+        parameters["qpoint_grid"] = get_kpoint_grid(
+            parameters["lattice"], parameters["qpoint_spacing"])
+
+    # Ensure we have at least 1 q-point in each direction
+    parameters["qpoint_grid"] = [max(1,q) for q in parameters["qpoint_grid"]]
+
+    if parameters["kpoint_grid"] is None:
+        # Work out k-point grid from q-point grid and
+        # k-points per qpoint
+        kpq = parameters["kpts_per_qpt"]
+        qpg = parameters["qpoint_grid"]
+        parameters["kpoint_grid"] = [int(q*k) for q,k in zip(qpg, kpq)]
+        mess = "Generating k-point grid from q-point grid: {0}x{1}x{2}\n"
+    else:
+        # Use explicitly specified k-point grid
+        mess = "Using explicit k-point grid: {0}x{1}x{2}\n"
+
+    # Tell user the k-point grid we're using and how we got it
+    log(mess.format(*parameters["kpoint_grid"]))
 
 def reduce_to_primitive(parameters):
 
+    log = parameters["out_file"].write if "out_file" in parameters else lambda m : None
     try:
         import seekpath
         # Return a modified parameter
@@ -628,15 +853,14 @@ def reduce_to_primitive(parameters):
         #    cart_coords = np.matmul(recip_prim_lattice.T, frac_coords)
         #    parameters["high_symm_points"][p] = cart_coords*a0/(2*np.pi)
 
-        outf = parameters["out_file"]
-        outf.write("Successfully reduced to primitive geometry using seekpath.\n")
+        log("Successfully reduced to primitive geometry using seekpath.\n")
 
     except ImportError:
         err  = "Could not import seekpath =>\n"
         err += "  1. We cannot reduce to the primitive geometry\n"
         err += "  2. We cannot obtain Brilloin zone paths\n"
         err += "  3. 2 => we cannot calculate bandstructures\n"
-        parameters["out_file"].write(err)
+        log(err)
         
         if parameters["require_prim_geom"]:
             ex_mess  = "Could not reduce to primitive geometry/find BZ path. "
@@ -644,83 +868,49 @@ def reduce_to_primitive(parameters):
             ex_mess += "have access to the seeKpath module."
             raise Exception(ex_mess)
 
-    # Work out qpoint_grid
-    if "qpoint_grid" in parameters:
-        
-        # Warn user we're using an explicit q-point grid
-        if "qpoint_spacing" in parameters:
-            parameters["out_file"].write(
-                "Explicit q-point grid specified, ignoring q-point spacing\n")
-
-    elif "qpoint_spacing" in parameters:
-        
-        # Work out qpoint_grid from qpoint_spacing
-        parameters["qpoint_grid"] = get_kpoint_grid(
-            parameters["lattice"], parameters["qpoint_spacing"])
-
-    # Ensure we have at least 1 q-point in each direction
-    parameters["qpoint_grid"] = [max(1,q) for q in parameters["qpoint_grid"]]
-
-    if parameters["kpoint_grid"] is None:
-        # Work out k-point grid from q-point grid and
-        # k-points per qpoint
-        kpq = parameters["kpts_per_qpt"]
-        qpg = parameters["qpoint_grid"]
-        parameters["kpoint_grid"] = [int(q*k) for q,k in zip(qpg, kpq)]
-        mess = "Generating k-point grid from q-point grid: {0}x{1}x{2}\n"
-    else:
-        # Use explicitly specified k-point grid
-        mess = "Using explicit k-point grid: {0}x{1}x{2}\n"
-
-    # Tell user the k-point grid we're using and how we got it
-    parameters["out_file"].write(mess.format(*parameters["kpoint_grid"]))
+    set_grids(parameters)
 
     # Return resulting new parameter set
     return parameters
 
-def run(parameters, dry=False, aux_kpts=False):
+def apply_relax_results(parameters, results):
 
-    # Open the output file
-    parameters["out_file"] = open("run.out","w",1)
-    parameters["out_file"].write("Dryrun   : {0}\n".format(dry))
-    parameters["out_file"].write("Aux kpts : {0}\n".format(aux_kpts))
-    max_l = str(max([len(p) for p in parameters]))
-    for p in parameters:
-        fs = "{0:"+max_l+"."+max_l+"} : {1}\n"
-        parameters["out_file"].write(fs.format(p, parameters[p]))
+    # Use the relaxed geometry for the rest of the calculation
+    parameters["lattice"] = results["lattice"]
+    parameters["atoms"]   = results["atoms"]
 
-    # Run with the auxilliary kpt grid
-    if aux_kpts:
-        parameters["out_file"].write("Running auxillary kpoint grid...\n")
-        parameters["kpts_per_qpt"] = parameters["aux_kpts"]
+def run_relax_stage(parameters, dry, cores=None):
 
-    # Reduce to primitive description
-    parameters = reduce_to_primitive(parameters)
-    
     # Caclulate relaxed geometry
     create_relax_in(parameters)
-    run_qe("pw.x", "relax", parameters, dry=dry)
-    if not dry:
-        relax_data = parse_vc_relax("relax.out")
-        parameters["lattice"] = relax_data["lattice"]
-        parameters["atoms"]   = relax_data["atoms"]
+    run_qe("pw.x", "relax", parameters, dry=dry, cores=cores)
+    if dry: return None
 
-    # Stop here if we're just doing relaxations
-    if parameters["relax_only"]: return
+    relax_data = parse_vc_relax(work_dir(parameters).file("relax.out"), final_only=True)
+    results = {
+        "lattice" : np.asarray(relax_data["lattice"], dtype=float).tolist(),
+        "atoms"   : [[a[0]] + [float(x) for x in a[1:]] for a in relax_data["atoms"]],
+    }
+    apply_relax_results(parameters, results)
+    return results
 
-    # Run SCF with the new geometry
-    create_scf_in(parameters)
-    run_qe("pw.x", "scf", parameters, dry=dry)
+def run_elph_stage(parameters, dry, cores=None):
 
+    wd = work_dir(parameters)
     if parameters["irrep_group_size"] > 0:
 
         # Run elec-phonon prep calculation
         create_elph_in("elph_prep", parameters, irr_range=[0,0])
-        run_qe("ph.x", "elph_prep", parameters, dry=dry, check_done=False)
+        run_qe("ph.x", "elph_prep", parameters, dry=dry, check_done=False, cores=cores)
+
+        # The irrep groups aren't known until elph_prep has run
+        if dry and not wd.isfile("elph_prep.out"):
+            parameters["out_file"].write("Dry run, irrep groups unknown without elph_prep.out\n")
+            return
 
         # Count q-points
         qpoint_count = 0
-        with open("elph_prep.out") as elph_prep_f:
+        with wd.open("elph_prep.out") as elph_prep_f:
             for line in elph_prep_f:
                 if "q-points):" in line:
                     qpoint_count = int(line.split("q-points")[0].replace("(",""))
@@ -728,96 +918,467 @@ def run(parameters, dry=False, aux_kpts=False):
 
         parameters["out_file"].write("q-points to calculate: {0}\n".format(qpoint_count))
 
-        # Count irreps
-        irrep_counts = {}  
+        # Find the dimension of each irrep at each q-point
+        irreps = {}
         for i in range(1, qpoint_count+1):
-            with open("_ph0/pwscf.phsave/patterns.{0}.xml".format(i)) as pat_file:
-                next_line = False
-                for l in pat_file:
-                    if next_line:
-                        irrep_counts[i] = int(l)
-                        break
-                    if "NUMBER_IRR_REP" in l:
-                        next_line = True
-
-        for i in irrep_counts:
-            fs = "    irreducible representations for q-point {0}: {1}\n"
-            parameters["out_file"].write(fs.format(i, irrep_counts[i]))
+            irreps[i] = parse_irrep_patterns(wd.file(PHSAVE, "patterns.{0}.xml".format(i)))
 
-        gs = int(parameters["irrep_group_size"])
+        for i in irreps:
+            fs = "    irreducible representations for q-point {0}: {1}\n"
+            parameters["out_file"].write(fs.format(i, len(irreps[i])))
 
         # Run elec-phonon calculations for each irrep group
-        for q_point in range(1, qpoint_count+1):
-            for irr in range(1, irrep_counts[q_point]+1, gs):
-                name = "elph_{0}_{1}_{2}".format(q_point, irr, irr+gs-1)
-                create_elph_in(name, parameters,
-                    irr_range=[irr, min(irr+gs-1, irrep_counts[q_point])], 
-                    q_range=[q_point, q_point])
-                run_qe("ph.x", name, parameters, dry=dry)
+        groups = irrep_groups(irreps, int(parameters["irrep_group_size"]))
+        run_irrep_groups(groups, parameters, dry, cores)
 
         # Collect phonon results/diagonalise dynamical matrix
         create_elph_in("elph_collect", parameters, force_recover=True)
-        run_qe("ph.x", "elph_collect", parameters, dry=dry)
+        run_qe("ph.x", "elph_collect", parameters, dry=dry, cores=cores)
 
     else:
         
         # Just calculate all electron-phonon stuff in a single step
         create_elph_in("elph_all", parameters)
-        run_qe("ph.x", "elph_all", parameters, dry=dry)
+        run_qe("ph.x", "elph_all", parameters, dry=dry, cores=cores)
 
     # Delete phonon files after successful elph run
     if parameters["disk_usage"] == "minimal":
-        os.system("rm -r _ph0")
+        for d in ["_ph0", "irrep_groups"]:
+            shutil.rmtree(wd.file(d), ignore_errors=True)
 
-    # Convert dynamcial matricies etc to real space
-    create_q2r_in(parameters)
-    run_qe("q2r.x", "q2r", parameters, dry=dry)
+# Where the measured time taken by each irrep is recorded
+IRREP_TIMINGS_FILE = "irrep_timings.json"
 
-    # Caclulate the phonon density of states
-    create_ph_dos_in(parameters)
-    run_qe("matdyn.x", "ph_dos", parameters, dry=dry)
+# The q.e phonon save directory
+PHSAVE = "_ph0/pwscf.phsave"
 
-    # Extract the eigenvalues
-    create_extract_evals_in(parameters)
-    run_qe("bands.x", "extract_evals", parameters, dry=dry)
+def irrep_groups(irreps, group_size):
 
-    # Only do the following if we have a brillouin zone path
-    if "bz_path" in parameters:
+    # Split the irreps at each q-point into groups of group_size
+    # irreps, returned as [name, q-point, first, last, dimensions]
+    groups = []
+    for q in sorted(irreps):
+        for irr in range(1, len(irreps[q])+1, group_size):
+            last = min(irr+group_size-1, len(irreps[q]))
+            name = "elph_{0}_{1}_{2}".format(q, irr, irr+group_size-1)
+            groups.append([name, q, irr, last, irreps[q][irr-1:last]])
+    return groups
 
-        # Caclulate the phonon bandstructure
-        create_ph_bands_in(parameters)
-        run_qe("matdyn.x", "ph_bands", parameters, dry=dry)
+def load_irrep_timings(wd):
+    try:
+        with wd.open(IRREP_TIMINGS_FILE) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def irrep_group_cost(group, timings):
+
+    # The measured cost (in core-seconds) of the irreps in the group if
+    # they have all been timed. Otherwise the number of perturbations
+    # in the group, multiplied by the average measured cost of a
+    # perturbation (if there is one)
+    name, q, first, last, dims = group
+    measured = [timings.get("{0}.{1}".format(q, i)) for i in range(first, last+1)]
+    if all(not m is None for m in measured):
+        return sum(m["seconds"] for m in measured)
+
+    seconds = sum(t["seconds"] for t in timings.values())
+    perts   = sum(t["dim"]     for t in timings.values())
+    return sum(dims) * (seconds/perts if perts > 0 else 1.0)
+
+def setup_irrep_group_dir(wd, directory):
+
+    # Set up a directory (within the working directory wd) in which an
+    # irrep group can be run alongside others; the pw.x save data is
+    # linked and the phonon save directory (containing the patterns etc.
+    # from elph_prep) is copied
+    phsave = wd.file(directory, PHSAVE)
+    if not os.path.isdir(phsave): os.makedirs(phsave)
+
+    for f in ["pwscf.save", "pwscf.a2Fsave"] + wd.glob("pwscf.wfc*"):
+        link = wd.file(directory, f)
+        if wd.exists(f) and not os.path.lexists(link):
+            os.symlink(wd.file(f), link)
+
+    for f in os.listdir(wd.file(PHSAVE)):
+        src, dst = wd.file(PHSAVE, f), os.path.join(phsave, f)
+        if os.path.isfile(src) and not os.path.exists(dst):
+            shutil.copy2(src, dst)
+
+def run_irrep_group(group, parameters, dry, cores, directory, timings, lock):
+
+    name, q, first, last, dims = group
+    wd   = work_dir(parameters)
+    path = wd.file(directory or "", name)
+
+    if directory is None:
+        create_elph_in(name, parameters, irr_range=[first, last], q_range=[q, q])
+    else:
+        setup_irrep_group_dir(wd, directory)
+        elph_input(parameters, q_range=[q, q], irr_range=[first, last],
+            recover=os.path.isfile(path+".out")).write(path+".in")
 
-        # Caculate the electronic bandstructure
-        create_bands_in(parameters)
-        run_qe("pw.x", "bands", parameters, dry=dry)
+    already_done = wd.job_done(os.path.join(directory or "", name+".out"))
+
+    start = time.time()
+    with trace.span(parameters, name, "irrep_group", cores, {"q" : q, "irreps" : [first, last], "dims" : dims}):
+        run_qe("ph.x", name, parameters, dry=dry, cores=cores, directory=directory)
+    elapsed = time.time() - start
+    if dry: return
+
+    # Copy the dynamical matrix/el-ph results back into the main
+    # phonon save directory, ready to be collected (ph.x images
+    # write their results into _ph1, _ph2 ...)
+    for save in wd.glob(os.path.join(directory or "", "_ph*", "pwscf.phsave")):
+        if os.path.samefile(wd.file(save), wd.file(PHSAVE)): continue
+        for irr in range(first, last+1):
+            for f in ["dynmat.{0}.{1}.xml", "elph.{0}.{1}.xml"]:
+                src = wd.file(save, f.format(q, irr))
+                if os.path.isfile(src): shutil.copy2(src, wd.file(PHSAVE, f.format(q, irr)))
+
+    # Record how long each irrep took (sharing the
+    # time between the irreps by their dimension)
+    if already_done: return
+    with lock:
+        for irr, d in zip(range(first, last+1), dims):
+            timings["{0}.{1}".format(q, irr)] = {
+                "seconds" : elapsed*cores*d/float(sum(dims)), "dim" : d, "cores" : cores}
+        tmp = wd.file("{0}.{1}.tmp".format(IRREP_TIMINGS_FILE, os.getpid()))
+        with open(tmp, "w") as f:
+            json.dump(timings, f, indent=1, sort_keys=True)
+        os.rename(tmp, wd.file(IRREP_TIMINGS_FILE))
+
+def run_irrep_groups(groups, parameters, dry, cores=None):
+
+    # Run the irrep groups, irrep_parallel_groups at a time, each on
+    # an equal share of the cores (any cores left over go to the first
+    # groups to start) and in their own directory (the
+    # results are copied back for elph_collect, as in the q.e GRID
+    # example). Groups are started in order of decreasing cost
+    # (longest processing time first), estimated from the measured
+    # timings of previous runs and the dimension of each irrep.
+    if cores is None: cores = parameters["nodes"]*parameters["cores_per_node"]
+    parallel = max(1, min(parameters["irrep_parallel_groups"], len(groups), cores))
+    timings  = load_irrep_timings(work_dir(parameters))
+    lock     = threading.Lock()
+
+    costs  = dict((g[0], irrep_group_cost(g, timings)) for g in groups)
+    groups = sorted(groups, key=lambda g : -costs[g[0]])
+
+    log = parameters["out_file"].write
+    log("Running {0} irrep groups, {1} at a time on {2}-{3} cores each\n".format(
+        len(groups), parallel, cores//parallel, -(-cores//parallel)))
+    for g in groups:
+        log("    {0} : q-point {1}, irreps {2}-{3}, dimensions {4}, cost {5:.3g}\n".format(
+            g[0], g[1], g[2], g[3], g[4], costs[g[0]]))
+
+    if parallel == 1:
+        for g in groups:
+            run_irrep_group(g, parameters, dry, cores, None, timings, lock)
+        return
+
+    # The cores are split into a slot (a disjoint set of cores, that
+    # the group is pinned to) for each running group. Each worker takes
+    # the next group and the largest free slot together, so that the
+    # costliest groups get the cores left over.
+    available = launch.node_cores(parameters)[:cores] if parameters["nodes"] == 1 else list(range(cores))
+    pending   = list(groups)
+    slots     = []
+    for i in range(parallel):
+        size = cores//parallel + (1 if i < cores % parallel else 0)
+        slots.append(available[sum(len(s) for s in slots):][:size])
+    claim = threading.Lock()
+
+    def worker(i):
+        c = None
+        while True:
+            with claim:
+                if not c is None: slots.append(c)
+                if len(pending) == 0: return
+                g = pending.pop(0)
+                c = max(slots, key=len)
+                slots.remove(c)
+            local = type(parameters)(parameters)
+            launch.pin_cores(local, c, available)
+            directory = os.path.join("irrep_groups", g[0])
+            run_irrep_group(g, local, dry, len(c), directory, timings, lock)
+
+    pool = ThreadPool(parallel)
+    try: pool.map(worker, range(parallel), chunksize=1)
+    finally: pool.close()
+
+# A stage that creates an input file, then runs a q.e program on it
+def qe_stage(exe, file_prefix, create_in):
+    def run_stage(parameters, dry, cores=None):
+        create_in(parameters)
+        run_qe(exe, file_prefix, parameters, dry=dry, cores=cores)
+    return run_stage
+
+# The expected cost of each stage, relative to the others, used to split
+# the cores between stages that run at the same time (until the stages
+# have been timed, at which point their measured timings are used)
+STAGE_COSTS = {
+    "relax"    : 10.0,
+    "scf"      : 4.0,
+    "elph"     : 50.0,
+    "q2r"      : 0.1,
+    "ph_dos"   : 1.0,
+    "ph_bands" : 0.5,
+    "bands"    : 4.0,
+    "bands.x"  : 0.1,
+}
+
+def pipeline_stages():
+
+    # The stages of a calculation, along with the decks that
+    # determine their results and their cost (see workflow.py)
+    phonons   = lambda p : not p["relax_only"]
+    band_path = lambda p : phonons(p) and "bz_path" in p
+    stages = [
+        Stage("relax", [], run_relax_stage,
+            decks   = lambda p : relax_input(p).text(),
+            outputs = ["relax.out"],
+            apply   = apply_relax_results),
+
+        Stage("scf", ["relax"], qe_stage("pw.x", "scf", create_scf_in),
+            decks   = lambda p : scf_input(p).text(),
+            outputs = ["scf.out"],
+            when    = phonons),
+
+        Stage("elph", ["scf"], run_elph_stage,
+            decks   = lambda p : elph_input(p).text() + "irrep_group_size={0}".format(p["irrep_group_size"]),
+            outputs = ["elph_*.out", "irrep_groups", "_ph0"],
+            when    = phonons),
+
+        # Convert dynamcial matricies etc to real space
+        Stage("q2r", ["elph"], qe_stage("q2r.x", "q2r", create_q2r_in),
+            decks   = lambda p : q2r_input(p).text(),
+            outputs = ["q2r.out"],
+            when    = phonons),
+
+        # Caclulate the phonon density of states
+        Stage("ph_dos", ["q2r"], qe_stage("matdyn.x", "ph_dos", create_ph_dos_in),
+            decks   = lambda p : ph_dos_input(p).text(),
+            outputs = ["ph_dos.out"],
+            when    = phonons),
+
+        # Caclulate the phonon bandstructure
+        Stage("ph_bands", ["q2r"], qe_stage("matdyn.x", "ph_bands", create_ph_bands_in),
+            decks   = lambda p : ph_bands_input(p, get_bz_path(p)[0]).text(),
+            outputs = ["ph_bands.out"],
+            when    = band_path),
+
+        # Caculate the electronic bandstructure (after the phonons,
+        # because pw.x rewrites the save directory that ph.x reads)
+        Stage("bands", ["scf", "elph"], qe_stage("pw.x", "bands", create_bands_in),
+            decks   = lambda p : bands_input(p, get_bz_path(p)[0]).text(),
+            outputs = ["bands.out"],
+            when    = band_path),
 
         # Re-order bands and calc band-related things
-        create_bands_x_in(parameters)
-        run_qe("bands.x", "bands.x", parameters, dry=dry)
+        Stage("bands.x", ["bands"], qe_stage("bands.x", "bands.x", create_bands_x_in),
+            decks   = lambda p : bands_x_input(p).text(),
+            outputs = ["bands.x.out"],
+            when    = band_path),
+    ]
+
+    for s in stages:
+        s.cost = STAGE_COSTS[s.name]
+    return stages
 
-def is_run_complete():
+def prepare_parameters(parameters, aux_kpts=False):
 
-    # Checks to see if a run is complete by
-    # checking the last calculation is done
-    if not os.path.isfile("extract_evals.out"):
-        return False
-    with open("extract_evals.out") as f:
-        return "JOB DONE" in f.read()
+    # Run with the auxilliary kpt grid
+    if aux_kpts:
+        if "out_file" in parameters:
+            parameters["out_file"].write("Running auxillary kpoint grid...\n")
+        parameters["kpts_per_qpt"] = parameters["aux_kpts"]
+
+    # Reduce to primitive description (which
+    # also works out the k-point/q-point grids)
+    return reduce_to_primitive(parameters)
+
+def run(parameters, dry=False, aux_kpts=False):
+
+    # Everything is run in the working directory
+    # (by default, the current directory)
+    wd = work_dir(parameters)
+    parameters["work_dir"] = wd
+
+    # Open the output file
+    parameters["out_file"] = wd.open("run.out","w",1)
+    parameters["out_file"].write("Dryrun   : {0}\n".format(dry))
+    parameters["out_file"].write("Aux kpts : {0}\n".format(aux_kpts))
+    max_l = str(max([len(p) for p in parameters]))
+    for p in parameters:
+        fs = "{0:"+max_l+"."+max_l+"} : {1}\n"
+        parameters["out_file"].write(fs.format(p, parameters[p]))
+
+    # Work out the geometry and grids to run with, and identify
+    # the calculation that is actually run by its digest
+    parameters = prepare_parameters(parameters, aux_kpts)
+    if isinstance(parameters, Parameters):
+        parameters["out_file"].write("Digest   : {0}\n".format(parameters.digest()))
+    
+    # Record a timeline of the run, if requested
+    if parameters["trace"]:
+        parameters["tracer"] = trace.Tracer(wd.file(trace.TRACE_FILE), wd.path)
+        parameters["out_file"].write("Writing trace to {0}\n".format(wd.file(trace.TRACE_FILE)))
+
+    # Run the stages of the calculation, skipping
+    # those that have already been completed
+    try:
+        Workflow(pipeline_stages(), state_file=wd.file("run_state.json")).run(parameters, dry=dry)
+    finally:
+        if not parameters.get("tracer") is None: parameters["tracer"].close()
+
+    # Summarise where the time went in each stage
+    if not dry: write_timing_report(wd.path)
+
+def timing_category(routine):
+
+    # Attribute a q.e timer to FFTs, I/O or communication.
+    # Note that q.e timers are nested (e.g fft_scatt_xy is
+    # called within fftw) so categories can overlap
+    r = routine.lower()
+    if r.startswith("fft_scat") or r.startswith("mp_") or r in ["reduce", "alltoall"]:
+        return "communication"
+    if r.startswith("fft") or r.startswith("invfft"):
+        return "fft"
+    if r in ["davcio", "read_rec", "write_rec", "openfil", "closefil"]:
+        return "io"
+    return "other"
+
+def collect_timings(directory="."):
+
+    # Collect the clock reports from the outputs of all of the stages
+    # in the given directory, and of the irrep groups run in their own
+    # directories (keyed by group name), adding the wall time spent
+    # in each timing category
+    wd      = WorkDir(directory)
+    outputs = [[f[:-4], f] for f in wd.glob("*.out") if f != "run.out"]
+    for f in wd.glob(os.path.join("irrep_groups", "*", "*.out")):
+        group = os.path.basename(os.path.dirname(f))
+        if os.path.basename(f) == group+".out": outputs.append([group, f])
+
+    timings = {}
+    for name, f in outputs:
+        report = parse_clock_report(wd.file(f))
+        if report["wall"] is None and len(report["routines"]) == 0: continue
+
+        cats = {"fft" : 0.0, "io" : 0.0, "communication" : 0.0}
+        for r in report["routines"]:
+            c = timing_category(r)
+            if c in cats: cats[c] += report["routines"][r]["wall"]
+        report["categories"] = cats
+        timings[name] = report
+
+    return timings
+
+def write_timing_report(directory=".", filename="timings.out", top=8):
+
+    # Write a summary of the clock reports of every stage in
+    # the given directory, along with the most expensive routines
+    timings = collect_timings(directory)
+
+    fs = "{0:24.24} {1:8.8} {2:>6} {3:>7} {4:>5} {5:>10} {6:>10} {7:>6} {8:>6} {9:>6}\n"
+    t  = fs.format("stage", "program", "ranks", "threads", "pools", 
+                   "cpu (s)", "wall (s)", "fft%", "io%", "comm%")
+
+    tot = {"cpu" : 0.0, "wall" : 0.0, "fft" : 0.0, "io" : 0.0, "communication" : 0.0}
+    for stage in sorted(timings):
+        r    = timings[stage]
+        wall = r["wall"] or sum(x["wall"] for x in r["routines"].values()) or 1.0
+        cpu  = r["cpu"]  or 0.0
+        pct  = lambda c : "{0:.1f}".format(100*r["categories"][c]/wall)
+        t   += fs.format(stage, str(r["program"]), r["mpi_processes"], r["threads"], 
+                r["pools"], "{0:.2f}".format(cpu), "{0:.2f}".format(wall),
+                pct("fft"), pct("io"), pct("communication"))
+        tot["cpu"]  += cpu
+        tot["wall"] += wall
+        for c in r["categories"]:
+            tot[c] += r["categories"][c]
+
+    if tot["wall"] > 0:
+        pct = lambda c : "{0:.1f}".format(100*tot[c]/tot["wall"])
+        t  += fs.format("total", "", "", "", "", "{0:.2f}".format(tot["cpu"]),
+                "{0:.2f}".format(tot["wall"]), pct("fft"), pct("io"), pct("communication"))
+
+    # Most expensive routines in each stage
+    for stage in sorted(timings):
+        routines = timings[stage]["routines"]
+        t += "\n{0}\n".format(stage)
+        for name in sorted(routines, key=lambda n : -routines[n]["wall"])[0:top]:
+            r  = routines[name]
+            t += "    {0:16.16} {1:>12.2f}s CPU {2:>12.2f}s WALL {3:>10} calls\n".format(
+                name, r["cpu"], r["wall"], r["calls"])
+
+    with open(os.path.join(directory, filename), "w") as f:
+        f.write(t)
+
+    return timings
+
+def is_run_complete(parameters, directory="."):
+
+    # Checks to see if a run is complete, i.e its workflow finished
+    # with every stage that applied to it (which depends on the
+    # prepared parameters, so is recorded by the run) done
+    state = os.path.join(directory, "run_state.json")
+    return Workflow(pipeline_stages(), state_file=state).complete()
 
 def run_dir(directory, infile, dry, aux_kpts):
     
     # Run the calculation in the given directory,
-    # with the given input file
-    os.chdir(directory)
-    params = read_parameters(infile)
+    # with the given input file (in that directory)
+    params = read_parameters(os.path.join(directory, infile))
+    params["work_dir"] = WorkDir(directory)
     run(params, dry=dry, aux_kpts=aux_kpts)
 
+# The command used to submit jobs to SLURM (which can be
+# replaced, e.g by a fake sbatch for testing, by setting
+# the QE_TOOLS_SBATCH environment variable)
+def sbatch_command():
+    return os.environ.get("QE_TOOLS_SBATCH", "sbatch")
+
+# Write the SLURM submission script for the given submission
+# system (e.g csd3_sl3) into the given directory, filled in
+# with the core/node count of the given parameters, returning
+# the name of the script
+def slurm_script(submit, params, directory, array=None):
+
+    # Choose service level
+    sub_file = "slurm_submit_csd3_sl4"
+    if "sl3" in submit:
+        sub_file = "slurm_submit_csd3_sl3"
+
+    # Copy the slurm submission script
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(script_dir, sub_file)) as f:
+        sub_text = f.read()
+
+    cores_total = params["cores_per_node"]*params["nodes"]
+    sub_text = sub_text.format(
+        nodes=params["nodes"],
+        cores_total=cores_total,
+        ranks_total=launch.ranks(params, cores_total),
+        threads_per_rank=params["threads_per_rank"]
+        )
+
+    # Run each task of a job array with its index
+    if not array is None:
+        sub_text = sub_text.replace("#SBATCH -J", "#SBATCH --array={0}\n#SBATCH -J".format(array), 1)
+        sub_text = sub_text.replace('CMD="python2.7 run.py"', 'CMD="python2.7 run.py $SLURM_ARRAY_TASK_ID"')
+
+    with open(os.path.join(directory, sub_file), "w") as f:
+        f.write(sub_text)
+
+    return sub_file
+
 def submit_calc(directory, infile, submit, dry, aux_kpts):
     
     # Submit the calculation in the given directory
-    os.chdir(directory)
-    params = read_parameters(infile)
+    params = read_parameters(os.path.join(directory, infile))
+    params["work_dir"] = WorkDir(directory)
 
     if submit is None:
 
@@ -825,28 +1386,9 @@ def submit_calc(directory, infile, submit, dry, aux_kpts):
         run(params, dry=dry, aux_kpts=aux_kpts)
 
     elif submit.startswith("csd3"):
-        
-        # Choose service level
-        sub_file = "slurm_submit_csd3_sl4"
-        if "sl3" in submit:
-            sub_file = "slurm_submit_csd3_sl3"
-
-        # Submit the calculation to CSD3 via SLURM
-        script_dir = os.path.realpath(__file__)
-        script_dir = "/".join(script_dir.split("/")[0:-1])
-
-        # Copy the slurm submission script
-        sub_script = script_dir+"/"+sub_file
-        with open(sub_script) as f:
-            sub_text = f.read()
 
         # Create the submission script with the given core/node count
-        with open(directory+"/"+sub_file, "w") as f:
-            cores_total = params["cores_per_node"]*params["nodes"]
-            f.write(sub_text.format(
-                nodes=params["nodes"],
-                cores_total=cores_total
-                ))
+        sub_file = slurm_script(submit, params, directory)
 
         # Create the python runscript
         r  = "from quantum_espresso_tools.superconductivity.calculate import run_dir\n"
@@ -855,13 +1397,27 @@ def submit_calc(directory, infile, submit, dry, aux_kpts):
             f.write(r)
 
         # If is a dry run, simply run it, otherwise submit it
-        if dry: os.system("python2.7 run.py")
+        metrics_file = os.path.join(directory, runner.METRICS_FILE)
+        if dry:
+            runner.run_checked(["python2.7", "run.py"], cwd=directory,
+                metrics_file=metrics_file, extra={"stage" : "run.py"})
         else:
-            if is_run_complete():
+            if is_run_complete(params, directory):
                 print("{0} already complete, refusing to submit.".format(directory))
             else:
                 print("Submitting {0}".format(directory))
-                os.system("sbatch "+sub_file)
+                runner.run_checked(sbatch_command().split() + [sub_file], cwd=directory,
+                    metrics_file=metrics_file, extra={"stage" : "sbatch"})
+    elif submit == "farm":
+
+        # Add the calculation to the task farm queue
+        from quantum_espresso_tools.superconductivity import farm
+        if is_run_complete(params, directory):
+            print("{0} already complete, refusing to queue.".format(directory))
+        else:
+            print("Queueing {0}".format(directory))
+            farm.add_task(farm.default_queue(os.path.dirname(directory)), directory, infile, aux_kpts)
+
     else:
         print("Unkown submission system: "+submit)
 
@@ -870,17 +1426,22 @@ def calculate(infile, dry=False, submit=None):
     # Base directory and auxillary k-point directory
     base_dir    = os.getcwd()
     params      = read_parameters(infile)
+
+    # Sweeps are expanded into a calculation for each point
+    if len(params["sweep"]) > 0:
+        from quantum_espresso_tools.superconductivity.sweep import calculate_sweep
+        return calculate_sweep(infile, dry=dry, submit=submit)
     
     if not params["aux_kpts"] is None:
         # Run auxilliary k-point grid
         # (do this first because it's faster)
         aux_dir = base_dir + "/aux_kpts"
-        os.system("mkdir " + aux_dir + " 2>/dev/null")
-        os.system("cp "    + infile  + " " + aux_dir)
+        if not os.path.isdir(aux_dir): os.makedirs(aux_dir)
+        shutil.copy(infile, aux_dir)
         submit_calc(aux_dir, infile, submit, dry, True)
 
     # Run normal k-point grid
     primary_dir = base_dir + "/primary_kpts"
-    os.system("mkdir " + primary_dir  + " 2>/dev/null")
-    os.system("cp "    + infile + " " + primary_dir)
+    if not os.path.isdir(primary_dir): os.makedirs(primary_dir)
+    shutil.copy(infile, primary_dir)
     submit_calc(primary_dir, infile, submit, dry, False)
@@ -2,38 +2,18 @@ import os
 import sys
 import numpy as np
 import matplotlib.pyplot as plt
+from quantum_espresso_tools import parser
 
 plt.rc("text", usetex=True)
 plt.rc("font", size=20)
 
-with open("extract_evals.in","w") as f:
-    f.write("&BANDS\n")
-    f.write("outdir='.',\n")
-    f.write("filband='extracted_evals.out',\n")
-    f.write("lsym=.false.\n")
-    f.write("/\n")
-
-os.system("bands.x < extract_evals.in > extract_evals.out")
-
-with open("scf.out") as f:
-    for l in f.read().split("\n"):
-        if "Fermi energy is" in l:
-            fermi_energy = float(l.split()[-2])
-
-with open("extracted_evals.out") as f:
-    lines = f.read().split("\n")
-
-evals = []
-for l in lines:
-    if len(l.split()) == 3:
-        continue
-    try:
-        evals.extend([float(w) for w in l.split()])
-    except:
-        continue
+# The eigenvalues are read directly from the scf output
+# (which requires verbosity='high' for more than 100 k-points)
+scf          = parser.parse_scf_out("scf.out")
+fermi_energy = scf["fermi_energy"]
 
 RY_TO_EV  = 13.605698065893753
-evals     = np.array(evals) - fermi_energy
+evals     = scf["eigenvalues"].flatten() - fermi_energy
 evals_sq  = evals**2
 evals_abs = abs(evals)
 evals_abs_sorted = np.array(sorted(evals_abs))
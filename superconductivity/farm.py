@@ -0,0 +1,257 @@
+from quantum_espresso_tools.superconductivity.calculate import read_parameters, run
+from quantum_espresso_tools.superconductivity.workdir import WorkDir
+import multiprocessing
+import subprocess
+import sqlite3
+import socket
+import errno
+import time
+import sys
+import os
+
+# A task farm, for running many calculations that each need only a few
+# cores inside a single allocation (or on a workstation). Calculations
+# are added to a queue (an SQLite database, so that it can be shared
+# between several farms and added to while they are running), e.g with
+# calculate(infile, submit="farm"). A farm, started with run_farm, packs
+# the queued calculations onto its cores (the largest that fits first),
+# runs each in its own subprocess on the cores it asked for
+# (nodes*cores_per_node of its parameters), pinned to its own range of
+# the farm's cores, and starts the next as soon as one finishes. The time each calculation took is recorded in the
+# queue, so that the farm's core utilisation can be reported.
+#
+# A farm records a heartbeat against the tasks it is running. Tasks left
+# running by a farm that has died (its process is gone, or its heartbeat
+# has stopped) are put back in the queue, as are failed tasks, until
+# they have been tried max_attempts times. A farm only stops once no
+# task is queued or running (in any farm), as running tasks may yet be
+# requeued.
+
+# How often (in seconds) a farm updates the heartbeat of its tasks
+HEARTBEAT_INTERVAL = 30.0
+
+# A running task whose heartbeat is older than this (in seconds)
+# belongs to a farm that has died
+HEARTBEAT_STALE = 300.0
+
+# How often (in seconds) a farm checks for finished tasks
+# and, when it is idle, for tasks that have been requeued
+POLL_INTERVAL = 1.0
+
+# The number of times a task is tried before it is left as failed
+MAX_ATTEMPTS = 3
+
+# The queue used by calculate(infile, submit="farm"); either the
+# QE_TOOLS_FARM environment variable or farm.db in the given directory
+def default_queue(directory):
+    return os.environ.get("QE_TOOLS_FARM", os.path.join(directory, "farm.db"))
+
+def connect(queue):
+
+    db = sqlite3.connect(queue, timeout=60, isolation_level=None)
+    db.execute("""CREATE TABLE IF NOT EXISTS tasks (
+        id        INTEGER PRIMARY KEY,
+        directory TEXT, infile TEXT, aux_kpts INTEGER, cores INTEGER,
+        status    TEXT, host TEXT, pid INTEGER, returncode INTEGER,
+        queued    REAL, started REAL, finished REAL, elapsed REAL,
+        heartbeat REAL, attempts INTEGER DEFAULT 0)""")
+
+    # Queues created before heartbeats and retries
+    columns = [c[1] for c in db.execute("PRAGMA table_info(tasks)")]
+    if not "heartbeat" in columns: db.execute("ALTER TABLE tasks ADD COLUMN heartbeat REAL")
+    if not "attempts"  in columns: db.execute("ALTER TABLE tasks ADD COLUMN attempts INTEGER DEFAULT 0")
+    return db
+
+# Returns True if the process with the given pid is running on this host
+def process_alive(pid):
+    try: os.kill(pid, 0)
+    except OSError as e: return e.errno == errno.EPERM
+    return True
+
+# Put tasks left running by farms that have died back in the queue
+# (a farm on this host whose process has gone, or any farm whose
+# heartbeat has stopped), returning the number of tasks requeued
+def requeue_orphans(db):
+
+    now  = time.time()
+    host = socket.gethostname()
+    db.execute("BEGIN IMMEDIATE")
+    orphans = []
+    for tid, h, pid, beat in db.execute("""SELECT id, host, pid, heartbeat
+        FROM tasks WHERE status='running'""").fetchall():
+        if (h == host and not process_alive(pid)) or (beat or 0) < now - HEARTBEAT_STALE:
+            orphans.append(tid)
+    for tid in orphans:
+        db.execute("""UPDATE tasks SET status='queued', host=NULL, pid=NULL,
+            started=NULL, heartbeat=NULL WHERE id=?""", (tid,))
+    db.execute("COMMIT")
+    return len(orphans)
+
+# The number of tasks that are queued or running (in any farm)
+def pending_tasks(db):
+    return db.execute("""SELECT COUNT(*) FROM tasks
+        WHERE status IN ('queued', 'running')""").fetchone()[0]
+
+# Add the calculation in the given directory to the queue (unless it
+# is already waiting or running), to be run on the given number of
+# cores (by default, nodes*cores_per_node from its parameters)
+def add_task(queue, directory, infile, aux_kpts=False, cores=None):
+
+    directory = os.path.abspath(directory)
+    if cores is None:
+        params = read_parameters(os.path.join(directory, infile))
+        cores  = params["nodes"]*params["cores_per_node"]
+
+    db = connect(queue)
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        waiting = db.execute("""SELECT id FROM tasks WHERE directory=? AND aux_kpts=?
+            AND status IN ('queued', 'running')""", (directory, int(aux_kpts))).fetchone()
+        if waiting is None:
+            db.execute("""INSERT INTO tasks (directory, infile, aux_kpts, cores, status, queued)
+                VALUES (?, ?, ?, ?, 'queued', ?)""", (directory, infile, int(aux_kpts), cores, time.time()))
+        db.execute("COMMIT")
+    finally:
+        db.close()
+
+# Claim the largest queued task that fits in the given number of free
+# cores (out of the given total, so that tasks that want more cores
+# than the farm has are run on all of them), returning None if none fit
+def claim_task(db, free, total):
+
+    db.execute("BEGIN IMMEDIATE")
+    task = db.execute("""SELECT id, directory, infile, aux_kpts, MIN(cores, ?) AS c FROM tasks
+        WHERE status='queued' AND MIN(cores, ?) <= ? ORDER BY c DESC, id LIMIT 1""",
+        (total, total, free)).fetchone()
+    if not task is None:
+        now = time.time()
+        db.execute("""UPDATE tasks SET status='running', host=?, pid=?, started=?, heartbeat=?,
+            attempts=COALESCE(attempts, 0)+1 WHERE id=?""",
+            (socket.gethostname(), os.getpid(), now, now, task[0]))
+    db.execute("COMMIT")
+    return task
+
+# Run the queued calculations on the given number of cores (by default,
+# all of the cores on this machine) until no task is queued or running,
+# trying each task up to max_attempts times
+def run_farm(queue, cores=None, dry=False, max_attempts=MAX_ATTEMPTS):
+
+    if cores is None: cores = multiprocessing.cpu_count()
+    db      = connect(queue)
+    running = {}
+    free    = list(range(cores))
+    start   = time.time()
+    beat    = start
+    print("Task farm on {0} cores, running tasks from {1}".format(cores, queue))
+
+    n = requeue_orphans(db)
+    if n > 0: print("Requeued {0} tasks left running by farms that have died".format(n))
+
+    try:
+        while True:
+
+            # Fill the free cores, giving each task its own cores
+            while len(free) > 0:
+                task = claim_task(db, len(free), cores)
+                if task is None: break
+                tid, directory, infile, aux_kpts, c = task
+                cpus = free[:c]
+                del free[:c]
+                proc = start_task(directory, infile, bool(aux_kpts), c, dry, cpus)
+                running[proc.pid] = [tid, cpus, proc]
+                print("Started {0} on {1} cores ({2} free)".format(directory, c, len(free)))
+
+            # Nothing to run here; stop if nothing is left
+            # anywhere, otherwise wait for tasks to be requeued
+            if len(running) == 0:
+                if pending_tasks(db) == 0: break
+                time.sleep(POLL_INTERVAL)
+                requeue_orphans(db)
+                continue
+
+            # Keep the heartbeat of our tasks going
+            if time.time() - beat > HEARTBEAT_INTERVAL:
+                beat = time.time()
+                tids = [r[0] for r in running.values()]
+                db.execute("UPDATE tasks SET heartbeat=? WHERE id IN ({0})".format(
+                    ",".join("?"*len(tids))), [beat] + tids)
+
+            # Collect any tasks that have finished
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(POLL_INTERVAL)
+                continue
+            if not pid in running: continue
+            tid, cpus, proc = running.pop(pid)
+            free = sorted(free + cpus)
+            proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            finish_task(db, tid, proc.returncode, max_attempts)
+
+    finally:
+        db.close()
+
+    print("Task farm finished after {0:.1f}s".format(time.time() - start))
+    farm_report(queue, cores)
+
+# Start the calculation in the given directory on the given
+# number of cores (pinned to the given cores), in a subprocess
+def start_task(directory, infile, aux_kpts, cores, dry=False, cpus=None):
+
+    code  = "from quantum_espresso_tools.superconductivity.farm import run_task\n"
+    code += "run_task({0!r}, {1!r}, {2}, {3}, {4}, {5!r})".format(directory, infile, aux_kpts, cores, dry, cpus)
+    with open(os.path.join(directory, "farm_task.log"), "a") as log:
+        return subprocess.Popen([sys.executable, "-c", code], cwd=directory,
+            stdout=log, stderr=subprocess.STDOUT)
+
+# Record the result of a task; a failed task is put back in
+# the queue unless it has already been tried max_attempts times
+def finish_task(db, tid, returncode, max_attempts=MAX_ATTEMPTS):
+
+    finished = time.time()
+    db.execute("BEGIN IMMEDIATE")
+    attempts = db.execute("SELECT attempts FROM tasks WHERE id=?", (tid,)).fetchone()[0] or 0
+    if returncode == 0: status = "done"
+    elif attempts < max_attempts: status = "queued"
+    else: status = "failed"
+    db.execute("""UPDATE tasks SET status=?, returncode=?, finished=?, elapsed=?-started
+        WHERE id=?""", (status, returncode, finished, finished, tid))
+    db.execute("COMMIT")
+    if status == "queued":
+        print("Task {0} failed (attempt {1} of {2}), requeued".format(tid, attempts, max_attempts))
+
+# Run a single calculation of the farm (in its subprocess), with its
+# parameters overriden to run on the given number of cores (pinned to
+# the given cores, so that it doesn't share cores with other tasks)
+def run_task(directory, infile, aux_kpts, cores, dry=False, cpus=None):
+
+    params = read_parameters(os.path.join(directory, infile))
+    params["work_dir"]       = WorkDir(directory)
+    params["nodes"]          = 1
+    params["cores_per_node"] = cores
+    params["cpu_list"]       = cpus
+    run(params, dry=dry, aux_kpts=aux_kpts)
+
+# Print the time taken by each task in the queue and, given the
+# number of cores of the farm, the fraction of core-time used
+def farm_report(queue, cores=None):
+
+    db = connect(queue)
+    try:
+        tasks = db.execute("""SELECT directory, aux_kpts, cores, status, started, finished, elapsed
+            FROM tasks ORDER BY id""").fetchall()
+    finally:
+        db.close()
+
+    fs = "{0:>8} {1:>6} {2:>10}  {3}"
+    print(fs.format("status", "cores", "elapsed/s", "directory"))
+    for directory, aux_kpts, c, status, started, finished, elapsed in tasks:
+        e = "" if elapsed is None else "{0:.1f}".format(elapsed)
+        print(fs.format(status, c, e, directory))
+
+    done = [t for t in tasks if not t[6] is None]
+    if cores is None or len(done) == 0: return
+    used = sum(min(t[2], cores)*t[6] for t in done)
+    wall = max(t[5] for t in done) - min(t[4] for t in done)
+    if wall > 0:
+        print("Core utilisation: {0:.1f}% of {1} cores over {2:.1f}s".format(
+            100.0*used/(wall*cores), cores, wall))
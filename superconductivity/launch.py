@@ -0,0 +1,188 @@
+from quantum_espresso_tools.superconductivity import runner
+import threading
+import tempfile
+import shutil
+import os
+
+# Builds the command used to launch a q.e executable on a number of
+# cores, with the launcher (the mpirun parameter) being one of
+#   mpirun : mpirun/mpiexec of Intel MPI, MPICH or OpenMPI (which take
+#            different placement and binding options, so the
+#            implementation is identified from mpirun --version)
+#   aprun  : Cray ALPS
+#   srun   : SLURM (launched directly, from inside an allocation)
+#   local  : no MPI at all; the executable is run as a single rank
+#            (useful for testing on a workstation)
+# Each rank runs threads_per_rank OpenMP threads, so that a run on
+# a given number of cores uses cores/threads_per_rank MPI ranks.
+# Ranks are placed ranks_per_node to a node (by default, as many as
+# fit in cores_per_node) and bound to hardware according to cpu_bind
+#   none    : no binding
+#   cores   : each thread bound to a core
+#   threads : each thread bound to a hardware thread
+#   sockets : each rank bound to a socket
+#
+# A run that shares a node with other runs at the same time (workflow
+# stages, irrep groups or task farm calculations) is given its own list
+# of cores of the node (the cpu_list parameter, set with pin_cores) and
+# its ranks are pinned to those, rather than every run binding from the
+# first core of the node. Under srun, SLURM places each step on its own
+# cores itself (given --exact). A run that shares several nodes can't
+# be placed on particular cores of each, so is not bound at all.
+
+LAUNCHERS = ["mpirun", "aprun", "srun", "local"]
+CPU_BINDINGS = ["none", "cores", "threads", "sockets"]
+
+# The launcher named by the given mpirun parameter (which
+# can be a path to, or a command line for, the launcher)
+def launcher(mpirun):
+
+    words = mpirun.split()
+    name  = os.path.basename(words[0]) if len(words) > 0 else "local"
+    if name.startswith("mpiexec"): return "mpirun"
+    for l in LAUNCHERS:
+        if name.startswith(l): return l
+    raise ValueError("Unkown mpirun = {0}".format(mpirun))
+
+# MPI implementations that have already been identified, keyed by mpirun command
+implementations      = {}
+implementations_lock = threading.Lock()
+
+# Time allowed for mpirun to report its version
+VERSION_TIMEOUT = 30
+
+# The MPI implementation ("intel", "mpich" or "openmpi") of the given
+# mpirun command, from its --version output. Runs are launched as for
+# Intel MPI if the implementation can't be identified.
+def mpi_implementation(mpirun):
+
+    with implementations_lock:
+        if mpirun in implementations: return implementations[mpirun]
+
+    scratch = tempfile.mkdtemp(prefix="mpi_version_")
+    text    = ""
+    try:
+        runner.run_command(mpirun.split() + ["--version"], cwd=scratch, stdin=os.devnull,
+            stdout="version.out", timeout=VERSION_TIMEOUT)
+        with open(os.path.join(scratch, "version.out")) as f:
+            text = f.read().lower()
+    except (IOError, OSError):
+        pass
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if "open mpi" in text or "openrte" in text: impl = "openmpi"
+    elif "intel" in text: impl = "intel"
+    elif "mpich" in text or "hydra" in text: impl = "mpich"
+    else: impl = "intel"
+
+    with implementations_lock:
+        implementations[mpirun] = impl
+    return impl
+
+# The number of MPI ranks used to run on the given number of cores
+def ranks(parameters, cores):
+    if launcher(parameters["mpirun"]) == "local": return 1
+    return max(1, cores//parameters["threads_per_rank"])
+
+def ranks_per_node(parameters, cores):
+    rpn = parameters["ranks_per_node"]
+    if rpn <= 0: rpn = max(1, parameters["cores_per_node"]//parameters["threads_per_rank"])
+    return min(rpn, ranks(parameters, cores))
+
+# The cores of the node that a run with the given parameters can use;
+# its own cpu_list if it has one, otherwise every core of the node
+def node_cores(parameters):
+    cpus = parameters.get("cpu_list")
+    if cpus is None: return list(range(parameters["cores_per_node"]))
+    return list(cpus)
+
+# Pin a run (with parameters local, its own copy of the parameters) to
+# the given cores, out of the cores available, which are indices of the
+# cores of the node (for a single node) or just count the cores (across
+# several nodes, in which case the run isn't bound). A run given every
+# core available is left as it is.
+def pin_cores(local, cpus, available):
+    if len(cpus) >= len(available): return
+    local["cpu_list"] = list(cpus)
+    if local["nodes"] > 1: local["cpu_bind"] = "none"
+
+# The environment variables controlling the OpenMP threads of each rank
+def launch_environment(parameters):
+
+    env  = {"OMP_NUM_THREADS" : str(parameters["threads_per_rank"])}
+    bind = parameters["cpu_bind"]
+    if bind != "none":
+        env["OMP_PROC_BIND"] = "close"
+        env["OMP_PLACES"]    = bind
+    return env
+
+# The command (launcher and its arguments, as a list) that precedes
+# the executable when running on the given number of cores, along
+# with the environment variables it should be run with
+def launch_command(parameters, cores):
+
+    mpirun  = parameters["mpirun"]
+    kind    = launcher(mpirun)
+    n       = ranks(parameters, cores)
+    rpn     = ranks_per_node(parameters, cores)
+    threads = parameters["threads_per_rank"]
+    bind    = parameters["cpu_bind"]
+    env     = launch_environment(parameters)
+
+    # The cores that the threads of each rank are pinned to (if
+    # the run has been given cores of its own and is bound)
+    cpus  = parameters.get("cpu_list")
+    pins  = None
+    if not cpus is None and bind != "none":
+        cpus = cpus[:cores]
+        pins = [cpus[i*threads:(i+1)*threads] for i in range(n)] if kind != "local" else [cpus]
+    join = lambda cs : ",".join(str(c) for c in cs)
+
+    if kind == "mpirun":
+        impl = mpi_implementation(mpirun)
+        args = mpirun.split() + ["-np", str(n)]
+
+        if impl == "openmpi":
+            pe = ":PE={0}".format(threads) if bind in ["cores", "threads"] else ""
+            if parameters["ranks_per_node"] > 0: args += ["--map-by", "ppr:{0}:node{1}".format(rpn, pe)]
+            elif pe: args += ["--map-by", "slot"+pe]
+            if bind == "threads": args += ["--use-hwthread-cpus"]
+            args += ["--bind-to", {"none" : "none", "cores" : "core", "threads" : "hwthread",
+                                   "sockets" : "socket"}[bind]]
+            if not pins is None: args += ["--cpu-set", join(cpus)]
+
+        else:
+            if parameters["ranks_per_node"] > 0: args += ["-ppn", str(rpn)]
+
+            if impl == "mpich" and not pins is None:
+                args += ["-bind-to", "user:" + ",".join(join(p).replace(",", "+") for p in pins)]
+            elif impl == "mpich" and bind != "none":
+                args += ["-bind-to", {"cores" : "core:{0}", "threads" : "hwthread:{0}",
+                                      "sockets" : "socket"}[bind].format(threads)]
+
+            # Intel MPI is bound through its environment, with
+            # explicit (hexadecimal) masks for pinned runs
+            elif impl == "intel" and not pins is None:
+                env["I_MPI_PIN_DOMAIN"] = "[{0}]".format(",".join(
+                    "{0:x}".format(sum(1 << c for c in p)) for p in pins))
+            elif impl == "intel" and bind != "none":
+                env["I_MPI_PIN_DOMAIN"] = "omp" if bind != "sockets" else "socket"
+
+    elif kind == "aprun":
+        cc = {"none" : "none", "cores" : "depth", "threads" : "depth", "sockets" : "numa_node"}[bind]
+        if not pins is None: cc = ":".join(join(p) for p in pins)
+        args = mpirun.split() + ["-n", str(n), "-N", str(rpn), "-d", str(threads), "-cc", cc]
+
+    elif kind == "srun":
+        args = mpirun.split() + ["-n", str(n), "--ntasks-per-node={0}".format(rpn),
+            "--cpus-per-task={0}".format(threads), "--cpu-bind={0}".format(bind)]
+
+        # Steps sharing the allocation only get the cores they ask for
+        # (--exact, SLURM 21.08 onwards), so that they run side by side
+        if not parameters.get("cpu_list") is None: args += ["--exact"]
+
+    else:
+        args = [] if pins is None else ["taskset", "-c", join(cpus)]
+
+    return env, args
@@ -0,0 +1,161 @@
+from quantum_espresso_tools.parser   import parse_run_dimensions
+from quantum_espresso_tools.qe_input import QEInput
+from quantum_espresso_tools.superconductivity.workdir import work_dir
+import numpy as np
+import os
+
+# Works out the q.e parallelization flags for a run on a given number
+# of MPI ranks, from the sizes of the calculation (read from the headers
+# of the outputs of earlier stages, or from the input deck):
+#   -nk : k-point pools; as many as possible, but never more than
+#         the number of irreducible k-points (which leaves pools with
+#         nothing to do), or so many that a pool runs out of memory
+#   -ntg: FFT task groups; used when there are more ranks in a pool
+#         than planes in the FFT grid (which the plane-wave
+#         parallelization can't use)
+#   -nd : linear-algebra (diagonalization) group; parallel
+#         diagonalization only pays off for a large number of bands
+#   -ni : ph.x images, which split the irreps of a run between them;
+#         only used for irrep-group runs, because the results of the
+#         images are only combined by the elph_collect run that follows
+# q2r.x, matdyn.x and bands.x have no k-point parallelism, so get no flags.
+
+# The outputs that the sizes of a calculation are read from, in
+# order of preference (after the output of the run itself)
+DIMENSION_SOURCES = ["scf.out", "relax.out", "elph_prep.out"]
+
+# Parallel diagonalization is only used with at least
+# this many bands per row of the diagonalization grid
+BANDS_PER_DIAG_ROW = 50
+
+# Executables that have pools/task groups/diagonalization groups
+PW_LIKE = ["pw.x", "ph.x"]
+
+def divisors(n):
+    return [d for d in range(1, n+1) if n % d == 0]
+
+# The sizes of the calculation in the given input deck (in the given
+# directory within the working directory wd), from the deck itself and
+# the outputs of this and earlier runs
+def run_dimensions(exe, file_prefix, wd, directory=None):
+
+    path = wd.file(directory or "", file_prefix)
+    dims = {"nks" : None, "nbnd" : None, "fft" : None, "nq" : None, "irreps" : None}
+
+    for f in [path+".out"] + [wd.file(s) for s in DIMENSION_SOURCES]:
+        if not os.path.isfile(f): continue
+        for key, value in parse_run_dimensions(f).items():
+            if dims[key] is None: dims[key] = value
+
+    if not os.path.isfile(path+".in"): return dims
+    inp = QEInput.read(path+".in")
+
+    # An explicit list of k-points (e.g a band structure), or a
+    # k-point grid for which we don't yet know the irreducible
+    # k-points (which is at most the number of grid points)
+    kpts = inp.card("K_POINTS")
+    if not kpts is None and len(kpts.lines) > 0:
+        words = kpts.lines[0].split()
+        if kpts.option == "automatic":
+            if dims["nks"] is None: dims["nks"] = int(np.prod([int(w) for w in words[:3]]))
+        elif exe == "pw.x":
+            dims["nks"] = int(words[0])
+
+    # The irreps of a ph.x irrep-group run
+    ph = inp.find("start_irr")
+    if not ph is None and ph["start_irr"] > 0 and "last_irr" in ph:
+        dims["irreps"] = ph["last_irr"] - ph["start_irr"] + 1
+
+    return dims
+
+# A rough estimate of the memory (bytes) needed by a single pool
+# (the wavefunctions and their workspace, plus the FFT grids)
+def pool_memory(dims):
+    grid = float(np.prod(dims["fft"]))
+    npw  = grid/16.0
+    return 16*(4*npw*dims["nbnd"] + 8*grid)
+
+# Choose the parallelization flags for running exe on the given number
+# of ranks, returning the flags and the reasoning behind them
+def plan_parallelization(exe, cores, dims, memory_per_rank=None):
+
+    reasons = []
+    if not exe in PW_LIKE:
+        reasons.append("{0} has no k-point parallelization, no flags".format(exe))
+        return "", reasons
+
+    flags = []
+
+    # Images (ph.x irrep-group runs only)
+    images = 1
+    irreps = dims.get("irreps")
+    nks    = dims["nks"]
+    if exe == "ph.x" and not irreps is None and irreps > 1:
+        per_pool = cores if nks is None else cores//max(d for d in divisors(cores) if d <= nks)
+        images = max(d for d in divisors(per_pool) if d <= irreps)
+        if images > 1:
+            flags.append("-ni {0}".format(images))
+            reasons.append("{0} images for {1} irreps (ranks left over after the "
+                           "k-point pools)".format(images, irreps))
+    elif exe == "ph.x":
+        reasons.append("no images (only used for irrep-group runs of more than one irrep)")
+    ranks = cores//images
+
+    # Pools
+    if nks is None:
+        pools = ranks
+        reasons.append("number of k-points unknown, one pool per rank")
+    else:
+        pools = max(d for d in divisors(ranks) if d <= nks)
+        reasons.append("{0} pools for {1} k-points on {2} ranks".format(pools, nks, ranks))
+
+        # Fewer pools if a pool doesn't fit in memory
+        if not memory_per_rank is None and not dims["fft"] is None and not dims["nbnd"] is None:
+            mem = pool_memory(dims)
+            while pools > 1 and mem*pools/ranks > memory_per_rank:
+                pools = max(d for d in divisors(ranks) if d < pools)
+            if mem*pools/ranks > memory_per_rank:
+                reasons.append("estimated {0:.2f} GB per rank exceeds the {1:.2f} GB available".format(
+                    mem*pools/ranks/1024**3, memory_per_rank/1024**3))
+            else:
+                reasons.append("{0} pools fit in memory (estimated {1:.2f} GB per rank)".format(
+                    pools, mem*pools/ranks/1024**3))
+    flags.append("-nk {0}".format(pools))
+    per_pool = ranks//pools
+
+    # Task groups
+    ntg = 1
+    if not dims["fft"] is None and per_pool > dims["fft"][2]:
+        ntg = min(d for d in divisors(per_pool) if per_pool//d <= dims["fft"][2])
+        flags.append("-ntg {0}".format(ntg))
+        reasons.append("{0} task groups; {1} ranks per pool but only {2} FFT planes".format(
+            ntg, per_pool, dims["fft"][2]))
+
+    # Diagonalization group (a square number of ranks)
+    if not dims["nbnd"] is None:
+        rows = min(int(np.sqrt(per_pool)), dims["nbnd"]//BANDS_PER_DIAG_ROW)
+        nd   = max(rows, 1)**2
+        flags.append("-nd {0}".format(nd))
+        if nd > 1: reasons.append("{0}x{0} diagonalization group for {1} bands".format(rows, dims["nbnd"]))
+        else: reasons.append("serial diagonalization for {0} bands".format(dims["nbnd"]))
+
+    return " ".join(flags), reasons
+
+# The parallelization flags for running the given input deck
+# on the given number of ranks, logging the reasoning
+def qe_flags(exe, file_prefix, ranks, parameters, directory=None):
+
+    log = parameters["out_file"].write
+    if len(parameters["parallel_flags"]) > 0:
+        log("Using parallelization flags from parameters: {0}\n".format(parameters["parallel_flags"]))
+        return parameters["parallel_flags"]
+
+    # Each rank has the memory of the cores its threads run on
+    memory = parameters["memory_per_core_gb"]*parameters["threads_per_rank"]*1024**3
+    dims   = run_dimensions(exe, file_prefix, work_dir(parameters), directory)
+    flags, reasons = plan_parallelization(exe, ranks, dims, memory if memory > 0 else None)
+
+    # Written at once, as runs can be planned from several threads
+    log("Parallelization for {0} on {1} ranks: {2}\n".format(file_prefix, ranks, flags) +
+        "".join("    {0}\n".format(r) for r in reasons))
+    return flags
@@ -150,7 +150,7 @@ def plot_tc_vs_p_aux_primary(
                 elif filename.endswith("relax.out"):
                     
                     # Parse vc-relax output
-                    relax = parse_vc_relax(filename)
+                    relax = parse_vc_relax(filename, final_only=True)
 
             if relax is None:
                 print("Could not parse relaxation data in "+grid_dir)
@@ -321,7 +321,7 @@ def plot_tc_vs_p(direc,
             print(relax_file+" does not exist, skipping...")
             continue
 
-        relax = parse_vc_relax(relax_file)
+        relax = parse_vc_relax(relax_file, final_only=True)
         pressure = relax["pressure"]
 
         # Check if the a2F.tc file exists
@@ -1,9 +1,12 @@
 import os
 from subprocess import check_output
 from quantum_espresso_tools import parser
+from quantum_espresso_tools.superconductivity.runner import run_checked, METRICS_FILE
 from scipy.optimize import curve_fit
 import numpy as np
 import warnings
+import tempfile
+import shutil
 import traceback
 warnings.filterwarnings("error")
 
@@ -17,7 +20,8 @@ def gap_model(t, tc, gmax):
 
 # Get superconductivity info from eliashhberg function
 # we ignore the portion of a2f where w < 0 (if there is such a region)
-def get_tc_info(omega, a2f, mu, plot_fit=False, plot_errors=False, outf=None):
+# (the resources used by elk are appended to metrics_file, if given)
+def get_tc_info(omega, a2f, mu, plot_fit=False, plot_errors=False, outf=None, metrics_file=None):
 
     # Use elk to solve the eliashberg equations
     # carry out caclulation in temporary directory
@@ -25,18 +29,19 @@ def get_tc_info(omega, a2f, mu, plot_fit=False, plot_errors=False, outf=None):
     elk_base_dir = elk_base_dir.decode("utf-8").replace("/src/elk\n", "")
     species_dir  = elk_base_dir+"/species/"
 
-    # Create temporary directory to run elk in
-    os.system("mkdir tmp_elk 2>/dev/null")
+    # Create a temporary directory to run elk in (of its own,
+    # so that several a2F files can be processed at once)
+    elk_dir = tempfile.mkdtemp(prefix="tmp_elk_")
 
     # Create a2F file
     wa    = [[w, a] for w, a in zip(omega, a2f) if w > 0]
-    with open("tmp_elk/ALPHA2F.OUT", "w") as a2fin:
+    with open(os.path.join(elk_dir, "ALPHA2F.OUT"), "w") as a2fin:
         for w, a in wa:
             w *= 0.5 # Convert Ry to Ha
             a2fin.write("{0} {1}\n".format(w,a))
 
     # Create elk input file
-    elkin = open("tmp_elk/elk.in", "w")
+    elkin = open(os.path.join(elk_dir, "elk.in"), "w")
     elkin.write("tasks\n260\n\nntemp\n20\nmustar\n{0}\n".format(mu))
     elkin.write("\nwplot\n{0} {1} {2}\n-0.5 0.5\n".format(len(wa), 1, 1))
     elkin.write("sppath\n'{0}'\n".format(species_dir))
@@ -47,12 +52,18 @@ def get_tc_info(omega, a2f, mu, plot_fit=False, plot_errors=False, outf=None):
     # Run elk
     if not outf is None:
         outf.write("Solving eliashberg equations with mu = {0} ...\n".format(mu))
-    os.system("cd tmp_elk; elk > /dev/null")
+    try:
+        run_checked(["elk"], cwd=elk_dir, stdout=os.devnull,
+            metrics_file=metrics_file, extra={"stage" : "elk", "mustar" : mu})
+
+        # Read superconducting gap vs temperature from output
+        gapf = open(os.path.join(elk_dir, "ELIASHBERG_GAP_T.OUT"))
+        lines = gapf.read().split("\n")
+        gapf.close()
 
-    # Read superconducting gap vs temperature from output
-    gapf = open("tmp_elk/ELIASHBERG_GAP_T.OUT")
-    lines = gapf.read().split("\n")
-    gapf.close()
+    finally:
+        # Remove temporary directory
+        shutil.rmtree(elk_dir, ignore_errors=True)
 
     ts   = []
     gaps = []
@@ -148,9 +159,6 @@ def get_tc_info(omega, a2f, mu, plot_fit=False, plot_errors=False, outf=None):
     outf.write("    Wrms      {0} Ry \n".format(wrms))
     outf.write("    Wlog/Wrms {0}    \n".format(wlog/wrms))
 
-    # Remove temporary directory
-    os.system("rm -r tmp_elk")
-
     return [tc, lam, wlog, tc_ad]
 
 # List all files in the given folder
@@ -211,7 +219,7 @@ def process_all_a2f(base_dir, overwrite=False, plot_fits=False):
             with open(ftc,"w") as w:
 
                 tc, lam, wlog, tc_ad = get_tc_info(omega, a2fnn, 0.1, 
-                    plot_fit=plot_fits, outf=outf)
+                    plot_fit=plot_fits, outf=outf, metrics_file=os.path.join(d, METRICS_FILE))
 
                 w.write("mu = 0.1\n")
                 fs  = "{0} # Tc (Eliashberg)\n"
@@ -220,7 +228,7 @@ def process_all_a2f(base_dir, overwrite=False, plot_fits=False):
                 w.write(fs.format(tc,tc_ad,lam,wlog))
 
                 tc, lam, wlog, tc_ad = get_tc_info(omega, a2fnn, 0.15, 
-                    plot_fit=plot_fits, outf=outf)
+                    plot_fit=plot_fits, outf=outf, metrics_file=os.path.join(d, METRICS_FILE))
 
                 w.write("mu = 0.15\n")
                 fs =  "{0} # Tc (Eliashberg)\n"
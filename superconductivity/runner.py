@@ -0,0 +1,125 @@
+import subprocess
+import threading
+import signal
+import json
+import time
+import sys
+import os
+
+# Runs the programs of a calculation as subprocesses (rather than through
+# a shell), with stdin/stdout redirected to files, an optional timeout
+# and a record of the resources used. Each program is started in its own
+# process group, so that on a timeout the whole group (e.g mpirun and
+# all of its ranks) is killed. Resource usage comes from the rusage of
+# the finished child (os.wait4), which includes the descendants it
+# waited for; for an mpirun launch, that is the ranks on this node.
+# The peak RSS is that of the largest single process, not the total.
+
+# The file (next to run.out) that the metrics of each run are appended to
+METRICS_FILE = "run_metrics.jsonl"
+
+# How often (in seconds) a run with a timeout is checked
+POLL_INTERVAL = 0.2
+
+# Time allowed between SIGTERM and SIGKILL when a run times out
+KILL_GRACE = 10.0
+
+# Serialises appends to metrics files from concurrent runs
+metrics_lock = threading.Lock()
+
+# Start the child in a new session (and so its own process group)
+if sys.version_info[0] >= 3:
+    NEW_SESSION = {"start_new_session" : True}
+else:
+    NEW_SESSION = {"preexec_fn" : os.setsid}
+
+# Wait for the given process, killing its process group if it is still
+# running after timeout seconds (if given). Returns the wait status,
+# the rusage of the process and True if it timed out
+def wait_process(proc, timeout=None):
+
+    if timeout is None:
+        pid, status, usage = os.wait4(proc.pid, 0)
+        return status, usage, False
+
+    deadline  = time.time() + timeout
+    timed_out = False
+    while True:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0: return status, usage, timed_out
+
+        if not timed_out and time.time() > deadline:
+            timed_out = True
+            try: os.killpg(proc.pid, signal.SIGTERM)
+            except OSError: pass
+            deadline = time.time() + KILL_GRACE
+
+        elif timed_out and time.time() > deadline:
+            try: os.killpg(proc.pid, signal.SIGKILL)
+            except OSError: pass
+            pid, status, usage = os.wait4(proc.pid, 0)
+            return status, usage, True
+
+        time.sleep(POLL_INTERVAL)
+
+# Run the command args (a list) in the directory cwd, reading stdin
+# from and writing stdout/stderr to the given files (relative to cwd,
+# or None to inherit them), with the given extra environment variables.
+# The run is killed after timeout seconds (if given). Returns the
+# metrics of the run, which are also appended as a json line to
+# metrics_file (if given), along with any extra entries.
+def run_command(args, cwd=None, stdin=None, stdout=None, env=None, timeout=None,
+                metrics_file=None, extra=None):
+
+    cwd  = os.path.abspath(cwd or ".")
+    full = dict(os.environ)
+    if not env is None: full.update(env)
+
+    fin  = None if stdin  is None else open(os.path.join(cwd, stdin))
+    fout = None if stdout is None else open(os.path.join(cwd, stdout), "w")
+    try:
+        start = time.time()
+        proc  = subprocess.Popen(args, cwd=cwd, stdin=fin, stdout=fout,
+            stderr=None if fout is None else subprocess.STDOUT, env=full, **NEW_SESSION)
+        status, usage, timed_out = wait_process(proc, timeout)
+        end = time.time()
+    finally:
+        if not fin  is None: fin.close()
+        if not fout is None: fout.close()
+
+    # The process has been reaped, so popen shouldn't try
+    if os.WIFEXITED(status): proc.returncode = os.WEXITSTATUS(status)
+    else: proc.returncode = -os.WTERMSIG(status)
+
+    metrics = {
+        "command"    : " ".join(args),
+        "directory"  : cwd,
+        "start"      : start,
+        "end"        : end,
+        "wall"       : end - start,
+        "user"       : usage.ru_utime,
+        "system"     : usage.ru_stime,
+        "max_rss_mb" : usage.ru_maxrss/1024.0,
+        "returncode" : proc.returncode,
+        "timed_out"  : timed_out,
+    }
+    if not extra is None: metrics.update(extra)
+
+    if not metrics_file is None:
+        with metrics_lock:
+            with open(metrics_file, "a") as f:
+                f.write(json.dumps(metrics, sort_keys=True) + "\n")
+
+    return metrics
+
+# As run_command, but raising an exception if the command
+# fails (exits with a non-zero status) or times out
+def run_checked(args, **kwargs):
+
+    metrics = run_command(args, **kwargs)
+    if metrics["timed_out"]:
+        raise Exception("{0} timed out in {1}".format(metrics["command"], metrics["directory"]))
+    if metrics["returncode"] != 0:
+        raise Exception("{0} exited with status {1} in {2}".format(
+            metrics["command"], metrics["returncode"], metrics["directory"]))
+    return metrics
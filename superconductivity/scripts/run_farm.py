@@ -0,0 +1,7 @@
+import sys
+from quantum_espresso_tools.superconductivity.farm import run_farm
+dry   = "-dry" in sys.argv
+args  = [a for a in sys.argv[1:] if a != "-dry"]
+cores = int(args[1]) if len(args) > 1 else None
+
+run_farm(args[0], cores=cores, dry=dry)
@@ -0,0 +1,220 @@
+from quantum_espresso_tools.qe_input import QEInput
+from quantum_espresso_tools.superconductivity.workdir import work_dir
+import hashlib
+import shutil
+import glob
+import json
+import time
+import os
+
+# Content-addressed store of completed q.e stages, so that identical
+# stages in different calculation directories (e.g aux_kpts/ and
+# primary_kpts/, or copies of a calculation at different pressures)
+# are only ever run once. Each stage is keyed by
+#   - the key of the previous stage in the calculation (the chain)
+#   - its input deck (ignoring restart flags and the pseudo_dir)
+#   - the checksums of the pseudopotentials
+#   - the path, size and modification time of the executable (the
+#     "Program ... v.x.y" line of the output is recorded with the stage)
+# When a stage completes its products are copied into the store; when a
+# stage with the same key is run elsewhere, the products are copied into
+# place instead (never linked, because later q.e runs rewrite files such
+# as elph_dir/* and matdyn* in place, which would corrupt the store).
+# The store is enabled by setting the stage_store parameter to a
+# directory, and is kept below stage_store_gb by removing the least
+# recently used stages.
+
+# The files produced by each stage that can be stored, as
+# [files, outdir files], both of which can contain wildcards.
+# The outdir files (the pw.x save directory etc.) are large, so are
+# only stored if the stage_store_outdir parameter is set; stages
+# that produce them can't be restored otherwise.
+STAGE_PRODUCTS = {
+    "relax"    : [["relax.out"], []],
+    "scf"      : [["scf.out"], ["pwscf.save", "pwscf.wfc*", "pwscf.a2Fsave"]],
+    "elph_all" : [["elph_all.out", "matdyn*", "elph_dir"], []],
+    "q2r"      : [["q2r.out", "force_constants", "elph_dir"], []],
+    "ph_dos"   : [["ph_dos.out", "ph_dos.freq", "phonon.dos", "a2F.dos*", "lambda"], []],
+    "ph_bands" : [["ph_bands.out", "ph_bands.freq*"], []],
+    "bands"    : [["bands.out"], ["pwscf.save"]],
+    "bands.x"  : [["bands.x.out", "bands.x.bands*"], []],
+}
+
+# Namelist entries that don't change the result of a stage
+IGNORED_INPUTS = ["restart_mode", "recover", "pseudo_dir"]
+
+# Checksums of files that have already been hashed,
+# keyed by [path, size, modification time]
+checksums = {}
+
+def checksum(path):
+
+    st  = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    if not key in checksums:
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda : f.read(1 << 20), b""):
+                h.update(block)
+        checksums[key] = h.hexdigest()
+    return checksums[key]
+
+# The full path of the given executable (or None if it can't be found)
+def exe_path(exe):
+
+    if "ESPRESSO_BIN" in os.environ:
+        paths = [os.environ["ESPRESSO_BIN"]]
+    else:
+        paths = os.environ.get("PATH", "").split(os.pathsep)
+
+    for p in paths:
+        path = os.path.join(p, exe)
+        if os.path.isfile(path): return os.path.realpath(path)
+    return None
+
+# The "Program PWSCF v.6.4.1 starts on ..." line of a q.e
+# output (without the date), or None if there isn't one
+def version_line(filename):
+    with open(filename) as f:
+        for i, line in enumerate(f):
+            if "Program" in line and " v." in line:
+                return line.split("starts")[0].strip()
+            if i > 100: break
+    return None
+
+# The identity of the given executable; its path, size and modification
+# time. The executable isn't run to find its version, because on many
+# machines (e.g Cray, or srun-only systems) it can only be run through
+# the launcher; the version that produced a stage is instead read from
+# the stage's own output, and recorded in the store alongside it.
+def exe_identity(exe):
+
+    path = exe_path(exe)
+    if path is None: return [exe]
+
+    st = os.stat(path)
+    return [path, st.st_size, st.st_mtime]
+
+def store_enabled(parameters):
+    return len(parameters.get("stage_store", "")) > 0
+
+def store_dir(parameters):
+    return os.path.expanduser(parameters["stage_store"])
+
+# Work out the key of the stage with the given
+# executable and input file (file_prefix.in)
+def stage_key(exe, file_prefix, parameters):
+
+    inp = QEInput.read(work_dir(parameters).file(file_prefix+".in"))
+    for n in inp.namelists:
+        for key in IGNORED_INPUTS:
+            if key in n: del n[key]
+
+    h = hashlib.sha1()
+    h.update(parameters.get("stage_chain", "").encode("utf-8"))
+    h.update(inp.text().encode("utf-8"))
+    h.update(repr(exe_identity(exe)).encode("utf-8"))
+
+    for s in parameters["species"]:
+        pseudo = os.path.join(parameters["pseudo_dir"], s[2])
+        if os.path.isfile(pseudo): h.update(checksum(pseudo).encode("utf-8"))
+        else: h.update(s[2].encode("utf-8"))
+
+    return h.hexdigest()
+
+# The files to store/restore for the given stage (or None if
+# the stage can't be stored with the given parameters)
+def stage_products(file_prefix, parameters):
+
+    if not file_prefix in STAGE_PRODUCTS: return None
+    files, outdir = STAGE_PRODUCTS[file_prefix]
+    if len(outdir) > 0 and not parameters["stage_store_outdir"]: return None
+    return files + outdir
+
+# Copy the file or directory src to dst (replacing
+# rather than writing through any existing file)
+def copy_product(src, dst):
+
+    if os.path.isdir(src):
+        if not os.path.isdir(dst): os.makedirs(dst)
+        for f in os.listdir(src):
+            copy_product(os.path.join(src, f), os.path.join(dst, f))
+        return
+
+    if os.path.lexists(dst): os.remove(dst)
+    shutil.copy2(src, dst)
+
+# Restore the products of the stage with the given key from the
+# store into the working directory, returning True if successful
+def restore_stage(key, file_prefix, parameters):
+
+    entry = os.path.join(store_dir(parameters), key[:2], key)
+    info  = os.path.join(entry, "stage.json")
+    if not os.path.isfile(info): return False
+
+    with open(info) as f:
+        stored = json.load(f)
+
+    wd = work_dir(parameters)
+    for f in stored["files"]:
+        copy_product(os.path.join(entry, f), wd.file(f))
+
+    # Mark as recently used
+    os.utime(info, None)
+    return True
+
+# Copy the products of the completed stage with
+# the given key from the working directory into the store
+def save_stage(key, file_prefix, parameters):
+
+    wd    = work_dir(parameters)
+    files = []
+    for p in stage_products(file_prefix, parameters):
+        files.extend(wd.glob(p))
+
+    # Copy into a temporary directory and rename, so
+    # that a partially stored stage is never restored
+    base  = store_dir(parameters)
+    entry = os.path.join(base, key[:2], key)
+    if os.path.isdir(entry): return
+    tmp = "{0}.{1}.tmp".format(entry, os.getpid())
+    os.makedirs(tmp)
+    for f in files:
+        copy_product(wd.file(f), os.path.join(tmp, f))
+
+    # Record the version of q.e that actually produced the stage
+    out = wd.file(file_prefix+".out")
+    with open(os.path.join(tmp, "stage.json"), "w") as f:
+        json.dump({"stage" : file_prefix, "files" : files, "time" : time.time(),
+                   "directory" : wd.path, "version" : version_line(out) if os.path.isfile(out) else None}, f)
+
+    try: os.rename(tmp, entry)
+    except OSError: shutil.rmtree(tmp) # Stored concurrently elsewhere
+
+    evict(base, parameters["stage_store_gb"]*1024**3)
+
+# The total size of the files in the given directory
+def directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+# Remove the least-recently-used stages from the store
+# until it is below 90% of the given maximum size
+def evict(base, max_bytes):
+
+    entries = []
+    for info in glob.glob(os.path.join(base, "*", "*", "stage.json")):
+        entry = os.path.dirname(info)
+        entries.append([os.path.getmtime(info), directory_size(entry), entry])
+
+    entries.sort()
+    total = sum(e[1] for e in entries)
+    if total <= max_bytes: return
+
+    for mtime, size, entry in entries:
+        if total <= 0.9*max_bytes: break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
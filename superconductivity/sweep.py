@@ -0,0 +1,274 @@
+from quantum_espresso_tools.superconductivity.calculate import read_parameters, prepare_parameters
+from quantum_espresso_tools.superconductivity.calculate import Parameters, PARAMETER_TYPES
+from quantum_espresso_tools.superconductivity.calculate import relax_input, scf_input, elph_input
+from quantum_espresso_tools.superconductivity.calculate import is_run_complete, run_dir
+from quantum_espresso_tools.superconductivity.calculate import slurm_script, sbatch_command
+from quantum_espresso_tools.superconductivity import runner
+import numpy as np
+import itertools
+import json
+import time
+import os
+
+# Generates the input decks for a high-throughput sweep over
+# parameters (e.g structure x pressure x cutoff) in bulk, using
+# direct file I/O (no subprocesses or changes of directory).
+#
+# A sweep is a list of [key, values] pairs (or a dictionary), where
+# key is a parameter name and values is the list of values it takes.
+# Each value is either
+#   a plain value            : parameters[key] = value
+#   a dictionary             : parameters are updated with the dictionary,
+#                              which should contain a "name" entry used
+#                              to label the value
+#   a parameter file         : (only for key = "structure") the lattice,
+#                              species and atoms are taken from the file
+# The sweep is expanded over the cartesian product of all the values,
+# e.g [["structure", ["LiH.in", "Li2H.in"]], ["pressure", [0, 50, 100]]]
+# A sweep can also be given in a parameter file, using sweep lines
+#   sweep structure LiH.in Li2H.in
+#   sweep pressure range 0 200 50
+# in which case calculate_sweep runs (or submits, as a single SLURM
+# job array) the calculation at every point in the sweep.
+
+# The parameters taken from a structure file in a sweep
+STRUCTURE_KEYS = ["lattice", "species", "atoms"]
+
+# The decks that can be generated for each point in the sweep
+DECK_BUILDERS = {
+    "relax" : lambda p, restart : relax_input(p, restart=restart),
+    "scf"   : lambda p, restart : scf_input(p, restart=restart),
+    "elph"  : lambda p, restart : elph_input(p, recover=restart),
+}
+
+# The filename/output file of each deck
+DECK_FILES = {
+    "relax" : ["relax.in", "relax.out"],
+    "scf"   : ["scf.in", "scf.out"],
+    "elph"  : ["elph_all.in", "elph.out"],
+}
+
+# Returns the label and parameter updates for a single value in a sweep
+def sweep_value(key, value):
+
+    if isinstance(value, dict):
+        updates = dict((k, v) for k, v in value.items() if k != "name")
+        return str(value.get("name", len(updates))), updates
+
+    if key == "structure" and isinstance(value, str):
+        structure = read_parameters(value)
+        label     = os.path.splitext(os.path.basename(value))[0]
+        return label, dict((k, structure[k]) for k in STRUCTURE_KEYS)
+
+    if isinstance(value, float): return "{0:g}".format(value), {key : value}
+    return str(value), {key : value}
+
+# Expand a sweep over the given base parameters, returning a list
+# of [name, parameters] for every point in the sweep, where name
+# is a directory name describing that point
+def expand_sweep(base, sweep):
+
+    if isinstance(sweep, dict):
+        sweep = sorted(sweep.items())
+
+    # Work out the labels/updates for each value (once, so that
+    # each structure file is only read a single time)
+    axes = []
+    for key, values in sweep:
+        axes.append([[key, sweep_value(key, v)] for v in values])
+
+    points = []
+    for combo in itertools.product(*axes):
+        params = Parameters(base)
+        params["sweep"] = []
+        name   = []
+        for key, (label, updates) in combo:
+            params.update(updates)
+            name.append("{0}_{1}".format(key, label))
+        points.append(["_".join(name), params])
+
+    return points
+
+# Write a parameter file (readable by read_parameters) for
+# the given parameters, omitting any that can't be written
+def format_parameters(parameters):
+
+    t = ""
+    for key in sorted(parameters):
+
+        val = parameters[key]
+        if val is None or not key in PARAMETER_TYPES: continue
+
+        if key == "lattice":
+            t += "lattice angstrom\n"
+            for l in val: t += "{0} {1} {2}\n".format(*l)
+
+        elif key == "atoms":
+            t += "atoms {0} crystal\n".format(len(val))
+            for a in val: t += "{0} {1} {2} {3}\n".format(*a)
+
+        elif key == "species":
+            t += "species {0}\n".format(len(val))
+            for s in val: t += "{0} {1} {2}\n".format(*s)
+
+        elif key in ["qpoint_grid", "kpts_per_qpt", "aux_kpts", "kpoint_grid"]:
+            t += "{0} {1} {2} {3}\n".format(key, *val)
+
+        elif isinstance(val, bool):
+            t += "{0} {1}\n".format(key, "true" if val else "false")
+
+        elif isinstance(val, (str, int, float, np.integer, np.floating)):
+            t += "{0} {1}\n".format(key, val)
+
+    return t
+
+# Expand the given sweep over the base parameters (a dictionary, or
+# a parameter file) and write the given decks for each point into
+# directory/name. Each directory also gets a copy of the parameters
+# (as parameters.in) so that it can be run with calculate. Returns
+# the list of directories written to.
+def generate_decks(base, sweep, directory=".", decks=("relax", "scf", "elph"), verbose=True):
+
+    if isinstance(base, str):
+        base = read_parameters(base)
+
+    start = time.time()
+    dirs  = []
+    count = 0
+
+    for name, params in expand_sweep(base, sweep):
+
+        d = os.path.join(directory, name)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        dirs.append(d)
+
+        # The parameters are written before the grids are worked
+        # out, so that they are worked out again by calculate
+        with open(os.path.join(d, "parameters.in"), "w") as f:
+            f.write(format_parameters(params))
+
+        # Prepare the parameters as run() does (the primitive
+        # geometry and the k-point and q-point grids)
+        params = prepare_parameters(Parameters(params))
+
+        for deck in decks:
+            infile, outfile = DECK_FILES[deck]
+            restart = os.path.isfile(os.path.join(d, outfile))
+            DECK_BUILDERS[deck](params, restart).write(os.path.join(d, infile))
+            count += 1
+
+    elapsed = time.time() - start
+    if verbose:
+        rate = count/elapsed if elapsed > 0 else float("inf")
+        print("Wrote {0} decks in {1} directories in {2:.2f}s ({3:.1f} decks/s)".format(
+            count, len(dirs), elapsed, rate))
+
+    return dirs
+
+# The file mapping the index of each task in a
+# job array to the calculation directory it runs
+ARRAY_INDEX = "sweep_index.json"
+
+# Set up the calculation directories for every point in the sweep given
+# in the parameter file infile (as calculate does for a single point),
+# returning [directory, aux_kpts, parameters] for each calculation
+def sweep_calculations(infile, directory="."):
+
+    base = read_parameters(infile)
+    name = os.path.basename(infile)
+    root = os.path.dirname(os.path.abspath(infile))
+
+    # Structure files are relative to the parameter file
+    sweep = []
+    for key, values in base["sweep"]:
+        if key == "structure": values = [os.path.join(root, v) for v in values]
+        sweep.append([key, values])
+
+    calcs = []
+    for point, params in expand_sweep(base, sweep):
+
+        text = format_parameters(params)
+        for sub, aux in [["aux_kpts", True], ["primary_kpts", False]]:
+            if aux and params["aux_kpts"] is None: continue
+
+            d = os.path.abspath(os.path.join(directory, point, sub))
+            if not os.path.isdir(d): os.makedirs(d)
+            with open(os.path.join(d, name), "w") as f:
+                f.write(text)
+            calcs.append([d, aux, params])
+
+    return calcs
+
+# Run every point in the sweep in the given parameter file, either
+# directly (submit=None), by submitting a single SLURM job array
+# containing a task for each calculation that isn't already complete,
+# or by adding those calculations to the task farm queue (submit="farm")
+def calculate_sweep(infile, dry=False, submit=None):
+
+    base_dir = os.getcwd()
+    name     = os.path.basename(infile)
+    calcs    = sweep_calculations(infile, base_dir)
+
+    # Check for complete calculations in bulk, before submitting anything
+    todo = [c for c in calcs if not is_run_complete(c[2], c[0])]
+
+    # The aux_kpts and primary_kpts calculations of a point are
+    # independent (they run in their own directories and neither reads
+    # the other's results; calculate() also submits them as separate
+    # jobs that can run at the same time). As in calculate(), the
+    # faster aux_kpts calculations go first, here by giving them the
+    # lowest array indices, which SLURM starts first.
+    todo.sort(key=lambda c : not c[1])
+    print("{0} of {1} calculations in the sweep already complete".format(
+        len(calcs)-len(todo), len(calcs)))
+
+    if submit is None:
+        for d, aux, params in todo:
+            run_dir(d, name, dry, aux)
+        return
+
+    if submit == "farm":
+        from quantum_espresso_tools.superconductivity import farm
+        for d, aux, params in todo:
+            farm.add_task(farm.default_queue(base_dir), d, name, aux)
+        print("Queued {0} calculations in the task farm".format(len(todo)))
+        return
+
+    if not submit.startswith("csd3"):
+        print("Unkown submission system: "+submit)
+        return
+
+    if len(todo) == 0:
+        print("Nothing to submit.")
+        return
+
+    # Write the map from array index to directory, the runscript
+    # and the job array submission script
+    with open(os.path.join(base_dir, ARRAY_INDEX), "w") as f:
+        json.dump([[d, aux] for d, aux, params in todo], f, indent=1)
+
+    r  = "import sys\n"
+    r += "from quantum_espresso_tools.superconductivity.sweep import run_array_task\n"
+    r += "run_array_task('{0}', '{1}', int(sys.argv[1]), {2})".format(
+        os.path.join(base_dir, ARRAY_INDEX), name, dry)
+    with open(os.path.join(base_dir, "run.py"), "w") as f:
+        f.write(r)
+
+    base     = read_parameters(infile)
+    sub_file = slurm_script(submit, base, base_dir, array="0-{0}".format(len(todo)-1))
+
+    # If is a dry run, simply run each task, otherwise submit the array
+    if dry:
+        for i in range(len(todo)):
+            run_array_task(os.path.join(base_dir, ARRAY_INDEX), name, i, dry)
+    else:
+        print("Submitting {0} calculations as a job array".format(len(todo)))
+        runner.run_checked(sbatch_command().split() + [sub_file], cwd=base_dir,
+            metrics_file=os.path.join(base_dir, runner.METRICS_FILE), extra={"stage" : "sbatch"})
+
+# Run the task with the given index from a job array
+def run_array_task(index_file, infile, task, dry=False):
+    with open(index_file) as f:
+        directory, aux_kpts = json.load(f)[task]
+    run_dir(directory, infile, dry, aux_kpts)
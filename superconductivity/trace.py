@@ -0,0 +1,122 @@
+import threading
+import json
+import time
+import os
+
+# A timeline of a calculation, written in the Chrome trace-event format
+# (load it in chrome://tracing or https://ui.perfetto.dev). Each workflow
+# stage, irrep group and q.e run is a span, on the row of the thread that
+# ran it, with the number of cores it ran on; a counter tracks the cores
+# busy running q.e, so that idle parts of the allocation show up as gaps.
+# Tracing is enabled with the trace parameter; otherwise there is no
+# tracer in the parameters and span() returns a span that does nothing.
+# In a dry run, each q.e run that would have been made is instead an
+# instantaneous event recording the cores it would have run on.
+#
+# Events are appended to the file as they happen (as a json array that
+# is only closed at the end of the run), so that the timeline of a run
+# that is killed part way through can still be loaded.
+
+# The file (next to run.out) that the trace is written to
+TRACE_FILE = "trace.json"
+
+class Tracer(object):
+
+    def __init__(self, filename, name=None):
+        self.lock    = threading.RLock()
+        self.file    = open(filename, "w")
+        self.pid     = os.getpid()
+        self.threads = {}
+        self.busy    = 0
+        self.count   = 0
+        self.file.write("[\n")
+        self.metadata("process_name", {"name" : name or os.path.dirname(os.path.abspath(filename))})
+
+    # The row (trace thread id) of the calling thread; rows are
+    # numbered in the order threads first record an event
+    def tid(self):
+        ident = threading.current_thread().ident
+        if not ident in self.threads: self.threads[ident] = len(self.threads)
+        return self.threads[ident]
+
+    def write(self, event):
+        self.file.write((",\n" if self.count > 0 else "") + json.dumps(event, sort_keys=True))
+        self.file.flush()
+        self.count += 1
+
+    def event(self, ph, name, cat, args=None, **extra):
+        with self.lock:
+            e = {"name" : name, "cat" : cat, "ph" : ph, "ts" : time.time()*1e6,
+                 "pid" : self.pid, "tid" : self.tid()}
+            if not args is None: e["args"] = args
+            e.update(extra)
+            self.write(e)
+
+    def metadata(self, name, args):
+        with self.lock:
+            self.write({"name" : name, "ph" : "M", "pid" : self.pid, "tid" : 0, "args" : args})
+
+    # The start (ph="B") or end (ph="E") of a span, updating
+    # the count of busy cores if the span is a q.e run
+    def span_event(self, ph, name, cat, cores, args):
+        a = {} if args is None else dict(args)
+        if not cores is None: a["cores"] = cores
+        with self.lock:
+            self.event(ph, name, cat, a)
+            if cat == "qe":
+                self.busy += cores if ph == "B" else -cores
+                self.event("C", "cores busy", "qe", {"cores" : self.busy})
+
+    # An instantaneous event (e.g a stage being skipped)
+    def instant(self, name, cat, args=None):
+        self.event("i", name, cat, args, s="t")
+
+    def close(self):
+        with self.lock:
+            if self.file.closed: return
+            self.file.write("\n]\n")
+            self.file.close()
+
+class Span(object):
+
+    def __init__(self, tracer, name, cat, cores, args):
+        self.tracer = tracer
+        self.name   = name
+        self.cat    = cat
+        self.cores  = cores
+        self.args   = args
+
+    def __enter__(self):
+        self.tracer.span_event("B", self.name, self.cat, self.cores, self.args)
+        return self
+
+    def __exit__(self, kind, value, tb):
+        args = self.args
+        if not kind is None:
+            args = dict(args or {})
+            args["error"] = str(value)
+        self.tracer.span_event("E", self.name, self.cat, self.cores, args)
+        return False
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, tb):
+        return False
+
+NULL_SPAN = NullSpan()
+
+# A span (used as a context manager) covering the given part of the
+# calculation with the given parameters, on the given number of cores
+#   cat : the kind of span ("stage", "irrep_group" or "qe")
+def span(parameters, name, cat, cores=None, args=None):
+    tracer = parameters.get("tracer")
+    if tracer is None: return NULL_SPAN
+    return Span(tracer, name, cat, cores, args)
+
+# Record an instantaneous event, if tracing
+def instant(parameters, name, cat, args=None):
+    tracer = parameters.get("tracer")
+    if not tracer is None: tracer.instant(name, cat, args)
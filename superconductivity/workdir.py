@@ -0,0 +1,47 @@
+import glob
+import os
+
+# The directory that a calculation runs in. Every file of a calculation
+# is accessed through the absolute path given by its working directory
+# (parameters["work_dir"]) rather than relative to the current
+# directory, which is never changed, so that several calculations can
+# be run from the same process (e.g in different threads).
+class WorkDir(object):
+
+    def __init__(self, path="."):
+        self.path = os.path.abspath(path)
+
+    def __repr__(self):
+        return "WorkDir({0!r})".format(self.path)
+
+    def __str__(self):
+        return self.path
+
+    # The absolute path of the given file within the directory
+    def file(self, *names):
+        return os.path.join(self.path, *names)
+
+    def isfile(self, *names):
+        return os.path.isfile(self.file(*names))
+
+    def exists(self, *names):
+        return os.path.exists(self.file(*names))
+
+    def open(self, name, *args):
+        return open(self.file(name), *args)
+
+    # The files matching the given pattern, relative to the directory
+    def glob(self, pattern):
+        return sorted(os.path.relpath(f, self.path) for f in glob.glob(self.file(pattern)))
+
+    # Returns True if the given q.e output file exists and has completed
+    def job_done(self, name):
+        if not self.isfile(name): return False
+        with self.open(name) as f:
+            return "JOB DONE" in f.read()
+
+# The working directory of the calculation with the given
+# parameters (by default, the current directory)
+def work_dir(parameters):
+    wd = parameters.get("work_dir")
+    return WorkDir(".") if wd is None else wd
@@ -0,0 +1,283 @@
+from quantum_espresso_tools.superconductivity.workdir import work_dir
+from quantum_espresso_tools.superconductivity import launch
+from quantum_espresso_tools.superconductivity import trace
+import threading
+import hashlib
+import shutil
+import json
+import time
+import os
+
+try:    import queue
+except ImportError: import Queue as queue
+
+# A workflow is a graph of stages, each of which declares the stages
+# it depends on, the input decks that determine its result and the
+# output files it produces. The state of each stage (its status, the
+# hash of its inputs, timings and any results, such as the relaxed
+# geometry) is recorded in a json state file, so that a resumed run can
+# skip straight past completed stages without re-reading their outputs.
+# A stage is rerun if the hash of its inputs (its decks, along with the
+# hashes of the stages it depends on) has changed since it completed,
+# so that e.g changing ph_ndos only reruns the phonon dos.
+
+# A single stage of a workflow
+#   name    : the name of the stage
+#   inputs  : the names of the stages this stage depends on
+#   run     : function(parameters, dry, cores) that runs the stage on the
+#             given number of cores, returning a (json-able) dictionary
+#             of results (or None)
+#   decks   : function(parameters) returning the text that determines
+#             the result of the stage (e.g its input decks)
+#   outputs : the output files and directories of the stage (can contain
+#             wildcards), which are removed when the stage needs to be rerun
+#   apply   : function(parameters, results) that applies the results
+#             of the stage to the parameters, used when it is skipped
+#   when    : function(parameters) returning False if the stage
+#             should not be run for the given parameters
+#   cost    : the expected cost of the stage, relative to other stages,
+#             used to share cores between stages that run at the same time
+class Stage(object):
+
+    def __init__(self, name, inputs, run, decks=None, outputs=None, apply=None, when=None, cost=1.0):
+        self.name    = name
+        self.inputs  = inputs
+        self.run     = run
+        self.decks   = decks
+        self.outputs = [] if outputs is None else outputs
+        self.apply   = apply
+        self.when    = when
+        self.cost    = cost
+
+class Workflow(object):
+
+    def __init__(self, stages, state_file="run_state.json"):
+        self.stages     = stages
+        self.state_file = state_file
+        self.state      = self.load_state()
+        self.lock       = threading.Lock()
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {"stages" : {}}
+
+    # Write the state file via a temporary file and a rename,
+    # so that an interrupted run never leaves it half written
+    def save_state(self):
+        tmp = "{0}.{1}.tmp".format(self.state_file, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.state_file)
+
+    # The stages in an order that respects their dependencies
+    # (otherwise keeping the order in which they were declared)
+    def order(self):
+
+        names = [s.name for s in self.stages]
+        done  = []
+        while len(done) < len(self.stages):
+            ready = [s for s in self.stages if not s in done and
+                     all(i in [d.name for d in done] or not i in names for i in s.inputs)]
+            if len(ready) == 0:
+                raise Exception("Cyclic dependency between workflow stages")
+            done.append(ready[0])
+        return done
+
+    # The hash of the inputs of the given stage
+    def stage_hash(self, stage, parameters, hashes):
+        h = hashlib.sha1(stage.name.encode("utf-8"))
+        for i in sorted(stage.inputs):
+            h.update(hashes.get(i, "").encode("utf-8"))
+        if not stage.decks is None:
+            h.update(stage.decks(parameters).encode("utf-8"))
+        return h.hexdigest()
+
+    # Returns the state of the given stage if it has
+    # completed with the given hash (otherwise None)
+    def completed(self, stage, stage_hash):
+        s = self.state["stages"].get(stage.name)
+        if s is None or s["status"] != "done" or s["hash"] != stage_hash:
+            return None
+        return s
+
+    # Returns True if every stage that applied to the last run of the
+    # workflow (recorded once it finished) has completed
+    def complete(self):
+        enabled = self.state.get("enabled")
+        if enabled is None: return False
+        return all(self.state["stages"].get(n, {}).get("status") == "done" for n in enabled)
+
+    # Remove the outputs of a stage that was run with different inputs
+    def remove_stale_outputs(self, stage, parameters):
+        wd = work_dir(parameters)
+        for pattern in stage.outputs:
+            for f in wd.glob(pattern):
+                if wd.isfile(f): os.remove(wd.file(f))
+                elif os.path.isdir(wd.file(f)): shutil.rmtree(wd.file(f))
+
+    # The expected cost of the given stages; the time they took to run
+    # previously, if known for all of them (otherwise their cost estimate)
+    def costs(self, stages):
+        elapsed = [self.state["stages"].get(s.name, {}).get("elapsed") for s in stages]
+        if all(not e is None and e > 0 for e in elapsed): return elapsed
+        return [s.cost for s in stages]
+
+    # Run the workflow, skipping stages that have already completed with
+    # the same inputs. Stages whose inputs are complete are run at the
+    # same time, with the free cores split between them in proportion to
+    # their expected cost, each pinned to its own cores (see launch.py).
+    # Once a stage fails, no more stages are started (those already
+    # running are waited for) and its error is raised.
+    def run(self, parameters, dry=False):
+
+        log      = parameters["out_file"].write
+        total    = parameters["nodes"]*parameters["cores_per_node"]
+        cores    = launch.node_cores(parameters) if parameters["nodes"] == 1 else list(range(total))
+        free     = list(cores)
+        stages   = [s for s in self.order() if s.when is None or s.when(parameters)]
+        names    = [s.name for s in stages]
+        hashes   = {}
+        chains   = {}
+        complete = []
+        running  = {}
+        errors   = []
+        results  = queue.Queue()
+
+        # Stages that don't apply count as complete
+        inputs_complete = lambda s : all(i in complete or not i in names for i in s.inputs)
+
+        while len(running) > 0 or (len(stages) > 0 and len(errors) == 0):
+
+            # Nothing more is started once a stage has failed
+            ready = [s for s in stages if inputs_complete(s)] if len(errors) == 0 else []
+            for stage in list(ready):
+
+                h = self.stage_hash(stage, parameters, hashes)
+                hashes[stage.name] = h
+
+                # Skip completed stages
+                done = self.completed(stage, h)
+                if not done is None:
+                    log("Stage {0} already complete, skipping.\n".format(stage.name))
+                    trace.instant(parameters, "{0} (skipped)".format(stage.name), "stage")
+                    if not stage.apply is None and not done.get("results") is None:
+                        stage.apply(parameters, done["results"])
+                    chains[stage.name] = done.get("chain", "")
+
+                # Nothing to record for dry runs
+                elif dry:
+                    with trace.span(parameters, stage.name, "stage", total):
+                        stage.run(parameters, dry, total)
+
+                else: continue
+
+                stages.remove(stage)
+                ready.remove(stage)
+                complete.append(stage.name)
+
+            # Skipped stages may have made others ready
+            if len(ready) == 0 and len(running) == 0: continue
+
+            # Start the ready stages, each on its share of the cores that
+            # are free (those that don't get a core wait for a running
+            # stage to finish)
+            shares = split_cores(len(free), self.costs(ready))
+            for stage, c in zip(ready, shares):
+                if c == 0: continue
+                stages.remove(stage)
+                running[stage.name] = free[:c]
+                del free[:c]
+                self.start(stage, parameters, hashes[stage.name], chains, running[stage.name], cores, results)
+
+            # Wait for a stage to finish, freeing its cores
+            stage, local, result, error = results.get()
+            free = sorted(free + running.pop(stage.name))
+            chains[stage.name] = local.get("stage_chain", "")
+            with self.lock:
+                self.state["stages"][stage.name]["chain"] = chains[stage.name]
+                self.save_state()
+
+            if not error is None:
+                errors.append(error)
+                continue
+
+            if not stage.apply is None and not result is None:
+                stage.apply(parameters, result)
+            complete.append(stage.name)
+
+        if len(errors) > 0:
+            raise errors[0]
+
+        # Record which stages make up a complete run
+        if not dry:
+            with self.lock:
+                self.state["enabled"] = names
+                self.save_state()
+
+    # Start running the given stage on the given cores (out of those
+    # available to the workflow), putting [stage, parameters, results,
+    # error] onto the finished queue once it has completed
+    def start(self, stage, parameters, stage_hash, chains, cpus, available, finished):
+
+        cores = len(cpus)
+        parameters["out_file"].write("Starting stage {0} on {1} cores\n".format(stage.name, cores))
+
+        # The stage runs with its own copy of the parameters, pinned to
+        # its cores, with the stage store chain following on from the
+        # stages it depends on
+        local = type(parameters)(parameters)
+        launch.pin_cores(local, cpus, available)
+        chain = hashlib.sha1("".join(chains.get(i, "") for i in sorted(stage.inputs)).encode("utf-8"))
+        local["stage_chain"] = chain.hexdigest()
+
+        # Previous outputs were computed with different inputs
+        previous = self.state["stages"].get(stage.name)
+        if not previous is None and previous["hash"] != stage_hash:
+            parameters["out_file"].write("Inputs to stage {0} have changed, rerunning.\n".format(stage.name))
+            self.remove_stale_outputs(stage, parameters)
+
+        record = {"status" : "running", "hash" : stage_hash, "start" : time.time(), "cores" : cores}
+        with self.lock:
+            self.state["stages"][stage.name] = record
+            self.save_state()
+
+        def run_stage():
+            result, error = None, None
+            try:
+                with trace.span(local, stage.name, "stage", cores):
+                    result = stage.run(local, False, cores)
+            except Exception as e: error = e
+            with self.lock:
+                record["status"]  = "done" if error is None else "failed"
+                record["end"]     = time.time()
+                record["elapsed"] = record["end"] - record["start"]
+                if not result is None: record["results"] = result
+            finished.put([stage, local, result, error])
+
+        t = threading.Thread(target=run_stage)
+        t.daemon = True
+        t.start()
+
+# Split the given number of cores between tasks in proportion to their
+# costs (largest remainder first). Every task gets at least one core,
+# unless there are more tasks than cores, in which case the tasks that
+# don't fit get none (and should wait for cores to become free).
+def split_cores(cores, costs):
+
+    count = len(costs)
+    n     = min(count, cores)
+    if n <= 0: return [0]*count
+
+    costs = [max(float(c), 1e-6) for c in costs[:n]]
+    spare = cores - n
+    share = [spare*c/sum(costs) for c in costs]
+    split = [1 + int(s) for s in share]
+
+    order = sorted(range(n), key=lambda i : int(share[i]) - share[i])
+    for i in order[:cores - sum(split)]:
+        split[i] += 1
+
+    return split + [0]*(count - n)
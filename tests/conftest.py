@@ -0,0 +1,6 @@
+import sys
+import os
+
+# The repository is the quantum_espresso_tools package itself, so
+# it is imported from the directory containing the checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
@@ -0,0 +1,51 @@
+from quantum_espresso_tools.superconductivity import calculate
+import pytest
+
+# The end of a q.e output, with its clock report
+def clock_report(program, wall):
+    return ("     Program {0} v.6.4.1 starts on 14Feb2019 at  9: 5:12\n"
+            "     fftw         :      {1:.2f}s CPU      {1:.2f}s WALL (     100 calls)\n"
+            "     {0:12} :      {1:.2f}s CPU      {1:.2f}s WALL\n"
+            "   JOB DONE.\n").format(program, wall)
+
+def test_collect_timings(tmp_path):
+
+    (tmp_path / "scf.out").write_text(clock_report("PWSCF", 10))
+    (tmp_path / "run.out").write_text("Running: pw.x\n")
+    for name, wall in [["elph_1_1_2", 20], ["elph_2_3_4", 30]]:
+        group = tmp_path / "irrep_groups" / name
+        group.mkdir(parents=True)
+        (group / (name+".out")).write_text(clock_report("PHONON", wall))
+
+    timings = calculate.collect_timings(str(tmp_path))
+    assert sorted(timings) == ["elph_1_1_2", "elph_2_3_4", "scf"]
+    assert timings["elph_2_3_4"]["program"] == "PHONON"
+    assert timings["elph_2_3_4"]["wall"] == 30
+
+    calculate.write_timing_report(str(tmp_path))
+    report = (tmp_path / "timings.out").read_text()
+    assert "elph_1_1_2" in report
+    assert "60.00" in report
+
+def test_failed_run(tmp_path, monkeypatch):
+
+    # A pw.x that writes some output, then fails
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "pw.x").write_text("#!/bin/sh\necho 'Program PWSCF'\nexit 1\n")
+    (bin_dir / "pw.x").chmod(0o755)
+    monkeypatch.setenv("ESPRESSO_BIN", str(bin_dir))
+
+    work = tmp_path / "work"
+    work.mkdir()
+    (work / "scf.in").write_text("&control\n/\n")
+
+    p = calculate.default_parameters()
+    p["work_dir"] = calculate.WorkDir(str(work))
+    p["out_file"] = open(str(tmp_path / "log"), "w")
+    p["mpirun"]   = "local"
+    p["cores_per_node"] = 1
+
+    # Even without checking for JOB DONE, the failure is raised
+    with pytest.raises(Exception, match="exited with status 1"):
+        calculate.run_qe("pw.x", "scf", p, check_done=False)
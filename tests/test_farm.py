@@ -0,0 +1,91 @@
+from quantum_espresso_tools.superconductivity import farm
+import subprocess
+import time
+import sys
+import os
+
+def queue(tmp_path, cores):
+    q = str(tmp_path / "farm.db")
+    for i, c in enumerate(cores):
+        farm.add_task(q, str(tmp_path / "calc{0}".format(i)), "p.in", cores=c)
+    return q
+
+def status(db):
+    return [r[0] for r in db.execute("SELECT status FROM tasks ORDER BY id")]
+
+# The pid of a process that has finished
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+def test_add_task(tmp_path):
+
+    # A calculation already waiting to run isn't queued twice
+    q  = queue(tmp_path, [4, 4])
+    farm.add_task(q, str(tmp_path / "calc0"), "p.in", cores=4)
+    farm.add_task(q, str(tmp_path / "calc0"), "p.in", aux_kpts=True, cores=4)
+    db = farm.connect(q)
+    assert db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0] == 3
+    assert farm.pending_tasks(db) == 3
+
+def test_claim(tmp_path):
+
+    db = farm.connect(queue(tmp_path, [2, 8, 4, 64]))
+
+    # The largest task that fits first; tasks wanting more
+    # cores than the farm has are run on all of them
+    assert farm.claim_task(db, 16, 16)[4] == 16
+    assert farm.claim_task(db, 12, 16)[4] == 8
+    assert farm.claim_task(db, 3, 16)[4] == 2
+    assert farm.claim_task(db, 3, 16) is None
+    assert status(db) == ["running", "running", "queued", "running"]
+
+    tid, host, pid, attempts = db.execute("""SELECT id, host, pid, attempts
+        FROM tasks WHERE status='running' ORDER BY id""").fetchone()
+    assert pid == os.getpid()
+    assert attempts == 1
+
+def test_finish(tmp_path):
+
+    db = farm.connect(queue(tmp_path, [1]))
+
+    # A failed task is requeued until it has been tried max_attempts times
+    for attempt in range(2):
+        tid = farm.claim_task(db, 1, 1)[0]
+        farm.finish_task(db, tid, 1, max_attempts=2)
+        assert status(db) == ["queued" if attempt == 0 else "failed"]
+    assert farm.pending_tasks(db) == 0
+
+def test_finish_done(tmp_path):
+
+    db  = farm.connect(queue(tmp_path, [1]))
+    tid = farm.claim_task(db, 1, 1)[0]
+    farm.finish_task(db, tid, 0)
+    assert status(db) == ["done"]
+    assert db.execute("SELECT returncode FROM tasks").fetchone()[0] == 0
+
+def test_requeue_orphans(tmp_path):
+
+    db = farm.connect(queue(tmp_path, [1, 1, 1]))
+    for i in range(3): farm.claim_task(db, 1, 1)
+
+    # Task 1 belongs to a farm that has died, task 2 to a farm that is
+    # running (this process) and task 3 to a farm that has stopped
+    # updating its heartbeat (e.g on another host)
+    db.execute("UPDATE tasks SET pid=? WHERE id=1", (dead_pid(),))
+    db.execute("UPDATE tasks SET host='elsewhere', heartbeat=? WHERE id=3",
+        (time.time() - 2*farm.HEARTBEAT_STALE,))
+
+    assert farm.requeue_orphans(db) == 2
+    assert status(db) == ["queued", "running", "queued"]
+    assert farm.requeue_orphans(db) == 0
+
+    # Requeued tasks are claimed again
+    assert farm.claim_task(db, 1, 1)[0] == 1
+    assert db.execute("SELECT attempts FROM tasks WHERE id=1").fetchone()[0] == 2
+
+def test_run_farm_idle(tmp_path):
+
+    # A farm with nothing to run stops straight away
+    farm.run_farm(queue(tmp_path, []), cores=1)
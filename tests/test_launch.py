@@ -0,0 +1,137 @@
+from quantum_espresso_tools.superconductivity import launch
+import pytest
+import os
+
+def parameters(mpirun="mpirun", bind="cores", threads=1, rpn=0, **extra):
+    p = {"mpirun" : mpirun, "cpu_bind" : bind, "threads_per_rank" : threads,
+         "ranks_per_node" : rpn, "cores_per_node" : 8, "nodes" : 1}
+    p.update(extra)
+    return p
+
+@pytest.fixture
+def implementation(monkeypatch):
+    def set(impl):
+        monkeypatch.setitem(launch.implementations, "mpirun", impl)
+    return set
+
+def test_launcher():
+    assert launch.launcher("/opt/intel/bin/mpiexec.hydra") == "mpirun"
+    assert launch.launcher("srun --mpi=pmi2") == "srun"
+    assert launch.launcher("") == "local"
+    with pytest.raises(ValueError):
+        launch.launcher("qsub")
+
+def test_ranks():
+    assert launch.ranks(parameters(threads=2), 8) == 4
+    assert launch.ranks(parameters(mpirun="local", threads=2), 8) == 1
+    assert launch.ranks_per_node(parameters(threads=2), 32) == 4
+    assert launch.ranks_per_node(parameters(rpn=2), 8) == 2
+
+def test_intel(implementation):
+    implementation("intel")
+    env, args = launch.launch_command(parameters(rpn=4), 8)
+    assert args == ["mpirun", "-np", "8", "-ppn", "4"]
+    assert env["I_MPI_PIN_DOMAIN"] == "omp"
+    assert env["OMP_PLACES"] == "cores"
+
+    env, args = launch.launch_command(parameters(bind="sockets"), 8)
+    assert env["I_MPI_PIN_DOMAIN"] == "socket"
+
+    env, args = launch.launch_command(parameters(bind="none"), 8)
+    assert not "I_MPI_PIN_DOMAIN" in env and not "OMP_PLACES" in env
+
+def test_mpich(implementation):
+    implementation("mpich")
+    env, args = launch.launch_command(parameters(threads=2), 8)
+    assert args == ["mpirun", "-np", "4", "-bind-to", "core:2"]
+    assert not "I_MPI_PIN_DOMAIN" in env
+    assert env["OMP_NUM_THREADS"] == "2"
+
+    env, args = launch.launch_command(parameters(bind="none"), 8)
+    assert args == ["mpirun", "-np", "8"]
+
+def test_openmpi(implementation):
+    implementation("openmpi")
+    env, args = launch.launch_command(parameters(threads=2, rpn=4), 8)
+    assert args == ["mpirun", "-np", "4", "--map-by", "ppr:4:node:PE=2", "--bind-to", "core"]
+    assert not "I_MPI_PIN_DOMAIN" in env
+
+    env, args = launch.launch_command(parameters(threads=2), 8)
+    assert args == ["mpirun", "-np", "4", "--map-by", "slot:PE=2", "--bind-to", "core"]
+
+    env, args = launch.launch_command(parameters(bind="threads"), 8)
+    assert args == ["mpirun", "-np", "8", "--map-by", "slot:PE=1", "--use-hwthread-cpus",
+                    "--bind-to", "hwthread"]
+
+    env, args = launch.launch_command(parameters(bind="sockets"), 8)
+    assert args == ["mpirun", "-np", "8", "--bind-to", "socket"]
+
+def test_aprun_srun():
+    env, args = launch.launch_command(parameters(mpirun="aprun", threads=2), 8)
+    assert args == ["aprun", "-n", "4", "-N", "4", "-d", "2", "-cc", "depth"]
+
+    env, args = launch.launch_command(parameters(mpirun="srun", threads=2), 8)
+    assert args == ["srun", "-n", "4", "--ntasks-per-node=4", "--cpus-per-task=2", "--cpu-bind=cores"]
+
+    env, args = launch.launch_command(parameters(mpirun="local"), 8)
+    assert args == []
+
+def test_pinned(implementation):
+
+    # A run pinned to cores 4-7 of the node, with two threads per rank
+    pinned = lambda **kw : parameters(threads=2, cpu_list=[4, 5, 6, 7], **kw)
+
+    implementation("intel")
+    env, args = launch.launch_command(pinned(), 4)
+    assert env["I_MPI_PIN_DOMAIN"] == "[30,c0]"
+
+    implementation("mpich")
+    env, args = launch.launch_command(pinned(), 4)
+    assert args == ["mpirun", "-np", "2", "-bind-to", "user:4+5,6+7"]
+
+    implementation("openmpi")
+    env, args = launch.launch_command(pinned(), 4)
+    assert args[-2:] == ["--cpu-set", "4,5,6,7"]
+
+    env, args = launch.launch_command(pinned(mpirun="aprun"), 4)
+    assert args[-2:] == ["-cc", "4,5:6,7"]
+
+    env, args = launch.launch_command(pinned(mpirun="srun"), 4)
+    assert args[-2:] == ["--cpu-bind=cores", "--exact"]
+
+    env, args = launch.launch_command(pinned(mpirun="local"), 4)
+    assert args == ["taskset", "-c", "4,5,6,7"]
+
+    # Unbound runs aren't pinned
+    env, args = launch.launch_command(pinned(mpirun="local", bind="none"), 4)
+    assert args == []
+
+def test_pin_cores():
+
+    p = parameters()
+    launch.pin_cores(p, [0, 1, 2, 3, 4, 5, 6, 7], launch.node_cores(p))
+    assert not "cpu_list" in p
+
+    launch.pin_cores(p, [2, 3], launch.node_cores(p))
+    assert launch.node_cores(p) == [2, 3]
+    assert p["cpu_bind"] == "cores"
+
+    # Runs sharing several nodes aren't bound
+    p = parameters(nodes=2)
+    launch.pin_cores(p, list(range(8)), list(range(16)))
+    assert p["cpu_bind"] == "none"
+
+def test_mpi_implementation(tmp_path, monkeypatch):
+
+    versions = {"openmpi" : "mpirun (Open MPI) 4.1.1",
+                "intel"   : "Intel(R) MPI Library for Linux* OS, Version 2021.6",
+                "mpich"   : "HYDRA build details:\n    Version: 4.0.2"}
+    for impl, version in versions.items():
+        mpirun = str(tmp_path / ("mpirun_"+impl))
+        with open(mpirun, "w") as f:
+            f.write("#!/bin/sh\necho '{0}'\n".format(version))
+        os.chmod(mpirun, 0o755)
+        assert launch.mpi_implementation(mpirun) == impl
+
+    # Falls back to Intel MPI
+    assert launch.mpi_implementation(str(tmp_path / "missing")) == "intel"
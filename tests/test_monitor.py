@@ -0,0 +1,34 @@
+from quantum_espresso_tools import monitor
+import time
+
+# The start of a pw.x scf, which has used more cpu time than
+# wall time (e.g running with several threads)
+SCF = """\
+     Program PWSCF v.6.4.1 starts on 14Feb2019 at  9: 5:12
+     iteration #  1     ecut=    40.00 Ry     beta= 0.70
+     total cpu time spent up to now is      120.5 secs
+     estimated scf accuracy    <       0.01000000 Ry
+     iteration #  2     ecut=    40.00 Ry     beta= 0.70
+     total cpu time spent up to now is      200.0 secs
+"""
+
+def test_iteration_time(tmp_path):
+
+    out = tmp_path / "scf.out"
+    out.write_text(SCF[:SCF.find("     iteration #  2")])
+    m = monitor.OutputMonitor(str(out))
+
+    before = time.time()
+    events = m.poll()
+    assert [e["event"] for e in events] == ["scf_iteration", "iteration_cpu_time", "scf_accuracy"]
+    assert m.start == time.mktime((2019, 2, 14, 9, 5, 12, 0, 0, -1))
+
+    # Stamped with the wall time it was seen, not the start time plus the cpu time
+    e = events[1]
+    assert before <= e["time"] <= time.time()
+    assert e["cpu_time"] == 120.5 and e["program"] == "PWSCF"
+
+    out.write_text(SCF)
+    events = m.poll()
+    assert events[1]["iteration"] == 2
+    assert events[1]["cpu_dt"] == 79.5
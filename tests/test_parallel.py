@@ -0,0 +1,50 @@
+from quantum_espresso_tools.superconductivity import parallel
+
+def dims(nks=None, nbnd=None, fft=None, irreps=None):
+    return {"nks" : nks, "nbnd" : nbnd, "fft" : fft, "nq" : None, "irreps" : irreps}
+
+def test_pools():
+
+    # As many pools as possible, without more pools than k-points
+    assert parallel.plan_parallelization("pw.x", 32, dims(nks=10))[0] == "-nk 8"
+    assert parallel.plan_parallelization("pw.x", 32, dims(nks=100))[0] == "-nk 32"
+    assert parallel.plan_parallelization("pw.x", 12, dims(nks=5))[0] == "-nk 4"
+
+    # Unknown k-points => one pool per rank
+    assert parallel.plan_parallelization("pw.x", 16, dims())[0] == "-nk 16"
+
+def test_pool_memory():
+
+    # A pool needs ~6.8MB, so 8 pools don't fit in 4MB per rank
+    d = dims(nks=8, nbnd=20, fft=[32, 32, 32])
+    assert parallel.plan_parallelization("pw.x", 8, d)[0] == "-nk 8 -nd 1"
+    flags, reasons = parallel.plan_parallelization("pw.x", 8, d, memory_per_rank=4*1024**2)
+    assert flags == "-nk 4 -nd 1"
+    assert "fit in memory" in reasons[1]
+
+def test_images():
+
+    # 2 pools for the k-points, the other 6 ranks split into 3 images
+    assert parallel.plan_parallelization("ph.x", 12, dims(nks=2, irreps=3))[0] == "-ni 3 -nk 2"
+
+    # No images for a single irrep, or a run that isn't an irrep group
+    assert parallel.plan_parallelization("ph.x", 12, dims(nks=2, irreps=1))[0] == "-nk 2"
+    assert parallel.plan_parallelization("ph.x", 12, dims(nks=2))[0] == "-nk 2"
+
+    # pw.x never uses images
+    assert parallel.plan_parallelization("pw.x", 12, dims(nks=2, irreps=3))[0] == "-nk 2"
+
+def test_diagonalization():
+
+    # 8x8 grid for 400 bands on a single 64 rank pool (which
+    # needs 2 task groups for the 48 FFT planes)
+    d = dims(nks=1, nbnd=400, fft=[48, 48, 48])
+    assert parallel.plan_parallelization("pw.x", 64, d)[0] == "-nk 1 -ntg 2 -nd 64"
+
+    # At least BANDS_PER_DIAG_ROW bands per row
+    d = dims(nks=1, nbnd=100)
+    assert parallel.plan_parallelization("pw.x", 64, d)[0] == "-nk 1 -nd 4"
+
+def test_no_flags():
+    for exe in ["q2r.x", "matdyn.x", "bands.x"]:
+        assert parallel.plan_parallelization(exe, 16, dims(nks=10))[0] == ""
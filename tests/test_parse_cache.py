@@ -0,0 +1,103 @@
+from quantum_espresso_tools import parse_cache
+from quantum_espresso_tools.parse_cache import cached_parser
+import numpy as np
+import pytest
+import glob
+import os
+
+# The calls made to parse_lines
+calls = []
+
+@cached_parser()
+def parse_lines(filename, upper=False):
+    calls.append(filename)
+    with open(filename) as f:
+        lines = f.read().split()
+    if upper: lines = [l.upper() for l in lines]
+    return {"lines" : lines, "lengths" : np.array([len(l) for l in lines])}
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(parse_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(parse_cache, "CACHE_ENABLED", True)
+    monkeypatch.setattr(parse_cache, "cache_bytes", None)
+    del calls[:]
+    return str(tmp_path / "cache")
+
+def write(tmp_path, text):
+    path = tmp_path / "x.out"
+    path.write_text(text)
+    return str(path)
+
+def entries(cache):
+    return glob.glob(os.path.join(cache, "*", "*.npz"))
+
+def test_hit(tmp_path, cache):
+    filename = write(tmp_path, "a bb ccc")
+    first    = parse_lines(filename)
+    second   = parse_lines(filename)
+    assert len(calls) == 1
+    assert second["lines"] == ["a", "bb", "ccc"]
+    assert np.array_equal(second["lengths"], first["lengths"])
+    assert len(entries(cache)) == 1
+
+    # Different arguments are cached separately
+    assert parse_lines(filename, upper=True)["lines"] == ["A", "BB", "CCC"]
+    assert len(calls) == 2
+
+def test_keyword_filename(tmp_path, cache):
+    filename = write(tmp_path, "a bb")
+    assert parse_lines(filename=filename)["lines"] == ["a", "bb"]
+    assert parse_lines(filename=filename)["lines"] == ["a", "bb"]
+    assert len(calls) == 1
+
+    # Bad arguments raise the parser's own error
+    with pytest.raises(TypeError):
+        parse_lines()
+
+def test_invalidation(tmp_path, cache):
+    filename = write(tmp_path, "a bb")
+    parse_lines(filename)
+
+    # Same size, but modified later
+    write(tmp_path, "c dd")
+    st = os.stat(filename)
+    os.utime(filename, (st.st_atime + 10, st.st_mtime + 10))
+    assert parse_lines(filename)["lines"] == ["c", "dd"]
+    assert len(calls) == 2
+
+def test_large_file(tmp_path, cache, monkeypatch):
+
+    # Only the ends of a large file are read to look it up
+    monkeypatch.setattr(parse_cache, "HASH_BLOCK_BYTES", 16)
+    filename = write(tmp_path, "word "*1000)
+    key = parse_cache.cache_key("parse_lines", [filename], (filename,), {})
+
+    # (changing the middle of the file, but not its modification time)
+    st = os.stat(filename)
+    with open(filename, "r+") as f:
+        f.seek(2500)
+        f.write("WORD")
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert parse_cache.cache_key("parse_lines", [filename], (filename,), {}) == key
+
+def test_bad_entry(tmp_path, cache):
+    filename = write(tmp_path, "a bb")
+    parse_lines(filename)
+
+    # A corrupt entry is reparsed and replaced
+    entry = entries(cache)[0]
+    with open(entry, "wb") as f:
+        f.write(b"not an npz file")
+    assert parse_lines(filename)["lines"] == ["a", "bb"]
+    assert len(calls) == 2
+    assert parse_lines(filename)["lines"] == ["a", "bb"]
+    assert len(calls) == 2
+
+def test_disabled(tmp_path, cache, monkeypatch):
+    monkeypatch.setattr(parse_cache, "CACHE_ENABLED", False)
+    filename = write(tmp_path, "a")
+    parse_lines(filename)
+    parse_lines(filename)
+    assert len(calls) == 2
+    assert entries(cache) == []
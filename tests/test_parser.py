@@ -0,0 +1,245 @@
+from quantum_espresso_tools import parser
+import numpy as np
+import pytest
+
+# The last bfgs step and final geometry of a (small) vc-relax output
+VC_RELAX = """\
+     Program PWSCF v.6.4.1 starts on 14Feb2019 at  9: 5:12
+
+     unit-cell volume          =     100.0000 (a.u.)^3
+!    total energy              =     -10.50000000 Ry
+          total   stress  (Ry/bohr**3)                   (kbar)     P=       12.34
+     enthalpy new            =     -10.40000000 Ry
+
+CELL_PARAMETERS (alat=  7.00000000)
+   1.000000000   0.000000000   0.000000000
+   0.000000000   1.100000000   0.000000000
+   0.000000000   0.000000000   1.200000000
+
+ATOMIC_POSITIONS (crystal)
+Li            0.0000000000        0.0000000000        0.0000000000
+H             0.5000000000        0.5000000000        0.5000000000
+End final coordinates
+
+     Final enthalpy =     -10.45000000 Ry
+"""
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+def test_vc_relax(tmp_path):
+    data = parser.parse_vc_relax(write(tmp_path, "relax.out", VC_RELAX))
+    assert data["lattice"] == [[1.0, 0.0, 0.0], [0.0, 1.1, 0.0], [0.0, 0.0, 1.2]]
+    assert data["atoms"] == [["Li", 0.0, 0.0, 0.0], ["H", 0.5, 0.5, 0.5]]
+    assert data["energy"]   == -10.5
+    assert data["enthalpy"] == -10.45
+    assert data["pressure"] == 12.34
+    assert data["volume"]   == 100.0
+
+def test_vc_relax_final_only(tmp_path):
+    filename = write(tmp_path, "relax.out", VC_RELAX)
+    assert parser.parse_vc_relax_tail(filename, chunk_size=64) == parser.parse_vc_relax(filename)
+
+def test_vc_relax_truncated(tmp_path):
+
+    # Ends part way through the cell parameters
+    text = VC_RELAX[:VC_RELAX.find("   0.000000000   0.000000000   1.2")]
+    data = parser.parse_vc_relax(write(tmp_path, "relax.out", text))
+    assert data["energy"] == -10.5
+    assert not "lattice" in data
+
+    # Ends part way through the atomic positions
+    text = VC_RELAX[:VC_RELAX.find("H ")]
+    data = parser.parse_vc_relax(write(tmp_path, "relax2.out", text))
+    assert data["atoms"] == [["Li", 0.0, 0.0, 0.0]]
+
+# The header and two bfgs steps of a vc-relax output, the
+# second at a new geometry (in angstrom and alat units)
+VC_RELAX_STEPS = """\
+     Program PWSCF v.6.4.1 starts on 14Feb2019 at  9: 5:12
+
+     lattice parameter (alat)  =       2.0000  a.u.
+     unit-cell volume          =       8.0000 (a.u.)^3
+     number of atoms/cell      =            2
+
+     crystal axes: (cart. coord. in units of alat)
+               a(1) = (   1.000000   0.000000   0.000000 )  
+               a(2) = (   0.000000   1.000000   0.000000 )  
+               a(3) = (   0.000000   0.000000   1.000000 )  
+
+     site n.     atom                  positions (alat units)
+         1           Li  tau(   1) = (   0.0000000   0.0000000   0.0000000  )
+         2           H   tau(   2) = (   0.5000000   0.5000000   0.5000000  )
+
+!    total energy              =     -10.00000000 Ry
+          total   stress  (Ry/bohr**3)                   (kbar)     P=       20.00
+     enthalpy new            =      -9.90000000 Ry
+
+CELL_PARAMETERS (alat=  2.00000000)
+   1.100000000   0.000000000   0.000000000
+   0.000000000   1.100000000   0.000000000
+   0.000000000   0.000000000   1.100000000
+
+ATOMIC_POSITIONS (crystal)
+Li            0.0000000000        0.0000000000        0.0000000000
+H             0.2500000000        0.5000000000        0.5000000000
+
+     unit-cell volume          =      10.6480 (a.u.)^3
+!    total energy              =     -10.50000000 Ry
+          total   stress  (Ry/bohr**3)                   (kbar)     P=       10.00
+     enthalpy new            =     -10.40000000 Ry
+"""
+
+def test_vc_relax_trajectory(tmp_path):
+    names, traj = parser.parse_vc_relax_trajectory(write(tmp_path, "relax.out", VC_RELAX_STEPS))
+    assert names == ["Li", "H"]
+    assert traj.shape == (2,)
+    assert traj["lattice"].shape   == (2, 3, 3)
+    assert traj["positions"].shape == (2, 2, 3)
+    assert traj["energy"].tolist()   == [-10.0, -10.5]
+    assert traj["enthalpy"].tolist() == [-9.9, -10.4]
+    assert traj["pressure"].tolist() == [20.0, 10.0]
+    assert traj["volume"].tolist()   == [8.0, 10.648]
+
+    # The first step is at the initial geometry, the second at the new one
+    assert np.allclose(traj["lattice"][0], 2.0*np.identity(3))
+    assert np.allclose(traj["lattice"][1], 2.2*np.identity(3))
+    assert np.allclose(traj["positions"][0][1], [0.5, 0.5, 0.5])
+    assert np.allclose(traj["positions"][1][1], [0.25, 0.5, 0.5])
+
+# An a2F.dos file with two modes, one of which has weight at a negative
+# frequency, an exponent that q.e has written without the E and the
+# closing lambda line
+A2F = """\
+ # Eliashberg function a2F (per both spin)
+ #  frequencies in Rydberg
+ # DOS normalized to E in Rydberg: a2F_total, a2F(mode)
+ -1.0000E-03   5.0000E-01   0.0000E+00   5.0000E-01
+  1.0000E-03   2.0000E-01   0.1000-105   2.0000E-01
+  2.0000E-03   4.0000E-01   1.0000E-01   3.0000E-01
+ lambda    1.2345   (   1.1000)  <log w>=   123.4 K  N(Ef)=  12.3 at degauss=0.005
+"""
+
+def test_a2f(tmp_path):
+    omega, a2f, a2f_noneg, a2f_proj = parser.parse_a2f(write(tmp_path, "a2F.dos1", A2F))
+    assert np.allclose(omega, [-1e-3, 1e-3, 2e-3])
+    assert np.allclose(a2f, [0.5, 0.2, 0.4])
+    assert a2f_proj.shape == (2, 3)
+    assert a2f_proj[0][1] == 0.1e-105
+
+    # Only the mode without weight at negative frequencies
+    assert np.allclose(a2f_noneg, a2f_proj[0])
+
+def test_a2f_truncated(tmp_path):
+
+    # The last line is cut short (e.g the file is still being written)
+    text = A2F[:A2F.find("1.0000E-01")]
+    omega, a2f, a2f_noneg, a2f_proj = parser.parse_a2f(write(tmp_path, "a2F.dos1", text))
+    assert np.allclose(omega, [-1e-3, 1e-3])
+    assert a2f_proj.shape == (2, 2)
+
+# A dynamical matrix file for a single atom (ibrav=2), with two
+# q-points in the star (one written without spaces between negative
+# components, as q.e does)
+DYN = """\
+Dynamical matrix file
+  1    1  2  7.0000000  0.0000000  0.0000000  0.0000000  0.0000000  0.0000000
+           1  'Pb  '    188851.25
+    1    1      0.0000000000      0.0000000000      0.0000000000
+
+     Dynamical  Matrix in cartesian axes
+
+     q = (    0.000000000   0.000000000   0.000000000 ) 
+
+    1    1
+  1.00000000  0.00000000    0.00000000  0.00000000    0.00000000  0.00000000
+  0.00000000  0.00000000    2.00000000  0.00000000    0.00000000  0.00000000
+  0.00000000  0.00000000    0.00000000  0.00000000    3.00000000 -0.50000000
+
+     Dynamical  Matrix in cartesian axes
+
+     q = (   -0.500000000-0.500000000  0.500000000 ) 
+
+    1    1
+  4.00000000  0.00000000    0.00000000  0.00000000    0.00000000  0.00000000
+  0.00000000  0.00000000    5.00000000  0.00000000    0.00000000  0.00000000
+  0.00000000  0.00000000    0.00000000  0.00000000    6.00000000  0.00000000
+
+     Diagonalizing the dynamical matrix
+"""
+
+def test_dyn_file(tmp_path):
+    header, qs, dyns = parser.parse_dyn_file(write(tmp_path, "matdyn1", DYN))
+    assert header["species"] == ["Pb"]
+    assert header["ityp"].tolist() == [0]
+    assert header["lattice"] is None
+    assert np.allclose(qs, [[0, 0, 0], [-0.5, -0.5, 0.5]])
+    assert dyns.shape == (2, 3, 3)
+    assert dyns[0][2][2] == 3 - 0.5j
+    assert np.allclose(np.diagonal(dyns[1]), [4, 5, 6])
+
+def test_dyn_file_truncated(tmp_path):
+
+    # Cut off in the header, and part way through a dynamical matrix
+    for i, end in enumerate([DYN.find("    1    1      0.0"), DYN.find("  0.00000000  0.00000000    5.0")]):
+        filename = write(tmp_path, "matdyn{0}".format(i+1), DYN[:end])
+        with pytest.raises(Exception, match="truncated"):
+            parser.parse_dyn_file(filename)
+
+def test_dyn_files(tmp_path):
+    write(tmp_path, "matdyn0", "Not a dynamical matrix\n")
+    write(tmp_path, "matdyn1", DYN)
+    write(tmp_path, "matdyn2", DYN)
+    data = parser.parse_dyn_files(str(tmp_path))
+    assert data["iq"].tolist() == [1, 1, 2, 2]
+    assert data["dyn"].shape == (4, 3, 3)
+
+# The output section of a (two k-point) data-file-schema.xml, with
+# energies in Hartree
+XML = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<qes:espresso xmlns:qes="http://www.quantum-espresso.org/ns/qes/qes-1.0">
+  <output>
+    <atomic_structure nat="1" alat="6.0">
+      <atomic_positions>
+        <atom name="Pb" index="1">0.0 0.0 0.0</atom>
+      </atomic_positions>
+      <cell>
+        <a1>-3.0 0.0 3.0</a1>
+        <a2>0.0 3.0 3.0</a2>
+        <a3>-3.0 3.0 0.0</a3>
+      </cell>
+    </atomic_structure>
+    <total_energy>
+      <etot>-5.0</etot>
+    </total_energy>
+    <band_structure>
+      <nks>2</nks>
+      <fermi_energy>0.25</fermi_energy>
+      <ks_energies>
+        <k_point weight="0.5">0.0 0.0 0.0</k_point>
+        <eigenvalues size="2">0.1 0.5</eigenvalues>
+      </ks_energies>
+      <ks_energies>
+        <k_point weight="1.5">0.5 0.5 0.5</k_point>
+        <eigenvalues size="2">0.2 0.6</eigenvalues>
+      </ks_energies>
+    </band_structure>
+  </output>
+</qes:espresso>
+"""
+
+def test_xml_data_file(tmp_path):
+    data = parser.parse_xml_data_file(write(tmp_path, "data-file-schema.xml", XML))
+    assert data["atoms"] == [["Pb", 0.0, 0.0, 0.0]]
+    assert np.allclose(data["lattice"][0], [-3.0, 0.0, 3.0])
+    assert np.allclose(data["weights"], [0.5, 1.5])
+    assert data["kpoints"].shape == (2, 3)
+
+    # Energies are in eV, as in parse_scf_out
+    ha = 2*parser.RY_TO_EV
+    assert np.isclose(data["total_energy"], -5.0*ha)
+    assert np.isclose(data["fermi_energy"], 0.25*ha)
+    assert np.allclose(data["eigenvalues"], [[0.1*ha, 0.5*ha], [0.2*ha, 0.6*ha]])
@@ -0,0 +1,97 @@
+from quantum_espresso_tools.qe_input import QEInput, parse_value, format_rows
+
+# A pw.x input, written in a different style to QEInput.text
+PW_INPUT = """\
+ &CONTROL
+   calculation = 'vc-relax', prefix="pwscf" ! a comment, with = and /
+   outdir = './out/', tprnfor = .true.
+ /
+&SYSTEM
+  ibrav=0, nat=2, ntyp=2, ecutwfc=40.0, degauss=2.0d-2,
+  celldm(1) = 7.0
+/
+&ELECTRONS
+/
+ATOMIC_SPECIES
+Li 6.94 li.upf
+H 1.008 h.upf
+CELL_PARAMETERS {angstrom}
+1.0 0.0 0.0
+0.0 1.0 0.0
+0.0 0.0 1.0
+ATOMIC_POSITIONS crystal
+Li 0.0 0.0 0.0
+H 0.5 0.5 0.5
+K_POINTS automatic
+4 4 4 0 0 0
+"""
+
+# A matdyn.x input, with a title line and an anonymous card (the q-points)
+MATDYN_INPUT = """\
+matdyn input
+&INPUT
+  asr='simple', flfrc='force_constants', dos=.false.
+/
+2
+0.0 0.0 0.0 1
+0.5 0.5 0.5 1
+"""
+
+def test_parse():
+    inp = QEInput.parse(PW_INPUT)
+    assert [n.name for n in inp.namelists] == ["CONTROL", "SYSTEM", "ELECTRONS"]
+    assert [c.name for c in inp.cards] == ["ATOMIC_SPECIES", "CELL_PARAMETERS",
+                                           "ATOMIC_POSITIONS", "K_POINTS"]
+
+    control = inp.namelist("control")
+    assert control["calculation"] == "vc-relax"
+    assert control["prefix"]      == "pwscf"
+    assert control["outdir"]      == "./out/"
+    assert control["TPRNFOR"] is True
+
+    system = inp.namelist("SYSTEM")
+    assert system["nat"]       == 2
+    assert system["degauss"]   == 0.02
+    assert system["celldm(1)"] == 7.0
+    assert inp.card("CELL_PARAMETERS").option == "angstrom"
+    assert inp.card("K_POINTS").lines == ["4 4 4 0 0 0"]
+
+def test_round_trip():
+    for text in [PW_INPUT, MATDYN_INPUT]:
+        inp  = QEInput.parse(text)
+        text = inp.text()
+        assert QEInput.parse(text).text() == text
+
+def test_anonymous_card():
+    inp = QEInput.parse(MATDYN_INPUT)
+    assert inp.title == ["matdyn input"]
+    assert inp.cards[0].name is None
+    assert inp.cards[0].lines == ["2", "0.0 0.0 0.0 1", "0.5 0.5 0.5 1"]
+
+    # New cards go before the anonymous card
+    inp.set_card("K_POINTS", "gamma", [])
+    assert [c.name for c in inp.cards] == ["K_POINTS", None]
+
+def test_modify_and_write(tmp_path):
+    inp = QEInput.parse(PW_INPUT)
+    assert inp.replace("ecutwfc", 60)
+    assert not inp.replace("ecutrho", 240)
+    inp.namelist("ELECTRONS")["conv_thr"] = 1e-8
+    del inp.namelist("CONTROL")["tprnfor"]
+
+    filename = str(tmp_path / "relax.in")
+    inp.write(filename)
+    assert [f.name for f in tmp_path.iterdir()] == ["relax.in"]
+
+    read = QEInput.read(filename)
+    assert read.find("ecutwfc")["ecutwfc"] == 60
+    assert read.namelist("ELECTRONS")["conv_thr"] == 1e-8
+    assert not "tprnfor" in read.namelist("CONTROL")
+    assert read.text() == inp.text()
+
+def test_values():
+    assert parse_value(".TRUE.") is True
+    assert parse_value("'a, b'") == "a, b"
+    assert parse_value("1.5D-3") == 1.5e-3
+    assert format_rows("%.1f %.1f", [[1, 2], [3, 4]]) == "1.0 2.0\n3.0 4.0"
+    assert format_rows("%.1f", []) == ""
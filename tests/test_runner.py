@@ -0,0 +1,61 @@
+from quantum_espresso_tools.superconductivity import runner
+import pytest
+import json
+import time
+import os
+
+def test_run_command(tmp_path):
+
+    (tmp_path / "x.in").write_text("input\n")
+    metrics_file = str(tmp_path / runner.METRICS_FILE)
+    metrics = runner.run_command(["sh", "-c", "cat; echo $GREETING; echo error >&2; exit 3"],
+        cwd=str(tmp_path), stdin="x.in", stdout="x.out", env={"GREETING" : "hello"},
+        metrics_file=metrics_file, extra={"stage" : "x"})
+
+    assert metrics["returncode"] == 3
+    assert not metrics["timed_out"]
+    assert metrics["directory"] == str(tmp_path)
+    assert metrics["wall"] >= 0
+    assert (tmp_path / "x.out").read_text() == "input\nhello\nerror\n"
+
+    # The metrics are appended to the metrics file, with the extra entries
+    runner.run_command(["true"], cwd=str(tmp_path), metrics_file=metrics_file)
+    with open(metrics_file) as f:
+        lines = [json.loads(l) for l in f]
+    assert [l["returncode"] for l in lines] == [3, 0]
+    assert lines[0]["stage"] == "x"
+    assert not "stage" in lines[1]
+
+# Returns True if the process with the given pid is still running
+# (and not just waiting to be reaped by its new parent)
+def running(pid):
+    try:
+        with open("/proc/{0}/stat".format(pid)) as f:
+            return not f.read().split(")")[-1].split()[0] in "ZX"
+    except (IOError, OSError):
+        return False
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs /proc")
+def test_timeout(tmp_path):
+
+    # The whole process group is killed, including the
+    # background process started by the shell
+    start   = time.time()
+    metrics = runner.run_command(["sh", "-c", "sleep 60 & echo $! > bg.pid; wait"],
+        cwd=str(tmp_path), timeout=0.5)
+    assert metrics["timed_out"]
+    assert metrics["returncode"] < 0
+    assert time.time() - start < runner.KILL_GRACE
+
+    time.sleep(0.5)
+    assert not running(int((tmp_path / "bg.pid").read_text()))
+
+def test_run_checked(tmp_path):
+
+    assert runner.run_checked(["true"], cwd=str(tmp_path))["returncode"] == 0
+
+    with pytest.raises(Exception, match="exited with status 2"):
+        runner.run_checked(["sh", "-c", "exit 2"], cwd=str(tmp_path))
+
+    with pytest.raises(Exception, match="timed out"):
+        runner.run_checked(["sleep", "60"], cwd=str(tmp_path), timeout=0.2)
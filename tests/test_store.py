@@ -0,0 +1,113 @@
+from quantum_espresso_tools.superconductivity import store
+from quantum_espresso_tools.superconductivity.workdir import WorkDir
+import pytest
+import json
+import os
+
+SCF_IN = """&control
+    calculation = 'scf',
+    restart_mode = '{0}',
+    pseudo_dir = '{1}',
+/
+&system
+    ecutwfc = 40,
+/
+ATOMIC_SPECIES
+Nb 92.906 Nb.upf
+"""
+
+@pytest.fixture
+def calc(tmp_path, monkeypatch):
+
+    # A pw.x to key stages on
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "pw.x").write_text("#!/bin/sh\nexit 1\n")
+    (bin_dir / "pw.x").chmod(0o755)
+    monkeypatch.setenv("ESPRESSO_BIN", str(bin_dir))
+
+    pseudo_dir = tmp_path / "pseudo"
+    pseudo_dir.mkdir()
+    (pseudo_dir / "Nb.upf").write_text("<UPF version=\"2.0.1\">\n")
+
+    # Make a calculation directory with the given scf.in
+    def make(name, restart="from_scratch", pseudo=str(pseudo_dir)):
+        work = tmp_path / name
+        work.mkdir()
+        (work / "scf.in").write_text(SCF_IN.format(restart, pseudo))
+        return {"work_dir" : WorkDir(str(work)), "species" : [["Nb", 92.906, "Nb.upf"]],
+                "pseudo_dir" : str(pseudo_dir), "stage_store" : str(tmp_path / "store"),
+                "stage_store_outdir" : False, "stage_store_gb" : 1.0}
+    return make
+
+def test_stage_key(calc):
+
+    a = calc("a")
+    b = calc("b", restart="restart", pseudo="/elsewhere")
+    key = store.stage_key("pw.x", "scf", a)
+
+    # Restart flags and the pseudo_dir are ignored
+    assert store.stage_key("pw.x", "scf", a) == key
+    assert store.stage_key("pw.x", "scf", b) == key
+
+    # The previous stage is not
+    b["stage_chain"] = "0"*40
+    assert store.stage_key("pw.x", "scf", b) != key
+
+    # Nor is the pseudopotential
+    with open(os.path.join(a["pseudo_dir"], "Nb.upf"), "a") as f:
+        f.write("</UPF>\n")
+    assert store.stage_key("pw.x", "scf", a) != key
+
+def test_save_restore(calc):
+
+    a = calc("a")
+    a["stage_store_outdir"] = True
+    os.makedirs(a["work_dir"].file("pwscf.save"))
+    with open(a["work_dir"].file("pwscf.save/data-file-schema.xml"), "w") as f:
+        f.write("<qes:espresso/>\n")
+    out = a["work_dir"].file("scf.out")
+    with open(out, "w") as f:
+        f.write("     Program PWSCF v.6.4.1 starts on 14Feb2019 at  9: 5:12\n   JOB DONE.\n")
+
+    key = store.stage_key("pw.x", "scf", a)
+    store.save_stage(key, "scf", a)
+
+    # The version is taken from the stage's own output
+    with open(os.path.join(a["stage_store"], key[:2], key, "stage.json")) as f:
+        assert json.load(f)["version"] == "Program PWSCF v.6.4.1"
+
+    b = calc("b")
+    assert store.restore_stage(key, "scf", b)
+    assert os.path.isfile(b["work_dir"].file("pwscf.save/data-file-schema.xml"))
+    restored = b["work_dir"].file("scf.out")
+    with open(restored) as f:
+        assert "JOB DONE" in f.read()
+
+    # The restored file is a copy, so rewriting it leaves the store intact
+    assert not os.path.samefile(restored, out)
+    with open(restored, "w") as f:
+        f.write("overwritten\n")
+    c = calc("c")
+    assert store.restore_stage(key, "scf", c)
+    with open(c["work_dir"].file("scf.out")) as f:
+        assert "JOB DONE" in f.read()
+
+    # Unknown stages aren't restored
+    assert not store.restore_stage("f"*40, "scf", c)
+
+def test_evict(tmp_path):
+
+    base = str(tmp_path)
+    for i, key in enumerate(["aa01", "aa02", "aa03"]):
+        entry = os.path.join(base, key[:2], key)
+        os.makedirs(entry)
+        with open(os.path.join(entry, "data"), "wb") as f:
+            f.write(b"x"*1000)
+        with open(os.path.join(entry, "stage.json"), "w") as f:
+            f.write("{}")
+        os.utime(os.path.join(entry, "stage.json"), (i, i))
+
+    # The least recently used stage is removed first
+    store.evict(base, 2500)
+    assert sorted(os.listdir(os.path.join(base, "aa"))) == ["aa02", "aa03"]
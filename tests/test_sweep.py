@@ -0,0 +1,110 @@
+from quantum_espresso_tools.superconductivity import sweep, calculate, farm
+import numpy as np
+
+# A parameter file sweeping over two structures and three pressures
+PARAMETERS = """\
+ecutwfc 40
+kpts_per_qpt 6 6 6
+aux_kpts 8 8 8
+require_prim_geom false
+sweep structure LiH.in Li2H.in
+sweep pressure range 0 100 50
+"""
+
+LIH = """\
+lattice angstrom
+2.0 0.0 0.0
+0.0 2.0 0.0
+0.0 0.0 2.0
+species 2
+Li 6.94 Li.UPF
+H 1.008 H.UPF
+atoms 2 crystal
+Li 0.0 0.0 0.0
+H 0.5 0.5 0.5
+"""
+
+LI2H = """\
+lattice angstrom
+3.0 0.0 0.0
+0.0 3.0 0.0
+0.0 0.0 3.0
+species 2
+Li 6.94 Li.UPF
+H 1.008 H.UPF
+atoms 3 crystal
+Li 0.0 0.0 0.0
+Li 0.5 0.5 0.0
+H 0.5 0.5 0.5
+"""
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+def test_expand_sweep(tmp_path):
+
+    lih  = write(tmp_path, "LiH.in", LIH)
+    base = calculate.default_parameters()
+    points = sweep.expand_sweep(base, [["structure", [lih]], ["pressure", [0, 12.5]],
+        ["cutoff", [{"name" : "low", "ecutwfc" : 30}, {"name" : "high", "ecutwfc" : 60}]]])
+
+    names = [p[0] for p in points]
+    assert names[:2] == ["structure_LiH_pressure_0_cutoff_low", "structure_LiH_pressure_0_cutoff_high"]
+    assert len(names) == 4 and len(set(names)) == 4
+
+    params = dict(points)["structure_LiH_pressure_12.5_cutoff_high"]
+    assert params["pressure"] == 12.5
+    assert params["ecutwfc"]  == 60
+    assert len(params["atoms"]) == 2
+    assert params["sweep"] == []
+
+    # The base parameters are left as they were
+    assert base["ecutwfc"] == 30
+    assert len(base["atoms"]) == 2 and base["atoms"][0][0] == "Li"
+
+def test_format_parameters(tmp_path):
+
+    params = calculate.read_parameters(write(tmp_path, "LiH.in", LIH))
+    params["pressure"]   = 12.5
+    params["elph"]       = False
+    params["aux_kpts"]   = [4, 4, 4]
+    params["work_dir"]   = str(tmp_path)
+
+    # Reading the written parameters gives back the same calculation
+    read = calculate.read_parameters(write(tmp_path, "p.in", sweep.format_parameters(params)))
+    assert read.freeze() == params.freeze()
+    assert read["elph"] is False
+    assert read["aux_kpts"] == [4, 4, 4]
+    assert np.allclose(read["lattice"], 2.0*np.identity(3))
+
+def test_calculate_sweep(tmp_path, monkeypatch):
+
+    write(tmp_path, "LiH.in", LIH)
+    write(tmp_path, "Li2H.in", LI2H)
+    infile = write(tmp_path, "p.in", PARAMETERS)
+    base   = calculate.read_parameters(infile)
+    assert base["sweep"] == [["structure", ["LiH.in", "Li2H.in"]], ["pressure", [0.0, 50.0, 100.0]]]
+
+    run = tmp_path / "run"
+    run.mkdir()
+    monkeypatch.chdir(str(run))
+    monkeypatch.delenv("QE_TOOLS_FARM", raising=False)
+    sweep.calculate_sweep(infile, submit="farm")
+
+    # An aux_kpts and a primary_kpts calculation for each point, with the
+    # aux_kpts calculations queued first
+    db    = farm.connect(str(run / "farm.db"))
+    tasks = db.execute("SELECT directory, aux_kpts FROM tasks ORDER BY id").fetchall()
+    assert len(tasks) == 12
+    assert [t[1] for t in tasks] == [1]*6 + [0]*6
+
+    # Each calculation has the parameters of its point in the sweep
+    d = run / "structure_Li2H_pressure_50" / "primary_kpts"
+    assert (str(d), 0) in tasks
+    params = calculate.read_parameters(str(d / "p.in"))
+    assert params["pressure"] == 50.0
+    assert params["ecutwfc"]  == 40
+    assert len(params["atoms"]) == 3
+    assert params["sweep"] == []
@@ -0,0 +1,80 @@
+from quantum_espresso_tools.superconductivity import trace
+import threading
+import pytest
+import json
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def test_trace(tmp_path):
+
+    filename   = str(tmp_path / trace.TRACE_FILE)
+    parameters = {"tracer" : trace.Tracer(filename, "calc")}
+    with trace.span(parameters, "scf", "stage", 4):
+        with trace.span(parameters, "scf", "qe", 4, {"exe" : "pw.x"}):
+            pass
+    trace.instant(parameters, "relax (skipped)", "stage")
+    parameters["tracer"].close()
+    parameters["tracer"].close()
+
+    events = load(filename)
+    assert events[0] == {"name" : "process_name", "ph" : "M", "pid" : events[0]["pid"],
+                         "tid" : 0, "args" : {"name" : "calc"}}
+    assert [[e["ph"], e["cat"]] for e in events[1:]] == [
+        ["B", "stage"], ["B", "qe"], ["C", "qe"], ["E", "qe"], ["C", "qe"], ["E", "stage"], ["i", "stage"]]
+
+    # The busy core counter goes up and back down
+    assert [e["args"]["cores"] for e in events if e["ph"] == "C"] == [4, 0]
+    assert events[2]["args"] == {"exe" : "pw.x", "cores" : 4}
+
+def test_trace_error(tmp_path):
+
+    # A span ended by an exception records the error
+    filename   = str(tmp_path / trace.TRACE_FILE)
+    parameters = {"tracer" : trace.Tracer(filename)}
+    with pytest.raises(ValueError):
+        with trace.span(parameters, "elph", "stage", 2):
+            raise ValueError("bad input")
+    parameters["tracer"].close()
+
+    assert load(filename)[-1]["args"] == {"cores" : 2, "error" : "bad input"}
+
+def test_trace_threads(tmp_path):
+
+    # Spans from threads running at the same time are each on their
+    # own row, and the events they write concurrently are kept whole
+    filename   = str(tmp_path / trace.TRACE_FILE)
+    parameters = {"tracer" : trace.Tracer(filename)}
+    barrier    = threading.Barrier(4)
+
+    def run(i):
+        barrier.wait()
+        for j in range(20):
+            with trace.span(parameters, "group{0}".format(i), "irrep_group", 1):
+                pass
+        barrier.wait()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    parameters["tracer"].close()
+
+    events = load(filename)
+    assert len(events) == 1 + 4*20*2
+    assert len(set(e["tid"] for e in events[1:])) == 4
+
+def test_unfinished_trace(tmp_path):
+
+    # Until it is closed, the trace is a json array missing only its end
+    filename = str(tmp_path / trace.TRACE_FILE)
+    tracer   = trace.Tracer(filename)
+    tracer.instant("start", "stage")
+    with open(filename) as f:
+        assert len(json.loads(f.read() + "\n]")) == 2
+    tracer.close()
+
+def test_no_tracer():
+    with trace.span({}, "scf", "stage", 1) as s:
+        assert s is trace.NULL_SPAN
+    trace.instant({}, "scf", "stage")
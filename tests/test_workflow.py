@@ -0,0 +1,117 @@
+from quantum_espresso_tools.superconductivity.workflow import Stage, Workflow, split_cores
+from quantum_espresso_tools.superconductivity.workdir import WorkDir
+import pytest
+import json
+import io
+
+# A chain of stages a -> b -> c, where each stage writes name.out in
+# the working directory and records that it ran in parameters["ran"].
+# The deck of each stage is parameters[name+"_deck"], b fails if
+# parameters["fail"] is set and c is only run if parameters["with_c"].
+def stages():
+
+    def stage(name):
+        def run(parameters, dry, cores):
+            wd = parameters["work_dir"]
+            parameters["ran"].append([name, wd.isfile(name+".out")])
+            if name == "b" and parameters.get("fail"): raise Exception("b failed")
+            with wd.open(name+".out", "w") as f: f.write(name)
+            return {"result" : name.upper()}
+        return run
+
+    deck  = lambda name : lambda parameters : parameters.get(name+"_deck", "")
+    apply = lambda parameters, results : parameters["applied"].append(results["result"])
+    return [
+        Stage("a", [], stage("a"), decks=deck("a"), outputs=["a.out"], apply=apply),
+        Stage("b", ["a"], stage("b"), decks=deck("b"), outputs=["b.out"], apply=apply),
+        Stage("c", ["b"], stage("c"), decks=deck("c"), outputs=["c.out"], apply=apply,
+              when=lambda parameters : parameters.get("with_c", True)),
+    ]
+
+def parameters(tmp_path, **extra):
+    p = {"out_file" : io.StringIO(), "nodes" : 1, "cores_per_node" : 2,
+         "work_dir" : WorkDir(str(tmp_path)), "ran" : [], "applied" : []}
+    p.update(extra)
+    return p
+
+def workflow(tmp_path):
+    return Workflow(stages(), state_file=str(tmp_path / "run_state.json"))
+
+# Run the workflow, returning the stages that were run
+def run(tmp_path, p, dry=False):
+    workflow(tmp_path).run(p, dry=dry)
+    return [r[0] for r in p["ran"]]
+
+def test_resume(tmp_path):
+
+    assert run(tmp_path, parameters(tmp_path)) == ["a", "b", "c"]
+    assert workflow(tmp_path).complete()
+
+    # Nothing is rerun, and the results of the skipped stages are applied
+    p = parameters(tmp_path)
+    assert run(tmp_path, p) == []
+    assert p["applied"] == ["A", "B", "C"]
+
+def test_stale(tmp_path):
+
+    run(tmp_path, parameters(tmp_path))
+
+    # Changing the deck of b reruns b and the stages that depend on it,
+    # after removing their outputs from the previous run
+    p = parameters(tmp_path, b_deck="changed")
+    assert run(tmp_path, p) == ["b", "c"]
+    assert p["ran"] == [["b", False], ["c", False]]
+    assert p["applied"] == ["A", "B", "C"]
+    assert run(tmp_path, parameters(tmp_path, b_deck="changed")) == []
+
+def test_failure(tmp_path):
+
+    # A failed stage raises its error, and its dependents are not run
+    with pytest.raises(Exception, match="b failed"):
+        run(tmp_path, parameters(tmp_path, fail=True))
+    with open(str(tmp_path / "run_state.json")) as f:
+        state = json.load(f)
+    assert state["stages"]["a"]["status"] == "done"
+    assert state["stages"]["b"]["status"] == "failed"
+    assert not "c" in state["stages"]
+    assert not workflow(tmp_path).complete()
+
+    # Resuming reruns only the failed stage onwards
+    assert run(tmp_path, parameters(tmp_path)) == ["b", "c"]
+    assert workflow(tmp_path).complete()
+
+def test_complete(tmp_path):
+
+    # A stage that doesn't apply isn't needed for the run to be complete
+    run(tmp_path, parameters(tmp_path, with_c=False))
+    assert workflow(tmp_path).complete()
+
+    # A dry run records nothing
+    other = tmp_path / "dry"
+    other.mkdir()
+    assert run(other, parameters(other), dry=True) == ["a", "b", "c"]
+    assert not workflow(other).complete()
+
+def test_split_cores():
+    assert split_cores(32, [9, 1]) == [28, 4]
+    assert split_cores(4, [1, 1]) == [2, 2]
+    assert split_cores(2, [1, 1, 1]) == [1, 1, 0]
+    assert split_cores(0, [1]) == [0]
+
+def test_stage_cores(tmp_path):
+
+    # Stages running at the same time are each pinned to their own
+    # cores; a stage running on its own gets every core, unpinned
+    started = {}
+    def stage(name):
+        def run(parameters, dry, cores):
+            started[name] = [cores, parameters.get("cpu_list")]
+        return run
+    stages = [Stage("a", [], stage("a")),
+              Stage("b", ["a"], stage("b"), cost=3.0),
+              Stage("c", ["a"], stage("c"), cost=1.0)]
+
+    p = parameters(tmp_path, cores_per_node=8)
+    Workflow(stages, state_file=str(tmp_path / "run_state.json")).run(p)
+    assert started == {"a" : [8, None], "b" : [6, [0, 1, 2, 3, 4, 5]], "c" : [2, [6, 7]]}
+    assert p.get("cpu_list") is None